@@ -0,0 +1,217 @@
+"""Provides forward mode automatic differentiation, for getting exact normals from f without finite differences.
+
+A Dual is a value along with its gradient, i.e. its partial derivatives with respect to each input.
+Arithmetic on Duals carries the gradient along, so calling f on Duals seeded with the axes gives both the value of f
+and its gradient in a single evaluation, rather than the 4 or 6 extra evaluations normal_from_function makes.
+The result is exact, rather than depending on the step size d.
+
+Duals support arithmetic, comparisons, abs, and the builtin min and max. For anything else, f must use the functions
+in this module (sqrt, exp, minimum, ...) or their numpy equivalents, not the math module, which only accepts plain
+numbers. The value can also be an array, for vectorized functions (see common.vectorized), in which case
+so is each entry of the gradient. Use minimum and maximum rather than min and max on those."""
+
+import functools
+
+import numpy as np
+
+from common import is_vectorized
+from utils_2d import V2
+from utils_3d import V3
+
+
+class Dual:
+    """A value, along with the gradient of that value. gradient is a tuple with an entry per input."""
+    def __init__(self, value, gradient):
+        self.value = value
+        self.gradient = tuple(gradient)
+
+    def __repr__(self):
+        return "Dual({!r}, {!r})".format(self.value, self.gradient)
+
+    def __add__(self, other):
+        a, ga, b, gb = _split(self, other)
+        return Dual(a + b, [x + y for x, y in zip(ga, gb)])
+
+    def __radd__(self, other):
+        return self + other
+
+    def __sub__(self, other):
+        a, ga, b, gb = _split(self, other)
+        return Dual(a - b, [x - y for x, y in zip(ga, gb)])
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        a, ga, b, gb = _split(self, other)
+        return Dual(a * b, [x * b + a * y for x, y in zip(ga, gb)])
+
+    def __rmul__(self, other):
+        return self * other
+
+    def __truediv__(self, other):
+        a, ga, b, gb = _split(self, other)
+        return Dual(a / b, [(x * b - a * y) / (b * b) for x, y in zip(ga, gb)])
+
+    def __rtruediv__(self, other):
+        a, ga, b, gb = _split(other, self)
+        return Dual(a / b, [(x * b - a * y) / (b * b) for x, y in zip(ga, gb)])
+
+    def __pow__(self, other):
+        if isinstance(other, Dual):
+            return exp(other * log(self))
+        value = self.value ** other
+        return Dual(value, [other * self.value ** (other - 1) * x for x in self.gradient])
+
+    def __rpow__(self, other):
+        return exp(self * np.log(other))
+
+    def __neg__(self):
+        return Dual(-self.value, [-x for x in self.gradient])
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        sign = np.sign(self.value)
+        return Dual(abs(self.value), [sign * x for x in self.gradient])
+
+    # Comparisons just look at the values, which is what min and max need
+    def __lt__(self, other):
+        return self.value < _value(other)
+
+    def __le__(self, other):
+        return self.value <= _value(other)
+
+    def __gt__(self, other):
+        return self.value > _value(other)
+
+    def __ge__(self, other):
+        return self.value >= _value(other)
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        """Lets numpy functions like numpy.sqrt be applied to Duals, and arrays be combined with them"""
+        if method != "__call__" or kwargs:
+            return NotImplemented
+        if ufunc in _UNARY and len(inputs) == 1:
+            x = inputs[0]
+            value = ufunc(x.value)
+            derivative = _UNARY[ufunc](x.value, value)
+            return Dual(value, [derivative * g for g in x.gradient])
+        if ufunc in _BINARY and len(inputs) == 2:
+            return _BINARY[ufunc](*inputs)
+        return NotImplemented
+
+
+def _value(x):
+    return x.value if isinstance(x, Dual) else x
+
+
+def _split(a, b):
+    """Returns the values and gradients of a and b, where one of them might be a plain number or array"""
+    n = len(a.gradient) if isinstance(a, Dual) else len(b.gradient)
+    if isinstance(a, Dual):
+        a, ga = a.value, a.gradient
+    else:
+        ga = (0,) * n
+    if isinstance(b, Dual):
+        b, gb = b.value, b.gradient
+    else:
+        gb = (0,) * n
+    return a, ga, b, gb
+
+
+def _select(condition, a, b):
+    """Takes a where condition holds, otherwise b, along with the matching gradient"""
+    a, ga, b, gb = _split(a, b)
+    return Dual(np.where(condition, a, b), [np.where(condition, x, y) for x, y in zip(ga, gb)])
+
+
+def _hypot(a, b):
+    return sqrt(a * a + b * b)
+
+
+# For each supported single argument ufunc, the derivative, given the input and the output
+_UNARY = {
+    np.sqrt: lambda x, y: 0.5 / y,
+    np.exp: lambda x, y: y,
+    np.log: lambda x, y: 1 / x,
+    np.sin: lambda x, y: np.cos(x),
+    np.cos: lambda x, y: -np.sin(x),
+    np.tan: lambda x, y: 1 + y * y,
+    np.absolute: lambda x, y: np.sign(x),
+    np.negative: lambda x, y: -1,
+    np.square: lambda x, y: 2 * x,
+}
+
+# Two argument ufuncs, in terms of the operators above
+_BINARY = {
+    np.add: lambda a, b: Dual.__add__(a, b) if isinstance(a, Dual) else Dual.__radd__(b, a),
+    np.subtract: lambda a, b: Dual.__sub__(a, b) if isinstance(a, Dual) else Dual.__rsub__(b, a),
+    np.multiply: lambda a, b: Dual.__mul__(a, b) if isinstance(a, Dual) else Dual.__rmul__(b, a),
+    np.true_divide: lambda a, b: Dual.__truediv__(a, b) if isinstance(a, Dual) else Dual.__rtruediv__(b, a),
+    np.power: lambda a, b: Dual.__pow__(a, b) if isinstance(a, Dual) else Dual.__rpow__(b, a),
+    np.minimum: lambda a, b: _select(_value(a) <= _value(b), a, b),
+    np.maximum: lambda a, b: _select(_value(a) >= _value(b), a, b),
+    np.hypot: _hypot,
+}
+
+
+def sqrt(x):
+    return np.sqrt(x)
+
+
+def exp(x):
+    return np.exp(x)
+
+
+def log(x):
+    return np.log(x)
+
+
+def sin(x):
+    return np.sin(x)
+
+
+def cos(x):
+    return np.cos(x)
+
+
+def minimum(a, b):
+    """Like min, but elementwise for arrays"""
+    return np.minimum(a, b)
+
+
+def maximum(a, b):
+    """Like max, but elementwise for arrays"""
+    return np.maximum(a, b)
+
+
+def value_and_gradient(f, *p):
+    """Evaluates f at a point, returning its value and a tuple of its partial derivatives.
+    For a vectorized f, the coordinates can be arrays."""
+    n = len(p)
+    seeds = [Dual(x, [1 if axis == i else 0 for axis in range(n)]) for i, x in enumerate(p)]
+    result = f(*seeds)
+    if not isinstance(result, Dual):
+        # f doesn't depend on its inputs at all
+        return result, (0,) * n
+    return result.value, result.gradient
+
+
+def normal_from_autodiff(f):
+    """Given a 2d or 3d function written with the operations above, returns a function giving its exact
+    normalized gradient, for use as f_normal, evaluating f once per normal.
+    Like normal_from_function, the result is vectorized if f is, and can be pickled if f can."""
+    norm = functools.partial(_autodiff_normal, f)
+    norm.vectorized = is_vectorized(f)
+    return norm
+
+
+def _autodiff_normal(f, *p):
+    _, gradient = value_and_gradient(f, *p)
+    return (V3 if len(p) == 3 else V2)(*gradient).normalize()
+
+
+__all__ = ["Dual", "value_and_gradient", "normal_from_autodiff",
+           "sqrt", "exp", "log", "sin", "cos", "minimum", "maximum"]
@@ -0,0 +1,268 @@
+"""Measures the performance of the four extractors on the example functions, at a range of grid sizes.
+
+Run it as a script. E.g. to record some results, and then later check a change against them:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --baseline before.json
+
+Every case meshes the range -3 to 3 along each axis (the default range of settings) with a number of cells along
+each side. For each case, it records the wall time (the median of --repeat runs, and the fastest), cells per second,
+the number of points f and f_normal were evaluated at, the peak memory allocated by Python while meshing, and the
+number of vertices and faces output. Counts and memory are measured in a separate run from the timing, as tracing
+them slows everything down.
+
+Comparing against a baseline (the JSON output of an earlier run) lists the change in time and memory of each case
+present in both. Cases more than --threshold times slower, or using that much more memory, are regressions,
+and make the script exit with status 1. The smallest cases take a few milliseconds, where noise alone can exceed
+the threshold, so a case also has to be more than --min-time seconds slower to count. Changed counts are reported
+too, as they mean the amount of work done or the output itself has changed."""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+import config
+import dual_contour_2d
+import dual_contour_3d
+import marching_cubes_2d
+import marching_cubes_3d
+from common import is_vectorized
+
+
+# The range meshed along each axis
+DOMAIN = (-3, 3)
+
+# The number of cells along each side of the grid, for each size of case
+SIZES_2D = (6, 12, 24, 48, 96)
+SIZES_3D = (6, 12, 24)
+
+# The example functions, with their normals. t_shape has no sensible normal, so isn't used with Dual Contouring.
+FIELDS_2D = {
+    "circle": (dual_contour_2d.circle_function, dual_contour_2d.circle_normal),
+    "square": (dual_contour_2d.square_function, dual_contour_2d.square_normal),
+    "intersect": (dual_contour_2d.intersect_function,
+                  dual_contour_2d.normal_from_function(dual_contour_2d.intersect_function)),
+    "t_shape": (dual_contour_2d.t_shape_function, None),
+}
+FIELDS_3D = {
+    "circle": (dual_contour_3d.circle_function, dual_contour_3d.circle_normal),
+    "square": (dual_contour_3d.square_function, dual_contour_3d.square_normal),
+    "intersect": (dual_contour_3d.intersect_function,
+                  dual_contour_3d.normal_from_function(dual_contour_3d.intersect_function)),
+    "t_shape": (dual_contour_3d.t_shape_function, None),
+}
+
+# Changes in time smaller than this many seconds are put down to noise
+MIN_TIME = 0.005
+
+# The results that count work done or output, rather than being measured
+COUNTS = ("f_calls", "f_normal_calls", "vertices", "faces")
+
+
+def _marching_cubes_2d(f, f_normal, cfg):
+    return marching_cubes_2d.marching_cubes_2d(f, *DOMAIN * 2, config=cfg)
+
+
+def _dual_contour_2d(f, f_normal, cfg):
+    return dual_contour_2d.dual_contour_2d(f, f_normal, *DOMAIN * 2, config=cfg)
+
+
+def _marching_cubes_3d(f, f_normal, cfg):
+    return marching_cubes_3d.marching_cubes_3d(f, *DOMAIN * 3, config=cfg)
+
+
+def _dual_contour_3d(f, f_normal, cfg):
+    return dual_contour_3d.dual_contour_3d(f, f_normal, *DOMAIN * 3, config=cfg)
+
+
+# For each extractor, the number of dimensions, how to run it, and whether it needs f_normal
+EXTRACTORS = {
+    "marching_cubes_2d": (2, _marching_cubes_2d, False),
+    "dual_contour_2d": (2, _dual_contour_2d, True),
+    "marching_cubes_3d": (3, _marching_cubes_3d, False),
+    "dual_contour_3d": (3, _dual_contour_3d, True),
+}
+
+
+class _Counter:
+    """Wraps f or f_normal, counting the points it is evaluated at"""
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+        self.vectorized = is_vectorized(f)
+
+    def __call__(self, *p):
+        self.count += np.size(p[0])
+        return self.f(*p)
+
+
+def _output_size(result):
+    """Returns the number of vertices and faces of a Mesh, or of a list of Edges"""
+    if isinstance(result, list):
+        return len({(v.x, v.y) for edge in result for v in (edge.v1, edge.v2)}), len(result)
+    return len(result.positions), len(result.tris) + len(result.quads)
+
+
+def run_case(extractor, field, cells, repeat=5):
+    """Meshes field with extractor, on a grid of the given number of cells along each side,
+    and returns a dictionary of the results"""
+    dims, run, uses_normal = EXTRACTORS[extractor]
+    f, f_normal = (FIELDS_2D if dims == 2 else FIELDS_3D)[field]
+    cfg = config.current(cell_size=(DOMAIN[1] - DOMAIN[0]) / cells)
+
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run(f, f_normal, cfg)
+        times.append(time.perf_counter() - start)
+    median = float(np.median(times))
+
+    counted_f = _Counter(f)
+    counted_normal = _Counter(f_normal) if uses_normal else None
+    tracemalloc.start()
+    try:
+        result = run(counted_f, counted_normal, cfg)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    vertices, faces = _output_size(result)
+
+    return {
+        "extractor": extractor,
+        "field": field,
+        "cells": cells,
+        "total_cells": cells ** dims,
+        "time": median,
+        "best_time": min(times),
+        "cells_per_second": cells ** dims / median if median > 0 else float("inf"),
+        "f_calls": counted_f.count,
+        "f_normal_calls": counted_normal.count if counted_normal else 0,
+        "peak_memory": peak,
+        "vertices": vertices,
+        "faces": faces,
+    }
+
+
+def cases(extractors=None, fields=None, sizes_2d=SIZES_2D, sizes_3d=SIZES_3D):
+    """Lists the (extractor, field, cells) of every case to run, optionally just for some extractors or fields"""
+    result = []
+    for extractor in extractors or EXTRACTORS:
+        dims, _, uses_normal = EXTRACTORS[extractor]
+        all_fields = FIELDS_2D if dims == 2 else FIELDS_3D
+        for field, (_, f_normal) in all_fields.items():
+            if fields is not None and field not in fields:
+                continue
+            if uses_normal and f_normal is None:
+                continue
+            for cells in (sizes_2d if dims == 2 else sizes_3d):
+                result.append((extractor, field, cells))
+    return result
+
+
+def run_benchmarks(case_list, repeat=5, report=None):
+    """Runs each case, returning the results along with a description of the machine.
+    report, if given, is called with the results of each case as it finishes."""
+    results = []
+    for case in case_list:
+        results.append(run_case(*case, repeat=repeat))
+        if report:
+            report(results[-1])
+    return {
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+        },
+        "repeat": repeat,
+        "results": results,
+    }
+
+
+def _key(result):
+    return result["extractor"], result["field"], result["cells"]
+
+
+def _name(result):
+    return "{} {} {}".format(*_key(result))
+
+
+def format_result(result):
+    return "{:<40} {:>10.2f}ms {:>12.0f} cells/s {:>8} f {:>8} f_normal {:>9.1f}KiB {:>6} verts {:>6} faces".format(
+        _name(result), result["time"] * 1000, result["cells_per_second"], result["f_calls"],
+        result["f_normal_calls"], result["peak_memory"] / 1024, result["vertices"], result["faces"])
+
+
+def compare(results, baseline, threshold=1.25, min_time=MIN_TIME):
+    """Compares results with baseline, both as returned by run_benchmarks.
+    A case is slower if its time grew by more than threshold times, and by more than min_time seconds.
+    Returns a list of lines describing the differences, and whether any case regressed."""
+    old = {_key(r): r for r in baseline["results"]}
+    lines = []
+    regressed = False
+    for result in results["results"]:
+        before = old.get(_key(result))
+        if before is None:
+            lines.append("{:<40} not in baseline".format(_name(result)))
+            continue
+        time_ratio = result["time"] / before["time"] if before["time"] > 0 else 1
+        memory_ratio = result["peak_memory"] / before["peak_memory"] if before["peak_memory"] > 0 else 1
+        notes = []
+        if time_ratio > threshold and result["time"] - before["time"] > min_time:
+            notes.append("SLOWER")
+        if memory_ratio > threshold:
+            notes.append("MORE MEMORY")
+        regressed = regressed or bool(notes)
+        for count in COUNTS:
+            if result[count] != before[count]:
+                notes.append("{} {} -> {}".format(count, before[count], result[count]))
+        lines.append("{:<40} time x{:.2f} ({:.2f}ms -> {:.2f}ms), memory x{:.2f} {}".format(
+            _name(result), time_ratio, before["time"] * 1000, result["time"] * 1000, memory_ratio,
+            ", ".join(notes)).rstrip())
+    return lines, regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmarks the extractors on the example functions.")
+    parser.add_argument("--extractors", nargs="+", choices=list(EXTRACTORS), help="only run these extractors")
+    parser.add_argument("--fields", nargs="+", choices=sorted(set(FIELDS_2D) | set(FIELDS_3D)),
+                        help="only run on these functions")
+    parser.add_argument("--sizes-2d", nargs="+", type=int, default=SIZES_2D,
+                        help="cells along each side of the grid, for the 2d extractors")
+    parser.add_argument("--sizes-3d", nargs="+", type=int, default=SIZES_3D,
+                        help="cells along each side of the grid, for the 3d extractors")
+    parser.add_argument("--repeat", type=int, default=5, help="times to run each case, keeping the median")
+    parser.add_argument("--output", help="file to write the results to, as JSON")
+    parser.add_argument("--baseline", help="results of an earlier run to compare with")
+    parser.add_argument("--threshold", type=float, default=1.25,
+                        help="how many times slower (or larger) a case can get before it counts as a regression")
+    parser.add_argument("--min-time", type=float, default=MIN_TIME,
+                        help="how many seconds slower a case has to get to count as a regression")
+    args = parser.parse_args(argv)
+
+    case_list = cases(args.extractors, args.fields, args.sizes_2d, args.sizes_3d)
+    results = run_benchmarks(case_list, args.repeat, report=lambda result: print(format_result(result)))
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(results, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        lines, regressed = compare(results, baseline, args.threshold, args.min_time)
+        print()
+        print("Compared with {}:".format(args.baseline))
+        for line in lines:
+            print(line)
+        if regressed:
+            return 1
+    return 0
+
+
+__all__ = ["run_case", "cases", "run_benchmarks", "compare", "main"]
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""Provides functions for meshing domains too large to fit in memory, by working through them a slab at a time.
+
+The domain is split along the z axis into slabs of chunk_size cells. Only one slab is held in memory at once,
+along with the indices of the vertices on the boundary with the previous slab, so that faces crossing
+that boundary can join up with vertices already output. The memory used depends on the size of a slab,
+not the whole domain.
+
+Each function is a generator, yielding a Mesh per slab. Each Mesh only contains the vertices created in that slab,
+but its faces index into the combined vertex list of all the slabs so far. So writing the chunks out in order
+(e.g. with make_obj_chunks), or combining them with join_chunks, gives a single crack free mesh."""
+
+from common import Grid
+from config import resolve
+import settings
+from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
+import numpy as np
+from utils_3d import Mesh, make_obj, sample_grid, find_crossings
+from marching_cubes_3d import cell_triangles, triangle_vertices
+from dual_contour_3d import dual_contour_3d_vertices, dual_contour_3d_faces
+import dual_contour_3d
+
+
+def _slabs(zs, chunk_size):
+    """Yields the range of lattice points along z of each slab"""
+    nz = len(zs) - 1
+    for k0 in range(0, nz, chunk_size):
+        yield k0, min(k0 + chunk_size, nz)
+
+
+def marching_cubes_3d_chunks(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                             chunk_size=None, sparse=False, lipschitz=None, config=None):
+    """Runs Marching Cubes over the specified range one slab at a time, yielding a Mesh per slab.
+    Vertices are shared between triangles as in marching_cubes_3d_vectorized with share_vertices=True,
+    including across slabs. chunk_size defaults to settings.CHUNK_SIZE. See sample_grid for sparse and lipschitz,
+    and config.Config for config."""
+    config = resolve(config)
+    chunk_size = chunk_size or settings.CHUNK_SIZE
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    vertex_count = 0
+    # The vertex of each x and y edge in the top plane of the previous slab
+    previous_top = None
+    for k0, k1 in _slabs(zs, chunk_size):
+        slab_zs = zs[k0:k1 + 1]
+        values = sample_grid(f, xs, ys, slab_zs, sparse, lipschitz, config)
+        crossings = find_crossings(values, xs, ys, slab_zs, config)
+
+        # Number the crossed edges, re-using the vertices from the previous slab
+        # for edges on the plane between the two
+        edge_vertex = []
+        positions = []
+        for axis, (mask, axis_positions) in enumerate(crossings):
+            index = np.full(mask.shape, -1, dtype=np.int64)
+            new = mask.copy()
+            if axis < 2 and previous_top is not None:
+                reused = mask[:, :, 0] & (previous_top[axis] >= 0)
+                index[:, :, 0][reused] = previous_top[axis][reused]
+                new[:, :, 0] &= ~reused
+            count = np.count_nonzero(new)
+            index[new] = np.arange(vertex_count, vertex_count + count)
+            vertex_count += count
+            edge_vertex.append(index)
+            positions.append(axis_positions[new[mask]])
+        previous_top = [edge_vertex[0][:, :, -1], edge_vertex[1][:, :, -1]]
+
+        cells, tri_edges = cell_triangles(values)
+        tri_verts = triangle_vertices(edge_vertex, cells, tri_edges)
+        yield Mesh.from_arrays(np.concatenate(positions), tri_verts)
+
+
+def dual_contour_3d_chunks(f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                           chunk_size=None, sparse=False, lipschitz=None, config=None):
+    """Runs Dual Contouring over the specified range one slab at a time, yielding a Mesh per slab.
+    Joined together, the result is the same as dual_contour_3d, up to the order of vertices and faces.
+    The other arguments are as for marching_cubes_3d_chunks."""
+    config = resolve(config)
+    chunk_size = chunk_size or settings.CHUNK_SIZE
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    vertex_count = 0
+    # The vertex of each cell in the top layer of the previous slab, and the signs of the lattice points below them
+    previous_layer = None
+    previous_solid = None
+    for k0, k1 in _slabs(zs, chunk_size):
+        slab_zs = zs[k0:k1 + 1]
+        values = sample_grid(f, xs, ys, slab_zs, sparse, lipschitz, config)
+        solid = values > 0
+        positions, vert_index = dual_contour_3d_vertices(f_normal, values, xs, ys, slab_zs, config=config)
+        vert_index[vert_index >= 0] += vertex_count
+        vertex_count += len(positions)
+
+        if previous_layer is None:
+            quads = dual_contour_3d_faces(solid, vert_index)
+        else:
+            # Include the last layer of cells of the previous slab, so faces on the plane between them
+            # can be found. That layer has already output its own faces.
+            quads = dual_contour_3d_faces(
+                np.concatenate([previous_solid[:, :, None], solid], axis=2),
+                np.concatenate([previous_layer[:, :, None], vert_index], axis=2),
+                first_owner=(0, 0, 1))
+        previous_layer = vert_index[:, :, -1]
+        previous_solid = solid[:, :, -2]
+
+        yield Mesh.from_arrays(positions, quads=quads)
+
+
+def join_chunks(chunks):
+    """Combines the chunks yielded by one of the functions above into a single Mesh"""
+    mesh = Mesh()
+    for chunk in chunks:
+        # The faces already index into the combined vertex list, so don't need offsetting
+        mesh.extend(chunk, offset=0)
+    return mesh
+
+
+def make_obj_chunks(f, chunks):
+    """Writes chunks to a Wavefront mesh file as they are produced, without ever holding the whole mesh"""
+    for chunk in chunks:
+        make_obj(f, chunk)
+
+
+__all__ = ["marching_cubes_3d_chunks", "dual_contour_3d_chunks", "join_chunks", "make_obj_chunks"]
+
+if __name__ == "__main__":
+    circle_function = dual_contour_3d.circle_function
+    chunks = dual_contour_3d_chunks(circle_function, dual_contour_3d.normal_from_function(circle_function),
+                                    chunk_size=2)
+    with open("output.obj", "w") as f:
+        make_obj_chunks(f, chunks)
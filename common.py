@@ -1,6 +1,8 @@
 """Contains utilities common to all meshing methods"""
 
-import settings
+import numpy as np
+
+from config import resolve
 
 class Edge:
     def __init__(self, v1, v2):
@@ -13,18 +15,138 @@ class Edge:
         else:
             return Edge(self.v1, self.v2)
 
-def adapt(v0, v1):
-    """v0 and v1 are numbers of opposite sign. This returns how far you need to interpolate from v0 to v1 to get to 0."""
+def adapt(v0, v1, config=None, axis=0):
+    """v0 and v1 are numbers of opposite sign. This returns how far you need to interpolate from v0 to v1 to get to 0.
+    v0 and v1 are at either end of a cell edge along axis, and config (see config.Config) gives the cell size."""
     assert (v1 > 0) != (v0 > 0), "v0 and v1 do not have opposite sign"
-    if settings.ADAPTIVE:
-        return (0 - v0) / (v1 - v0) * settings.CELL_SIZE
+    config = resolve(config)
+    if config.adaptive:
+        return (0 - v0) / (v1 - v0) * config.size(axis)
     else:
-        return 0.5 * settings.CELL_SIZE
+        return 0.5 * config.size(axis)
+
+def adapt_array(v0, v1, config=None, axis=0):
+    """Like adapt, but operates elementwise on numpy arrays of values. The caller is responsible
+    for only passing pairs that have opposite sign."""
+    config = resolve(config)
+    return adapt_fraction_array(v0, v1, config) * config.size(axis)
+
+def adapt_fraction_array(v0, v1, config=None):
+    """Like adapt_array, but gives the fraction of the way along the edge, for edges of any length"""
+    if resolve(config).adaptive:
+        return (0 - v0) / (v1 - v0)
+    else:
+        return np.full(np.shape(v0), 0.5)
+
+class Grid:
+    """A regular lattice of cells. origin is the lowest corner, spacing the size of a cell along each axis, and shape
+    the number of cells along each axis. Lattice points are identified by integer indices, and their positions
+    are always worked out from those, so unlike stepping along with floats, they never drift."""
+    def __init__(self, origin, spacing, shape):
+        self.origin = np.array(origin, dtype=float)
+        self.spacing = np.broadcast_to(np.array(spacing, dtype=float), self.origin.shape).copy()
+        self.shape = tuple(int(n) for n in shape)
+        assert len(self.shape) == len(self.origin), "shape does not match origin"
+        # The position of each lattice point along each axis
+        self.coords = [o + np.arange(n + 1) * s for o, s, n in zip(self.origin, self.spacing, self.shape)]
+
+    @classmethod
+    def from_bounds(cls, mins, maxs, config=None):
+        """Returns the grid starting at mins, of cells of the size given by config (see config.Config),
+        with enough of them to reach maxs. The last cell along each axis can go past maxs."""
+        spacing = resolve(config).sizes(len(mins))
+        # Allow for a little rounding error, so a range a whole number of cells long doesn't get an extra one
+        shape = [max(int(np.ceil((hi - lo) / s - 1e-9)), 0) for lo, hi, s in zip(mins, maxs, spacing)]
+        return cls(mins, spacing, shape)
+
+    def __repr__(self):
+        return "Grid({}, {}, {})".format(self.origin.tolist(), self.spacing.tolist(), self.shape)
+
+    @property
+    def dims(self):
+        return len(self.shape)
+
+    @property
+    def point_shape(self):
+        """The number of lattice points along each axis"""
+        return tuple(n + 1 for n in self.shape)
+
+    def position(self, index):
+        """The position of the lattice point with the given index. index can also be an array with a
+        row per point, or be fractional."""
+        return self.origin + np.asarray(index) * self.spacing
+
+    def cell(self, position):
+        """The index of the cell containing position (or an array of them), which may be outside the grid"""
+        return np.floor((np.asarray(position, dtype=float) - self.origin) / self.spacing).astype(np.int64)
+
+    def point(self, position, tolerance=1e-6):
+        """The index of the lattice point at position, allowing for rounding error,
+        or None if position isn't on a lattice point of the grid"""
+        index = (np.asarray(position, dtype=float) - self.origin) / self.spacing
+        nearest = np.round(index)
+        if np.any(np.abs(index - nearest) > tolerance) or np.any(nearest < 0) or np.any(nearest > self.shape):
+            return None
+        return tuple(int(i) for i in nearest)
+
+    def cells(self):
+        """Iterates over the index of every cell, in order"""
+        return np.ndindex(*self.shape)
+
+    def cell_positions(self):
+        """Iterates over the index and lowest corner of every cell, in order"""
+        coords = [c[:-1].tolist() for c in self.coords]
+        for index in self.cells():
+            yield index, tuple(c[i] for c, i in zip(coords, index))
+
+    def index_array(self, fill=-1, points=False):
+        """An integer array with an entry per cell (or per lattice point), all set to fill"""
+        return np.full(self.point_shape if points else self.shape, fill, dtype=np.int64)
+
+def vectorized(f):
+    """Decorator declaring that f (or f_normal) can be called with numpy arrays of coordinates, one per axis,
+    as well as with single numbers. f should then return an array of values, and f_normal a V2/V3 of arrays.
+    Where possible, the meshing methods then evaluate whole blocks of points with a single call,
+    of at most the batch_size of their config (settings.BATCH_SIZE by default) points."""
+    f.vectorized = True
+    return f
+
+def signed_distance(f):
+    """Decorator declaring that f is a signed distance function, or at least never changes by more than the
+    distance moved. The sparse search (see utils_3d.find_active_blocks) then uses that as its lipschitz bound,
+    so it can safely skip regions without being told."""
+    f.lipschitz = 1
+    return f
+
+def is_vectorized(f):
+    return getattr(f, "vectorized", False)
 
-def frange(start, stop, step=1):
-    """Like range, but works for floats"""
-    v = start
-    while v < stop:
-        yield v
-        v += step
+def evaluate_batch(f, *coords, config=None):
+    """Evaluates f at each of the points given by coords, a 1d array of positions per axis.
+    Returns an array of the values. f is only called point by point if it isn't vectorized,
+    and otherwise on batches of config.batch_size points."""
+    n = len(coords[0])
+    if not is_vectorized(f):
+        return np.array([f(*p) for p in zip(*[np.asarray(c).tolist() for c in coords])], dtype=float)
+    batch_size = resolve(config).batch_size
+    result = np.empty(n)
+    for start in range(0, n, batch_size):
+        result[start:start + batch_size] = f(*[c[start:start + batch_size] for c in coords])
+    return result
 
+def evaluate_normals_batch(f_normal, *coords, config=None):
+    """Like evaluate_batch, but for f_normal. Returns an array with a row per point, and a column per axis."""
+    n = len(coords[0])
+    axes = "xyz"[:len(coords)]
+    result = np.empty((n, len(axes)))
+    if not is_vectorized(f_normal):
+        for i, p in enumerate(zip(*[np.asarray(c).tolist() for c in coords])):
+            normal = f_normal(*p)
+            result[i] = [getattr(normal, a) for a in axes]
+        return result
+    batch_size = resolve(config).batch_size
+    for start in range(0, n, batch_size):
+        normal = f_normal(*[c[start:start + batch_size] for c in coords])
+        for j, a in enumerate(axes):
+            result[start:start + batch_size, j] = getattr(normal, a)
+    return result
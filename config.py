@@ -0,0 +1,60 @@
+"""Provides Config, for giving settings to the extractors per call, rather than through the settings module.
+
+The extractors and the QEF solvers take an optional config argument. If it is left out, they use a Config of the
+values in the settings module at the time of the call, so changing those works as it always has. A Config is
+immutable, and handed down to everything that needs it, so extractions with different settings can run side
+by side in the same process (even in threads) without interfering. E.g.
+
+    fine = config.current(cell_size=0.25)
+    flat = config.current(cell_size=(1, 1, 0.5), bias=False)
+    mesh = dual_contour_3d(f, f_normal, config=flat)"""
+
+import collections
+
+import numpy as np
+
+import settings
+
+
+class Config(collections.namedtuple("Config", ["cell_size", "adaptive", "clip", "boundary", "bias",
+                                               "bias_strength", "batch_size"])):
+    """The settings that change how a mesh is made, see the settings module for what each means.
+    cell_size is either a single number, or a sequence with a size per axis, for cells that aren't square.
+    Use replace to make a modified copy."""
+    __slots__ = ()
+
+    def __new__(cls, cell_size, adaptive, clip, boundary, bias, bias_strength, batch_size):
+        if np.ndim(cell_size) > 0:
+            cell_size = tuple(cell_size)
+        assert np.all(np.asarray(cell_size) > 0), "cell_size must be positive"
+        assert batch_size > 0, "batch_size must be positive"
+        return super().__new__(cls, cell_size, adaptive, clip, boundary, bias, bias_strength, batch_size)
+
+    def size(self, axis):
+        """The size of a cell along the given axis"""
+        if isinstance(self.cell_size, tuple):
+            return self.cell_size[axis]
+        return self.cell_size
+
+    def sizes(self, dims):
+        """The size of a cell along each of the first dims axes"""
+        return tuple(self.size(axis) for axis in range(dims))
+
+    def replace(self, **kwargs):
+        """Returns a copy of this Config, with some fields changed"""
+        return Config(**dict(self._asdict(), **kwargs))
+
+
+def current(**kwargs):
+    """Returns a Config of the values in the settings module right now, with any fields given as keyword
+    arguments changed"""
+    return Config(settings.CELL_SIZE, settings.ADAPTIVE, settings.CLIP, settings.BOUNDARY, settings.BIAS,
+                  settings.BIAS_STRENGTH, settings.BATCH_SIZE).replace(**kwargs)
+
+
+def resolve(config):
+    """Returns config, or if it is None, the current settings"""
+    return current() if config is None else config
+
+
+__all__ = ["Config", "current"]
@@ -1,35 +1,47 @@
 """Provides a function for performing 2D Dual Contouring"""
 
 import math
+import functools
 
+import numpy as np
 
-from common import Edge, adapt, frange
-from settings import ADAPTIVE, XMIN, XMAX, YMIN, YMAX, CELL_SIZE
-from utils_2d import V2, make_svg
-from qef import solve_qef_2d
+from common import Edge, Grid, adapt, evaluate_normals_batch, is_vectorized
+from config import resolve
+from settings import XMIN, XMAX, YMIN, YMAX
+from utils_2d import V2, make_svg, presample, find_active_cells
+from qef import solve_qef_2d, solve_qef_batch
 
 
-def dual_contour_2d_find_best_vertex(f, f_normal, x, y):
-    if not ADAPTIVE:
-        return V2(x+0.5 * CELL_SIZE, y+0.5 * CELL_SIZE)
+def _find_crossings(f, x, y, config):
+    """Returns where the boundary crosses each edge of the cell with lowest corner x, y"""
+    size_x, size_y = config.sizes(2)
 
     # Evaluate
     x0y0 = f(x + 0.0, y + 0.0)
-    x0y1 = f(x + 0.0, y + CELL_SIZE)
-    x1y0 = f(x + CELL_SIZE, y + 0.0)
-    x1y1 = f(x + CELL_SIZE, y + CELL_SIZE)
+    x0y1 = f(x + 0.0, y + size_y)
+    x1y0 = f(x + size_x, y + 0.0)
+    x1y1 = f(x + size_x, y + size_y)
 
     # For each edge, identify where there is a sign change
     changes = []
     if (x0y0 > 0) != (x0y1 > 0):
-        changes.append([x + 0, y + adapt(x0y0, x0y1)])
+        changes.append([x + 0, y + adapt(x0y0, x0y1, config, 1)])
     if (x1y0 > 0) != (x1y1 > 0):
-        changes.append([x + CELL_SIZE, y + adapt(x1y0, x1y1)])
+        changes.append([x + size_x, y + adapt(x1y0, x1y1, config, 1)])
     if (x0y0 > 0) != (x1y0 > 0):
-        changes.append([x + adapt(x0y0, x1y0), y + 0])
+        changes.append([x + adapt(x0y0, x1y0, config, 0), y + 0])
     if (x0y1 > 0) != (x1y1 > 0):
-        changes.append([x + adapt(x0y1, x1y1), y + CELL_SIZE])
+        changes.append([x + adapt(x0y1, x1y1, config, 0), y + size_y])
+    return changes
 
+
+def dual_contour_2d_find_best_vertex(f, f_normal, x, y, config=None):
+    config = resolve(config)
+    size_x, size_y = config.sizes(2)
+    if not config.adaptive:
+        return V2(x+0.5 * size_x, y+0.5 * size_y)
+
+    changes = _find_crossings(f, x, y, config)
     if len(changes) <= 1:
         return None
 
@@ -40,56 +52,105 @@ def dual_contour_2d_find_best_vertex(f, f_normal, x, y):
         n = f_normal(v[0], v[1])
         normals.append([n.x, n.y])
 
-    v = solve_qef_2d(x, y, changes, normals)
+    v = solve_qef_2d(x, y, changes, normals, config)
 
     return v
 
-def dual_contour_2d(f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX):
-    """Iterates over a cells of size one between the specified range, and evaluates f and f_normal to produce
-    a boundary by Dual Contouring. Returns an unordered list of Edge objects."""
+
+def _find_best_vertices(f, f_normal, grid, active, config):
+    """Like calling dual_contour_2d_find_best_vertex for every active cell of grid, but evaluates f_normal at
+    all the crossings together in batches, and solves the QEFs together, like dual_contour_3d_vertices.
+    Returns a list of vertices, and an array giving for each cell the index of its vertex, or -1 if none."""
+    verts = []
+    vert_index = grid.index_array()
+    if not config.adaptive:
+        for index, (x, y) in grid.cell_positions():
+            if active[index]:
+                vert_index[index] = len(verts)
+                verts.append(dual_contour_2d_find_best_vertex(f, f_normal, x, y, config))
+        return verts, vert_index
+
+    cells = []
+    changes = []
+    for index, (x, y) in grid.cell_positions():
+        cell_changes = _find_crossings(f, x, y, config) if active[index] else []
+        if len(cell_changes) > 1:
+            cells.append((index, x, y))
+            changes.append(cell_changes)
+    if not cells:
+        return verts, vert_index
+
+    # Neighbouring cells share the crossings on their shared edge, so each is only evaluated once
+    points = np.array([p for cell_changes in changes for p in cell_changes], dtype=float)
+    unique, inverse = np.unique(points, axis=0, return_inverse=True)
+    normals = evaluate_normals_batch(f_normal, unique[:, 0], unique[:, 1], config=config)[inverse.reshape(-1)]
+    # Padded out to the most crossings a cell can have
+    mask = np.arange(4) < np.array([len(c) for c in changes])[:, None]
+    padded_points = np.zeros(mask.shape + (2,))
+    padded_points[mask] = points
+    padded_normals = np.zeros(mask.shape + (2,))
+    padded_normals[mask] = normals
+    mins = np.array([(x, y) for _, x, y in cells], dtype=float)
+    positions = solve_qef_batch(mins, padded_points, padded_normals, mask, config=config)
+    for (index, _, _), (vx, vy) in zip(cells, positions.tolist()):
+        vert_index[index] = len(verts)
+        verts.append(V2(vx, vy))
+    return verts, vert_index
+
+
+def dual_contour_2d(f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, config=None, sparse=False):
+    """Iterates over the cells of size config.cell_size between the specified range (see common.Grid),
+    and evaluates f and f_normal to produce a boundary by Dual Contouring. Returns an unordered list of Edge objects.
+    config defaults to the current settings, see config.Config.
+    If sparse is set and f has an interval method (see interval.bounded), only the cells
+    that might contain the boundary are visited, see find_active_cells."""
+    config = resolve(config)
+    grid = Grid.from_bounds((xmin, ymin), (xmax, ymax), config)
+    if sparse:
+        active = find_active_cells(f, grid)
+    else:
+        active = np.ones(grid.shape, dtype=bool)
+        # Evaluate vectorized f at every grid point up front in batches, or read a volume a tile at a time
+        f = presample(f, grid, config)
     # For each cell, find the the best vertex for fitting f
-    verts = {}
-    for ix, x in enumerate(frange(xmin, xmax, CELL_SIZE)):
-        for iy, y in enumerate(frange(ymin, ymax, CELL_SIZE)):
-            verts[ix, iy] = dual_contour_2d_find_best_vertex(f, f_normal, x, y)
+    verts, vert_index = _find_best_vertices(f, f_normal, grid, active, config)
+    # The solidity of each corner of the active cells. A sign changing edge always has active cells either side.
+    xs, ys = [c.tolist() for c in grid.coords]
+    corners = np.zeros(grid.point_shape, dtype=bool)
+    for dx in (0, 1):
+        for dy in (0, 1):
+            corners[dx:dx + active.shape[0], dy:dy + active.shape[1]] |= active
+    solid = np.zeros(grid.point_shape, dtype=bool)
+    for ix, iy in zip(*np.nonzero(corners)):
+        solid[ix, iy] = f(xs[ix], ys[iy]) > 0
     # For each cell edge, emit an edge between the center of the adjacent cells if it is a sign changing edge
     edges = []
+    nx, ny = grid.shape
     # Do all the vertical sign changes
-    for ix, x in enumerate(frange(xmin, xmax, CELL_SIZE)):
-        if ix == 0:
-            continue
-        for iy, y in enumerate(frange(ymin, ymax, CELL_SIZE)):
-            y0 = y
-            y1 = y+CELL_SIZE
-            y0_solid = f(x, y0) > 0
-            y1_solid = f(x, y1) > 0
-            if y0_solid != y1_solid:
-                edges.append(Edge(verts[ix - 1, iy], verts[ix, iy]).swap(y0_solid))
+    for ix in range(1, nx):
+        for iy in range(ny):
+            if active[ix - 1, iy] and active[ix, iy] and solid[ix, iy] != solid[ix, iy + 1]:
+                edges.append(Edge(verts[vert_index[ix - 1, iy]], verts[vert_index[ix, iy]]).swap(solid[ix, iy]))
     # Do all the horizontal sign changes
-    for iy, y in enumerate(frange(ymin, ymax, CELL_SIZE)):
-        if iy == 0:
-            continue
-        for ix, x in enumerate(frange(xmin, xmax, CELL_SIZE)):
-            x0 = x
-            x1 = x+CELL_SIZE
-            x0_solid = f(x0, y) > 0
-            x1_solid = f(x1, y) > 0
-            if x0_solid != x1_solid:
-                edges.append(Edge(verts[ix, iy-1], verts[ix, iy]).swap(x0_solid))
+    for iy in range(1, ny):
+        for ix in range(nx):
+            if active[ix, iy - 1] and active[ix, iy] and solid[ix, iy] != solid[ix + 1, iy]:
+                edges.append(Edge(verts[vert_index[ix, iy - 1]], verts[vert_index[ix, iy]]).swap(solid[ix, iy]))
     return edges
 
 
 def circle_function(x, y):
-    return 2.5 - math.sqrt(x*x + y*y)
+    return 2.5 - np.sqrt(x*x + y*y)
 
 
 def circle_normal(x, y):
-    l = math.sqrt(x*x + y*y)
+    l = np.sqrt(x*x + y*y)
     return V2(-x / l, -y / l)
 
 
 def square_function(x, y):
-    return 2.5 - max(abs(x), abs(y))
+    # np.maximum rather than max, so this also works on arrays and overlapping Intervals (see interval.bounded)
+    return 2.5 - np.maximum(abs(x), abs(y))
 
 
 def square_normal(x, y):
@@ -100,28 +161,37 @@ def square_normal(x, y):
 
 def normal_from_function(f, d=0.01):
     """Given a sufficiently smooth 2d function, f, returns a function approximating of the gradient of f.
-    d controls the scale, smaller values are a more accurate approximation."""
-    def norm(x, y):
-        return V2(
-            (f(x + d, y) - f(x - d, y)) / 2 / d,
-            (f(x, y + d) - f(x, y - d)) / 2 / d,
-        ).normalize()
+    d controls the scale, smaller values are a more accurate approximation.
+    The result is vectorized if f is, and can be pickled (e.g. to send to another process) if f can."""
+    norm = functools.partial(_finite_difference_normal, f, d)
+    norm.vectorized = is_vectorized(f)
     return norm
 
 
+def _finite_difference_normal(f, d, x, y):
+    return V2(
+        (f(x + d, y) - f(x - d, y)) / 2 / d,
+        (f(x, y + d) - f(x, y - d)) / 2 / d,
+    ).normalize()
+
+
 
 def t_shape_function(x, y):
-    if (x, y) in ((0, 0), (0, 1), (0, -1), (1, 0)):
-        return 1
-    return -1
+    """1 at the lattice points (0, 0), (0, 1), (0, -1) and (1, 0), and -1 at every other lattice point.
+    Between lattice points, it slopes linearly, and is written with np.minimum and np.maximum (rather than
+    comparisons, which overlapping Intervals can't answer), so interval.bounded can skip regions away from the T."""
+    bumps = [1 - 2 * np.minimum(abs(x - px) + abs(y - py), 1) for px, py in ((0, 0), (0, 1), (0, -1), (1, 0))]
+    return np.maximum(np.maximum(bumps[0], bumps[1]), np.maximum(bumps[2], bumps[3]))
 
 
 def intersect_function(x, y):
-    y -= 0.3
-    x -= 0.5
+    # Not -=, which would change arrays passed in
+    y = y - 0.3
+    x = x - 0.5
     x = abs(x)
     #x += x*x / 1000
-    return min(x - y, x + y)
+    # np.minimum rather than min, so interval.bounded can bound this where x - y and x + y overlap
+    return np.minimum(x - y, x + y)
 
 
 __all__ = ["dual_contour_2d"]
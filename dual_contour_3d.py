@@ -1,23 +1,30 @@
 """Provides a function for performing 3D Dual Countouring"""
 
-from common import adapt, frange
-from settings import ADAPTIVE, XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX, CELL_SIZE
+from common import Grid, adapt, is_vectorized, evaluate_normals_batch, signed_distance
+from config import resolve
+from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
 import numpy as np
-import math
-from utils_3d import V3, Quad, Mesh, make_obj
-from qef import solve_qef_3d
+import functools
+from utils_3d import V3, Mesh, make_obj, sample_grid, find_crossings
+from qef import solve_qef_3d, solve_qef_batch
+from marching_cubes_3d import number_crossings
 
 
-def dual_contour_3d_find_best_vertex(f, f_normal, x, y, z):
-    if not ADAPTIVE:
-        return V3(x+0.5*CELL_SIZE, y+0.5*CELL_SIZE, z+0.5*CELL_SIZE)
+def dual_contour_3d_find_best_vertex(f, f_normal, x, y, z, v=None, config=None):
+    """Finds the vertex for the cell with lowest corner (x, y, z).
+    v optionally gives the already known values of f at the corners of the cell, as a 2x2x2 array."""
+    config = resolve(config)
+    size_x, size_y, size_z = config.sizes(3)
+    if not config.adaptive:
+        return V3(x+0.5*size_x, y+0.5*size_y, z+0.5*size_z)
 
-    # Evaluate f at each corner
-    v = np.empty((2, 2, 2))
-    for dx in (0, 1):
-        for dy in (0, 1):
-            for dz in (0,1):
-                v[dx, dy, dz] = f(x + dx * CELL_SIZE, y + dy * CELL_SIZE, z + dz * CELL_SIZE)
+    if v is None:
+        # Evaluate f at each corner
+        v = np.empty((2, 2, 2))
+        for dx in (0, 1):
+            for dy in (0, 1):
+                for dz in (0,1):
+                    v[dx, dy, dz] = f(x + dx * size_x, y + dy * size_y, z + dz * size_z)
 
     # For each edge, identify where there is a sign change.
     # There are 4 edges along each of the three axes
@@ -25,23 +32,23 @@ def dual_contour_3d_find_best_vertex(f, f_normal, x, y, z):
     for dx in (0, 1):
         for dy in (0, 1):
             if (v[dx, dy, 0] > 0) != (v[dx, dy, 1] > 0):
-                changes.append((x + dx * CELL_SIZE, 
-                                y + dy * CELL_SIZE,
-                                z + adapt(v[dx, dy, 0],v[dx, dy, 1])))
+                changes.append((x + dx * size_x,
+                                y + dy * size_y,
+                                z + adapt(v[dx, dy, 0], v[dx, dy, 1], config, 2)))
 
     for dx in (0, 1):
         for dz in (0, 1):
             if (v[dx, 0, dz] > 0) != (v[dx, 1, dz] > 0):
-                changes.append((x + dx * CELL_SIZE,
-                                y + adapt(v[dx, 0, dz], v[dx, 1, dz]),
-                                z + dz * CELL_SIZE))
+                changes.append((x + dx * size_x,
+                                y + adapt(v[dx, 0, dz], v[dx, 1, dz], config, 1),
+                                z + dz * size_z))
 
     for dy in (0, 1):
         for dz in (0, 1):
             if (v[0, dy, dz] > 0) != (v[1, dy, dz] > 0):
-                changes.append((x + adapt(v[0, dy, dz], v[1, dy, dz]),
-                                y + dy * CELL_SIZE,
-                                z + dz * CELL_SIZE))
+                changes.append((x + adapt(v[0, dy, dz], v[1, dy, dz], config, 0),
+                                y + dy * size_y,
+                                z + dz * size_z))
 
     if len(changes) <= 1:
         return None
@@ -57,88 +64,247 @@ def dual_contour_3d_find_best_vertex(f, f_normal, x, y, z):
         n = f_normal(v[0], v[1], v[2])
         normals.append([n.x, n.y, n.z])
 
-    return solve_qef_3d(x, y, z, changes, normals)
+    return solve_qef_3d(x, y, z, changes, normals, config)
+
+
+# The edges of a cell, in the same order dual_contour_3d_find_best_vertex visits them.
+# Each is the axis the edge runs along, and the offset of its lowest vertex from the lowest corner of the cell.
+CELL_EDGES = (
+    [(2, dx, dy, 0) for dx in (0, 1) for dy in (0, 1)] +
+    [(1, dx, 0, dz) for dx in (0, 1) for dz in (0, 1)] +
+    [(0, 0, dy, dz) for dy in (0, 1) for dz in (0, 1)]
+)
+
+
+class HermiteData:
+    """Stores the position and normal of every place the boundary crosses an edge of the lattice.
+    edge_index is a list with an array per axis. edge_index[axis][ix, iy, iz] is the row of positions and normals
+    for the edge along that axis starting at lattice point (ix, iy, iz), or -1 if that edge has no crossing."""
+    def __init__(self, edge_index, positions, normals):
+        self.edge_index = edge_index
+        self.positions = positions
+        self.normals = normals
+
+    def cell_edges(self):
+        """Returns an array with an entry for every cell, listing the rows of the 12 edges of that cell
+        (in the order of CELL_EDGES), or -1 where there is no crossing"""
+        nx, ny, nz = self.edge_index[0].shape[0], self.edge_index[1].shape[1], self.edge_index[2].shape[2]
+        result = np.empty((nx, ny, nz, len(CELL_EDGES)), dtype=np.int64)
+        for i, (axis, dx, dy, dz) in enumerate(CELL_EDGES):
+            result[..., i] = self.edge_index[axis][dx:dx + nx, dy:dy + ny, dz:dz + nz]
+        return result
+
+
+def dual_contour_3d_hermite(f_normal, values, xs, ys, zs, config=None):
+    """Finds every sign changing edge of the lattice, and the position and normal of the crossing along it.
+    Each edge is shared by 4 cells, but this way f_normal is only called on it once."""
+    crossings = find_crossings(values, xs, ys, zs, config)
+    positions = np.concatenate([p for _, p in crossings])
+    normals = evaluate_normals_batch(f_normal, *positions.T, config=config)
+    return HermiteData(number_crossings(crossings), positions, normals)
+
+
+def dual_contour_3d_vertices(f_normal, values, xs, ys, zs, hermite=None, config=None):
+    """Finds the best vertex for every cell of the lattice that the boundary passes through.
+    Returns an array of vertex positions, and an array giving for each cell the index of its vertex, or -1 if none.
+    Vertices are in the same order as the cells.
+    If the HermiteData of the lattice is already known, it can be passed in as hermite."""
+    config = resolve(config)
+    cell_shape = (len(xs) - 1, len(ys) - 1, len(zs) - 1)
+    if not config.adaptive:
+        mins = np.stack(np.meshgrid(*[np.asarray(c[:-1], dtype=float) for c in (xs, ys, zs)], indexing="ij"), axis=-1)
+        positions = (mins + 0.5 * np.array(config.sizes(3))).reshape(-1, 3)
+        return positions, np.arange(len(positions)).reshape(cell_shape)
+
+    # Find the position and normal on every edge with a sign change, once for all cells
+    if hermite is None:
+        hermite = dual_contour_3d_hermite(f_normal, values, xs, ys, zs, config)
+    # Then gather those for each cell with at least two crossings,
+    # and solve all their QEFs together
+    cell_edges = hermite.cell_edges()
+    crossed = cell_edges >= 0
+    active = np.nonzero(crossed.sum(axis=-1) > 1)
+    rows = cell_edges[active]
+    mins = np.stack([np.asarray(c, dtype=float)[i] for c, i in zip((xs, ys, zs), active)], axis=-1)
+    positions = solve_qef_batch(mins, hermite.positions[rows], hermite.normals[rows], crossed[active],
+                                config=config)
+    vert_index = np.full(cell_shape, -1, dtype=np.int64)
+    vert_index[active] = np.arange(len(positions))
+    return positions, vert_index
+
+
+def surface_nets_3d_vertices(values, xs, ys, zs, relaxation=0, config=None):
+    """Like dual_contour_3d_vertices, but puts each vertex at the mass point of the crossings on the edges of
+    its cell, as in Surface Nets. This is much cheaper, and doesn't need f_normal at all, but rounds off
+    sharp features. Each pass of relaxation then moves every vertex to the average of the vertices of the
+    neighbouring cells, keeping it inside its own cell, which smooths out the terracing of the mass points."""
+    config = resolve(config)
+    cell_shape = (len(xs) - 1, len(ys) - 1, len(zs) - 1)
+    crossings = find_crossings(values, xs, ys, zs, config)
+    positions = np.concatenate([p for _, p in crossings])
+    cell_edges = HermiteData(number_crossings(crossings), positions, None).cell_edges()
+    crossed = cell_edges >= 0
+    count = crossed.sum(axis=-1)
+    active = np.nonzero(count > 1)
+    rows = cell_edges[active]
+    vertices = (positions[rows] * crossed[active][..., None]).sum(axis=1) / count[active][:, None]
+
+    if relaxation > 0 and len(vertices) > 0:
+        has_vertex = count > 1
+        vertex = np.zeros(cell_shape + (3,))
+        vertex[active] = vertices
+        mins = np.stack([np.asarray(c, dtype=float)[i] for c, i in zip((xs, ys, zs), active)], axis=-1)
+        for _ in range(relaxation):
+            total = np.zeros(cell_shape + (3,))
+            neighbours = np.zeros(cell_shape)
+            for axis in range(3):
+                for lo, hi in ((slice(1, None), slice(None, -1)), (slice(None, -1), slice(1, None))):
+                    here = (slice(None),) * axis + (lo,)
+                    there = (slice(None),) * axis + (hi,)
+                    total[here] += vertex[there] * has_vertex[there][..., None]
+                    neighbours[here] += has_vertex[there]
+            relaxed = total[active] / np.maximum(neighbours[active], 1)[:, None]
+            relaxed = np.where(neighbours[active][:, None] > 0, relaxed, vertex[active])
+            vertex[active] = np.clip(relaxed, mins, mins + np.array(config.sizes(3)))
+        vertices = vertex[active]
 
+    vert_index = np.full(cell_shape, -1, dtype=np.int64)
+    vert_index[active] = np.arange(len(vertices))
+    return vertices, vert_index
+
+
+def dual_contour_3d_faces(solid, vert_index, first_owner=(0, 0, 0)):
+    """Finds the quads joining the vertices of neighbouring cells, one for each sign changing edge of the lattice
+    that has 4 cells around it. solid says which lattice points are solid, and vert_index gives the vertex of
+    each cell, as returned by dual_contour_3d_vertices.
+    Each cell is responsible for the edges leaving its lowest corner. Cells with an index below first_owner
+    along any axis are only used as neighbours, and don't output any quads themselves. This is for when
+    the lattice is one piece of a larger one.
+    Returns an array with the 4 vertex indices of each quad."""
+    nx, ny, nz = vert_index.shape
+    vi = vert_index
+    crossed = np.zeros((nx, ny, nz, 3), dtype=bool)
+    quads = np.zeros((nx, ny, nz, 3, 4), dtype=np.int64)
+    swap = np.zeros((nx, ny, nz, 3), dtype=bool)
+
+    # Edges along the z axis
+    solid1 = solid[1:nx, 1:ny, 0:nz]
+    solid2 = solid[1:nx, 1:ny, 1:nz + 1]
+    crossed[1:, 1:, :, 0] = solid1 != solid2
+    quads[1:, 1:, :, 0] = np.stack([vi[:-1, :-1, :], vi[1:, :-1, :], vi[1:, 1:, :], vi[:-1, 1:, :]], axis=-1)
+    swap[1:, 1:, :, 0] = solid2
+
+    # Edges along the y axis
+    solid1 = solid[1:nx, 0:ny, 1:nz]
+    solid2 = solid[1:nx, 1:ny + 1, 1:nz]
+    crossed[1:, :, 1:, 1] = solid1 != solid2
+    quads[1:, :, 1:, 1] = np.stack([vi[:-1, :, :-1], vi[1:, :, :-1], vi[1:, :, 1:], vi[:-1, :, 1:]], axis=-1)
+    swap[1:, :, 1:, 1] = solid1
+
+    # Edges along the x axis
+    solid1 = solid[0:nx, 1:ny, 1:nz]
+    solid2 = solid[1:nx + 1, 1:ny, 1:nz]
+    crossed[:, 1:, 1:, 2] = solid1 != solid2
+    quads[:, 1:, 1:, 2] = np.stack([vi[:, :-1, :-1], vi[:, 1:, :-1], vi[:, 1:, 1:], vi[:, :-1, 1:]], axis=-1)
+    swap[:, 1:, 1:, 2] = solid2
+
+    for axis, first in enumerate(first_owner):
+        crossed[(slice(None),) * axis + (slice(0, first),)] = False
+    quads = quads[crossed]
+    swap = swap[crossed]
+    # Flip the winding of the quads, so they face outwards
+    quads[swap] = quads[swap, ::-1]
+    return quads
+
+
+def dual_contour_3d(f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX, values=None,
+                    sparse=False, lipschitz=None, surface_nets=False, relaxation=0, config=None):
+    """Iterates over the cells of size config.cell_size between the specified range (see common.Grid),
+        and evaluates f and f_normal to produce a boundary by Dual Contouring. Returns a Mesh object.
+        f is evaluated once per grid point, and the results are shared by both passes below.
+        If you've already got those values, you can pass them in as values, an array with an entry for
+        every grid point (i.e. one more than the number of cells along each axis).
+        Otherwise, sparse and lipschitz are passed on to sample_grid, to skip evaluating f far from the boundary.
+        Already gridded fields (see volume.Volume) are meshed a slab at a time by chunked_3d, so the whole
+        grid is never held in memory, and the vertices come out in slab order.
+        If surface_nets is set, vertices are placed by surface_nets_3d_vertices instead of solving QEFs,
+        with the given number of relaxation passes, and f_normal is never called (so can be None).
+        Relaxation needs every vertex at once, so with surface_nets even a Volume is sampled all together.
+        config defaults to the current settings, see config.Config."""
+    config = resolve(config)
+    if values is None and hasattr(f, "sample") and not surface_nets:
+        # chunked_3d builds on this module, so can't be imported at the top
+        from chunked_3d import dual_contour_3d_chunks, join_chunks
+        return join_chunks(dual_contour_3d_chunks(f, f_normal, xmin, xmax, ymin, ymax, zmin, zmax, config=config))
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    if values is None:
+        values = sample_grid(f, xs, ys, zs, sparse, lipschitz, config)
+    values = np.asarray(values, dtype=float)
+    assert values.shape == (len(xs), len(ys), len(zs)), "values does not match the grid"
 
-def dual_contour_3d(f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX):
-    """Iterates over a cells of size one between the specified range, and evaluates f and f_normal to produce
-        a boundary by Dual Contouring. Returns a Mesh object."""
     # For each cell, find the the best vertex for fitting f
-    vert_array = []
-    vert_indices = {}
-    for ix, x in enumerate(frange(xmin, xmax, CELL_SIZE)):
-        for iy, y in enumerate(frange(ymin, ymax, CELL_SIZE)):
-            for iz, z in enumerate(frange(zmin, zmax, CELL_SIZE)):
-                vert = dual_contour_3d_find_best_vertex(f, f_normal, x, y, z)
-                if vert is None:
-                    continue
-                vert_array.append(vert)
-                vert_indices[ix, iy, iz] = len(vert_array)
+    if surface_nets:
+        positions, vert_index = surface_nets_3d_vertices(values, xs, ys, zs, relaxation, config)
+    else:
+        positions, vert_index = dual_contour_3d_vertices(f_normal, values, xs, ys, zs, config=config)
 
     # For each cell edge, emit an face between the center of the adjacent cells if it is a sign changing edge
-    faces = []
-    for ix, x in enumerate(frange(xmin, xmax, CELL_SIZE)):
-        for iy, y in enumerate(frange(ymin, ymax, CELL_SIZE)):
-            for iz, z in enumerate(frange(zmin, zmax, CELL_SIZE)):
-                if x > xmin and y > ymin:
-                    solid1 = f(x, y, z + 0) > 0
-                    solid2 = f(x, y, z + CELL_SIZE) > 0
-                    if solid1 != solid2:
-                        faces.append(Quad(
-                            vert_indices[(ix - 1, iy - 1, iz)],
-                            vert_indices[(ix - 0, iy - 1, iz)],
-                            vert_indices[(ix - 0, iy - 0, iz)],
-                            vert_indices[(ix - 1, iy - 0, iz)],
-                        ).swap(solid2))
-                if x > xmin and z > zmin:
-                    solid1 = f(x, y + 0, z) > 0
-                    solid2 = f(x, y + CELL_SIZE, z) > 0
-                    if solid1 != solid2:
-                        faces.append(Quad(
-                            vert_indices[(ix - 1, iy, iz - 1)],
-                            vert_indices[(ix - 0, iy, iz - 1)],
-                            vert_indices[(ix - 0, iy, iz - 0)],
-                            vert_indices[(ix - 1, iy, iz - 0)],
-                        ).swap(solid1))
-                if y > ymin and z > zmin:
-                    solid1 = f(x + 0, y, z) > 0
-                    solid2 = f(x + CELL_SIZE, y, z) > 0
-                    if solid1 != solid2:
-                        faces.append(Quad(
-                            vert_indices[(ix, iy - 1, iz - 1)],
-                            vert_indices[(ix, iy - 0, iz - 1)],
-                            vert_indices[(ix, iy - 0, iz - 0)],
-                            vert_indices[(ix, iy - 1, iz - 0)],
-                        ).swap(solid2))
-
-    return Mesh(vert_array, faces)
+    quads = dual_contour_3d_faces(values > 0, vert_index)
+
+    return Mesh.from_arrays(positions, quads=quads)
 
 
+@signed_distance
 def circle_function(x, y, z):
-    return 2.5 - math.sqrt(x*x + y*y + z*z)
+    return 2.5 - np.sqrt(x*x + y*y + z*z)
 
 
 def circle_normal(x, y, z):
-    l = math.sqrt(x*x + y*y + z*z)
+    l = np.sqrt(x*x + y*y + z*z)
     return V3(-x / l, -y / l, -z / l)
 
 def intersect_function(x, y, z):
-    y -= 0.3
-    x -= 0.5
+    # Not -=, which would change arrays passed in
+    y = y - 0.3
+    x = x - 0.5
     x = abs(x)
-    return min(x - y, x + y)
+    # np.minimum rather than min, so interval.bounded can bound this where x - y and x + y overlap
+    return np.minimum(x - y, x + y)
+
+def square_function(x, y, z):
+    # np.maximum rather than max, so this also works on arrays and overlapping Intervals (see interval.bounded)
+    return 2.5 - np.maximum(np.maximum(abs(x), abs(y)), abs(z))
+
+def square_normal(x, y, z):
+    # Out of the nearest face, towards the inside like circle_normal
+    if abs(x) >= abs(y) and abs(x) >= abs(z):
+        return V3(-1.0 if x > 0 else 1.0, 0, 0)
+    if abs(y) >= abs(z):
+        return V3(0, -1.0 if y > 0 else 1.0, 0)
+    return V3(0, 0, -1.0 if z > 0 else 1.0)
+
+def t_shape_function(x, y, z):
+    """Like the 2d t_shape_function: 1 at the lattice points (0, 0, 0), (0, 1, 0), (0, -1, 0) and (1, 0, 0),
+    -1 at every other lattice point, and sloping linearly in between"""
+    bumps = [1 - 2 * np.minimum(abs(x - px) + abs(y - py) + abs(z), 1) for px, py in ((0, 0), (0, 1), (0, -1), (1, 0))]
+    return np.maximum(np.maximum(bumps[0], bumps[1]), np.maximum(bumps[2], bumps[3]))
 
 def normal_from_function(f, d=0.01):
     """Given a sufficiently smooth 3d function, f, returns a function approximating of the gradient of f.
-    d controls the scale, smaller values are a more accurate approximation."""
-    def norm(x, y, z):
-        return V3(
-            (f(x + d, y, z) - f(x - d, y, z)) / 2 / d,
-            (f(x, y + d, z) - f(x, y - d, z)) / 2 / d,
-            (f(x, y, z + d) - f(x, y, z - d)) / 2 / d,
-        ).normalize()
+    d controls the scale, smaller values are a more accurate approximation.
+    The result is vectorized if f is, and can be pickled (e.g. to send to another process) if f can."""
+    norm = functools.partial(_finite_difference_normal, f, d)
+    norm.vectorized = is_vectorized(f)
     return norm
 
+
+def _finite_difference_normal(f, d, x, y, z):
+    return V3(
+        (f(x + d, y, z) - f(x - d, y, z)) / 2 / d,
+        (f(x, y + d, z) - f(x, y - d, z)) / 2 / d,
+        (f(x, y, z + d) - f(x, y, z - d)) / 2 / d,
+    ).normalize()
+
 __all__ = ["dual_contour_3d"]
 
 if __name__ == "__main__":
@@ -0,0 +1,379 @@
+"""Provides a function for performing 3D Dual Contouring on an octree, simplifying the mesh where it is flat"""
+
+from common import Grid, evaluate_batch
+from config import resolve
+from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
+import numpy as np
+from utils_3d import Mesh, make_obj, sample_grid
+from qef import make_qef_data_batch, solve_qef_data_batch, sum_qef_data, unpack_qef_data
+from dual_contour_3d import dual_contour_3d_hermite, circle_function, normal_from_function
+
+# Children of an octree node are identified by a tuple (dx, dy, dz) of 0s and 1s,
+# saying which half of the parent they are in along each axis.
+CHILDREN = [(dx, dy, dz) for dx in (0, 1) for dy in (0, 1) for dz in (0, 1)]
+
+
+class Octree:
+    """An octree over the cells of the grid, stored level by level.
+    Level 0 is the individual cells, and each level above has nodes twice the size of the one below.
+    A node is identified by a tuple (level, ix, iy, iz), or None for a node that contains no part of the boundary.
+
+    For each level, we store
+     * has_data: whether the node touches the boundary at all
+     * is_leaf: whether the node should not be subdivided further. At level 0, that's every node with data,
+       above that it's nodes that were simplified into a single vertex.
+     * vertex: the position of the vertex of the node, for leaves."""
+    def __init__(self, shape):
+        self.shape = shape
+        self.has_data = []
+        self.is_leaf = []
+        self.vertex = []
+
+    @property
+    def depth(self):
+        return len(self.has_data)
+
+    @property
+    def root(self):
+        return self.node(self.depth - 1, 0, 0, 0)
+
+    def node(self, level, ix, iy, iz):
+        """Returns the node identifier, or None if there is nothing there"""
+        has_data = self.has_data[level]
+        if ix >= has_data.shape[0] or iy >= has_data.shape[1] or iz >= has_data.shape[2]:
+            return None
+        if not has_data[ix, iy, iz]:
+            return None
+        return level, ix, iy, iz
+
+    def is_leaf_node(self, node):
+        level, ix, iy, iz = node
+        return self.is_leaf[level][ix, iy, iz]
+
+    def child(self, node, child):
+        """Returns the given child of node. Leaves are treated as their own children."""
+        if self.is_leaf_node(node):
+            return node
+        level, ix, iy, iz = node
+        dx, dy, dz = child
+        return self.node(level - 1, 2 * ix + dx, 2 * iy + dy, 2 * iz + dz)
+
+    def size(self, node):
+        """The size of the node, measured in cells"""
+        return 2 ** node[0]
+
+    def origin(self, node):
+        """The index of the lowest lattice point of the node"""
+        level, ix, iy, iz = node
+        return ix << level, iy << level, iz << level
+
+
+def _other_axes(axis):
+    """The two axes perpendicular to axis, in cyclic order"""
+    return (axis + 1) % 3, (axis + 2) % 3
+
+
+# The 4 cells around an edge along some axis are listed by which side of the edge they are on, along the
+# two other axes (in cyclic order). Going round in this order, the quad winds the same way as in dual_contour_3d.
+EDGE_RING = [(0, 0), (1, 0), (1, 1), (0, 1)]
+
+
+def _child_bits(axis_bits):
+    """Converts a dictionary of axis -> bit into a child tuple"""
+    return tuple(axis_bits[axis] for axis in range(3))
+
+
+class _Contourer:
+    """Walks the octree using the standard recursive cell / face / edge procedures of octree dual contouring,
+    outputting a polygon for each minimal sign changing edge."""
+    def __init__(self, octree, solid, vertex_index, mesh):
+        self.octree = octree
+        self.solid = solid
+        self.vertex_index = vertex_index
+        self.mesh = mesh
+
+    def cell_proc(self, node):
+        octree = self.octree
+        if node is None or octree.is_leaf_node(node):
+            return
+        children = {child: octree.child(node, child) for child in CHILDREN}
+        for child in CHILDREN:
+            self.cell_proc(children[child])
+
+        for axis in range(3):
+            u, v = _other_axes(axis)
+            # The 4 faces between the children along this axis
+            for bu in (0, 1):
+                for bv in (0, 1):
+                    self.face_proc(children[_child_bits({axis: 0, u: bu, v: bv})],
+                                   children[_child_bits({axis: 1, u: bu, v: bv})],
+                                   axis)
+            # The 2 edges in the middle of the node along this axis
+            for half in (0, 1):
+                self.edge_proc([children[_child_bits({axis: half, u: su, v: sv})] for su, sv in EDGE_RING], axis)
+
+    def face_proc(self, node0, node1, axis):
+        """Handles the face between node0 and node1, where node1 is after node0 along axis"""
+        octree = self.octree
+        if node0 is None or node1 is None:
+            return
+        if octree.is_leaf_node(node0) and octree.is_leaf_node(node1):
+            return
+
+        u, v = _other_axes(axis)
+        for bu in (0, 1):
+            for bv in (0, 1):
+                self.face_proc(octree.child(node0, _child_bits({axis: 1, u: bu, v: bv})),
+                               octree.child(node1, _child_bits({axis: 0, u: bu, v: bv})),
+                               axis)
+
+        # The 4 edges lying in the face
+        for edge_axis in (u, v):
+            other = v if edge_axis == u else u
+            ring_axes = _other_axes(edge_axis)
+            for half in (0, 1):
+                nodes = []
+                for sides in EDGE_RING:
+                    side = dict(zip(ring_axes, sides))
+                    parent = node0 if side[axis] == 0 else node1
+                    bits = {axis: 1 - side[axis], other: side[other], edge_axis: half}
+                    nodes.append(octree.child(parent, _child_bits(bits)))
+                self.edge_proc(nodes, edge_axis)
+
+    def edge_proc(self, nodes, axis):
+        """Handles the edge along axis shared by the 4 nodes, given in EDGE_RING order"""
+        octree = self.octree
+        if any(node is None for node in nodes):
+            return
+        if all(octree.is_leaf_node(node) for node in nodes):
+            self.process_edge(nodes, axis)
+            return
+        u, v = _other_axes(axis)
+        for half in (0, 1):
+            children = []
+            for node, (su, sv) in zip(nodes, EDGE_RING):
+                children.append(octree.child(node, _child_bits({axis: half, u: 1 - su, v: 1 - sv})))
+            self.edge_proc(children, axis)
+
+    def process_edge(self, nodes, axis):
+        """Outputs a polygon for the 4 leaves around an edge, if the smallest leaf's edge changes sign"""
+        octree = self.octree
+        u, v = _other_axes(axis)
+        smallest = min(range(4), key=lambda i: octree.size(nodes[i]))
+        node = nodes[smallest]
+        su, sv = EDGE_RING[smallest]
+        size = octree.size(node)
+        origin = octree.origin(node)
+        p0 = list(origin)
+        p0[u] += (1 - su) * size
+        p0[v] += (1 - sv) * size
+        p1 = list(p0)
+        p1[axis] += size
+        solid0 = self.solid[tuple(p0)]
+        solid1 = self.solid[tuple(p1)]
+        if solid0 == solid1:
+            return
+
+        # Larger leaves can occupy more than one slot around the edge. If so, we get a triangle.
+        verts = []
+        for level, ix, iy, iz in nodes:
+            vert = self.vertex_index[level][ix, iy, iz]
+            if vert not in verts:
+                verts.append(vert)
+        if solid1:
+            verts.reverse()
+        if len(verts) == 4:
+            self.mesh.add_quad(*verts)
+        elif len(verts) == 3:
+            self.mesh.add_tri(*verts)
+
+
+def _children_array(array, fill):
+    """Given an array for some level of the octree, returns an array for the level above,
+    where each entry is the 8 entries of the children of the corresponding node (in order of CHILDREN)"""
+    pad = [(0, s % 2) for s in array.shape[:3]] + [(0, 0)] * (array.ndim - 3)
+    array = np.pad(array, pad, constant_values=fill)
+    nx, ny, nz = array.shape[0] // 2, array.shape[1] // 2, array.shape[2] // 2
+    array = array.reshape((nx, 2, ny, 2, nz, 2) + array.shape[3:])
+    array = np.moveaxis(array, (1, 3, 5), (3, 4, 5))
+    return array.reshape((nx, ny, nz, 8) + array.shape[6:])
+
+
+def _topology_safe(solid, level):
+    """For each node at level + 1, checks that simplifying it into a single cell wouldn't change the topology
+    of the surface, using the tests of Ju et al., "Dual Contouring of Hermite Data".
+    The sign at the middle of each edge of the node must match one of the ends of the edge,
+    the sign at the middle of each face must match one of the corners of the face,
+    and the sign at the center must match one of the corners of the node."""
+    h = 2 ** level
+    # The signs at the corners of all the children
+    s = solid[::h, ::h, ::h]
+    # Only nodes that are entirely inside the grid are considered
+    n = [max((d - 1) // 2, 0) for d in s.shape]
+    result = np.ones(n, dtype=bool)
+    if 0 in n:
+        return result
+
+    def point(dx, dy, dz):
+        """The sign at lattice offset (dx, dy, dz) from each node, measured in children"""
+        return s[dx:dx + 2 * n[0]:2, dy:dy + 2 * n[1]:2, dz:dz + 2 * n[2]:2]
+
+    def check(mid, ends):
+        # The mid point is bad if all the end points agree, but it doesn't
+        same = np.all([e == ends[0] for e in ends[1:]], axis=0)
+        return ~same | (mid == ends[0])
+
+    for axis in range(3):
+        u, v = _other_axes(axis)
+        for a in (0, 2):
+            for b in (0, 2):
+                # Edges
+                mid = {axis: 1, u: a, v: b}
+                lo = {axis: 0, u: a, v: b}
+                hi = {axis: 2, u: a, v: b}
+                result &= check(point(*_child_bits(mid)), [point(*_child_bits(lo)), point(*_child_bits(hi))])
+        for a in (0, 2):
+            # Faces
+            mid = {axis: a, u: 1, v: 1}
+            corners = [point(*_child_bits({axis: a, u: b, v: c})) for b in (0, 2) for c in (0, 2)]
+            result &= check(point(*_child_bits(mid)), corners)
+    # Center
+    corners = [point(2 * dx, 2 * dy, 2 * dz) for dx, dy, dz in CHILDREN]
+    result &= check(point(1, 1, 1), corners)
+    return result
+
+
+def build_octree(values, xs, ys, zs, cell_qef_index, qef_data, tolerance, lod=None, config=None):
+    """Builds an octree over the grid, bottom up, merging any 8 leaf siblings whose combined QEF
+    can be solved with error less than tolerance.
+    cell_qef_index gives, for each cell, the row of qef_data describing it, or -1 for cells without any crossings.
+    If lod is given, it is a function of position giving a level, and nodes up to that level are merged
+    whatever their error (subject to the same topology checks).
+    config (see config.Config) controls how the QEFs are solved."""
+    config = resolve(config)
+    shape = cell_qef_index.shape
+    solid = values > 0
+    octree = Octree(shape)
+    mins = np.stack(np.meshgrid(np.asarray(xs[:-1], dtype=float), np.asarray(ys[:-1], dtype=float),
+                                np.asarray(zs[:-1], dtype=float), indexing="ij"), axis=-1)
+
+    # Level 0, the individual cells
+    has_data = cell_qef_index >= 0
+    active = np.nonzero(has_data)
+    vertex = np.zeros(shape + (3,))
+    vertex[active] = solve_qef_data_batch(mins[active], qef_data[cell_qef_index[active]], config=config)
+    octree.has_data.append(has_data)
+    octree.is_leaf.append(has_data)
+    octree.vertex.append(vertex)
+
+    # Keep merging until there is a single root node
+    level = 0
+    qef_index = cell_qef_index
+    # A blank record, used for children without any data
+    blank = len(qef_data)
+    qef_data = np.concatenate([qef_data, np.zeros(1, dtype=qef_data.dtype)])
+    while max(octree.has_data[-1].shape) > 1:
+        children_has_data = _children_array(octree.has_data[level], False)
+        children_is_leaf = _children_array(octree.is_leaf[level], False)
+        children_qef = _children_array(qef_index, -1)
+        children_qef[children_qef < 0] = blank
+        has_data = children_has_data.any(axis=-1)
+
+        # A node can be simplified if all its children are leaves (or empty),
+        # it is entirely inside the grid, and the sign changes are simple enough
+        candidate = has_data & np.all(children_is_leaf | ~children_has_data, axis=-1)
+        safe = np.zeros(has_data.shape, dtype=bool)
+        inside = _topology_safe(solid, level)
+        safe[:inside.shape[0], :inside.shape[1], :inside.shape[2]] = inside
+        candidate &= safe
+
+        is_leaf = np.zeros(has_data.shape, dtype=bool)
+        vertex = np.zeros(has_data.shape + (3,))
+        new_qef_index = np.full(has_data.shape, -1, dtype=np.int64)
+        candidates = np.nonzero(candidate)
+        if len(candidates[0]) > 0:
+            merged = sum_qef_data(qef_data[children_qef[candidates]], axis=1)
+            size = 2 ** (level + 1)
+            candidate_mins = mins[tuple(c * size for c in candidates)]
+            # Solved like a single cell the size of the whole node
+            node_sizes = np.multiply(config.sizes(3), size)
+            candidate_vertex = solve_qef_data_batch(candidate_mins, merged,
+                                                    config=config.replace(cell_size=tuple(node_sizes)))
+            ata, atb, btb, _, _ = unpack_qef_data(merged)
+            error = (np.einsum("ni,nij,nj->n", candidate_vertex, ata, candidate_vertex)
+                     - 2 * np.einsum("ni,ni->n", candidate_vertex, atb) + btb)
+            ok = error <= tolerance
+            if lod is not None:
+                centers = candidate_mins + node_sizes / 2
+                ok |= level + 1 <= evaluate_batch(lod, *centers.T, config=config)
+            simplified = tuple(c[ok] for c in candidates)
+            is_leaf[simplified] = True
+            vertex[simplified] = candidate_vertex[ok]
+            # Store the merged QEFs, so the level above can merge them again
+            new_qef_index[simplified] = len(qef_data) + np.arange(ok.sum())
+            qef_data = np.concatenate([qef_data, merged[ok]])
+
+        octree.has_data.append(has_data)
+        octree.is_leaf.append(is_leaf)
+        octree.vertex.append(vertex)
+        qef_index = new_qef_index
+        level += 1
+
+    return octree
+
+
+def dual_contour_3d_octree(f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                           tolerance=1e-4, values=None, sparse=False, lipschitz=None, lod=None, config=None):
+    """Like dual_contour_3d, but builds an octree over the cells, and merges together groups of cells
+    whose vertices are well described by a single vertex, i.e. where the combined QEF has error at most tolerance.
+    Flat regions of the surface end up with far fewer polygons, while sharp features are kept.
+    The output is a Mesh with a mix of quads and triangles. A negative tolerance disables simplification.
+    values, sparse, lipschitz and config are the same as for dual_contour_3d.
+    lod optionally gives a level of detail to simplify to regardless of tolerance, see lod_3d."""
+    config = resolve(config)
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    if values is None:
+        values = sample_grid(f, xs, ys, zs, sparse, lipschitz, config)
+    values = np.asarray(values, dtype=float)
+    assert values.shape == (len(xs), len(ys), len(zs)), "values does not match the grid"
+
+    # The QEF for every cell with crossings
+    hermite = dual_contour_3d_hermite(f_normal, values, xs, ys, zs, config)
+    cell_edges = hermite.cell_edges()
+    crossed = cell_edges >= 0
+    active = np.nonzero(crossed.sum(axis=-1) > 1)
+    rows = cell_edges[active]
+    qef_data = make_qef_data_batch(hermite.positions[rows], hermite.normals[rows], crossed[active])
+    cell_qef_index = np.full(cell_edges.shape[:3], -1, dtype=np.int64)
+    cell_qef_index[active] = np.arange(len(rows))
+
+    octree = build_octree(values, xs, ys, zs, cell_qef_index, qef_data, tolerance, lod, config)
+
+    # Number the vertices of the leaves
+    mesh = Mesh()
+    vertex_index = []
+    for level in range(octree.depth):
+        index = np.full(octree.has_data[level].shape, -1, dtype=np.int64)
+        vertex_index.append(index)
+    def number_leaves(node):
+        if node is None:
+            return
+        level, ix, iy, iz = node
+        if octree.is_leaf_node(node):
+            vertex_index[level][ix, iy, iz] = mesh.add_vertex(*octree.vertex[level][ix, iy, iz].tolist())
+            return
+        for child in CHILDREN:
+            number_leaves(octree.child(node, child))
+    number_leaves(octree.root)
+
+    contourer = _Contourer(octree, values > 0, vertex_index, mesh)
+    contourer.cell_proc(octree.root)
+    return mesh
+
+
+__all__ = ["dual_contour_3d_octree"]
+
+if __name__ == "__main__":
+    mesh = dual_contour_3d_octree(circle_function, normal_from_function(circle_function))
+    with open("output.obj", "w") as f:
+        make_obj(f, mesh)
@@ -0,0 +1,253 @@
+"""Provides classes for keeping a mesh up to date as f is edited, without re-meshing everything.
+
+The meshers keep everything they worked out along the way: the value of f at each lattice point, where the
+boundary crosses each edge (and for Dual Contouring, the normal there and the vertex of each cell). The faces are
+kept in blocks of settings.REMESH_BLOCK_SIZE cells along each side. The optional config (see config.Config) is
+resolved when the mesher is made, and used for all re-meshing after that.
+
+After changing f, call mark_dirty with a box containing every point where f changed. Only the cells touching that
+box are re-evaluated, and only the vertices and faces depending on those values (so including a border of one cell
+around them) are recomputed. The time taken depends on the size of the edit, not the size of the whole grid.
+
+mesh() gives the whole mesh. For large grids, it is cheaper to keep a Mesh per block, replacing just the blocks
+returned by mark_dirty with block_mesh."""
+
+import itertools
+
+import numpy as np
+
+from common import Grid, evaluate_normals_batch
+from config import resolve
+import settings
+from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
+from utils_3d import Mesh, make_obj, sample_grid, find_crossings
+from marching_cubes_3d import cell_triangles, triangle_vertices
+from dual_contour_3d import HermiteData, dual_contour_3d_vertices, dual_contour_3d_faces
+import dual_contour_3d
+
+
+class _IncrementalMesher:
+    """The bookkeeping shared by both meshers. Vertices are identified by an id, unique across the whole grid,
+    and each block stores its faces in terms of those ids."""
+    # Number of vertices per face
+    FACE_SIZE = None
+    # How many cells beyond those whose vertices changed have faces that depend on them
+    FACE_BORDER = 0
+
+    def __init__(self, f, xmin, xmax, ymin, ymax, zmin, zmax, block_size, config):
+        self.f = f
+        self.config = resolve(config)
+        self.lattice = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), self.config).coords
+        self.coords = [np.asarray(c, dtype=float) for c in self.lattice]
+        self.cell_shape = tuple(len(c) - 1 for c in self.coords)
+        self.block_size = block_size or settings.REMESH_BLOCK_SIZE
+        self.values = sample_grid(f, *self.lattice, config=self.config)
+        self.edge_shapes = []
+        for axis in range(3):
+            shape = list(self.values.shape)
+            shape[axis] -= 1
+            self.edge_shapes.append(tuple(shape))
+        self.crossed = [np.zeros(shape, dtype=bool) for shape in self.edge_shapes]
+        self.edge_positions = [np.zeros(shape + (3,)) for shape in self.edge_shapes]
+        self._allocate()
+        self.block_faces = {}
+        if min(self.cell_shape) > 0:
+            self._update([0, 0, 0], list(self.cell_shape))
+
+    def mark_dirty(self, lo, hi):
+        """Tells the mesher that f has changed, but only inside the box from lo to hi (each an (x, y, z) tuple).
+        Re-evaluates f in the cells touching that box, and re-meshes them and their neighbours.
+        Returns a list of the blocks whose faces were recomputed, see block_mesh."""
+        # The cells that overlap the box
+        c_lo = []
+        c_hi = []
+        for axis in range(3):
+            c = self.coords[axis]
+            c_lo.append(int(np.searchsorted(c[1:], lo[axis], "left")))
+            c_hi.append(int(np.searchsorted(c[:-1], hi[axis], "right")))
+        if any(l >= h for l, h in zip(c_lo, c_hi)):
+            return []
+        points = tuple(slice(l, h + 1) for l, h in zip(c_lo, c_hi))
+        self.values[points] = sample_grid(self.f, *[lattice[s] for lattice, s in zip(self.lattice, points)],
+                                          config=self.config)
+        return self._update(c_lo, c_hi)
+
+    def _update(self, c_lo, c_hi):
+        """Recomputes everything depending on the lattice points of cells c_lo to c_hi"""
+        # The cells with a changed corner, and so possibly a changed edge
+        b_lo = [max(l - 1, 0) for l in c_lo]
+        b_hi = [min(h + 1, n) for h, n in zip(c_hi, self.cell_shape)]
+        points = tuple(slice(l, h + 1) for l, h in zip(b_lo, b_hi))
+        crossings = find_crossings(self.values[points], *[lattice[s] for lattice, s in zip(self.lattice, points)],
+                                   config=self.config)
+
+        # Store the crossings of just the edges with a changed end
+        changed = []
+        for axis, (mask, positions) in enumerate(crossings):
+            dense = np.zeros(mask.shape + (3,))
+            dense[mask] = positions
+            local = []
+            edges = []
+            for a in range(3):
+                start, stop = (b_lo[a], b_hi[a]) if a == axis else (c_lo[a], c_hi[a] + 1)
+                local.append(slice(start - b_lo[a], stop - b_lo[a]))
+                edges.append(slice(start, stop))
+            local, edges = tuple(local), tuple(edges)
+            mask = mask[local]
+            positions = dense[local][mask]
+            self.crossed[axis][edges] = mask
+            self.edge_positions[axis][edges][mask] = positions
+            changed.append((edges, mask, positions))
+        self._update_edges(changed)
+        self._update_cells(b_lo, b_hi)
+
+        # Re-make the faces of every block that could have changed
+        f_hi = [min(h + self.FACE_BORDER, n) for h, n in zip(b_hi, self.cell_shape)]
+        ranges = [range(l // self.block_size, (h - 1) // self.block_size + 1) for l, h in zip(b_lo, f_hi)]
+        blocks = list(itertools.product(*ranges))
+        for block in blocks:
+            lo = [b * self.block_size for b in block]
+            hi = [min(l + self.block_size, n) for l, n in zip(lo, self.cell_shape)]
+            self.block_faces[block] = self._block_faces(lo, hi)
+        return blocks
+
+    def _allocate(self):
+        pass
+
+    def _update_edges(self, changed):
+        pass
+
+    def _update_cells(self, lo, hi):
+        pass
+
+    def _make_mesh(self, ids, faces):
+        """Makes a Mesh of the vertices with the given (sorted) ids, and faces made of those ids"""
+        faces = np.searchsorted(ids, faces)
+        if self.FACE_SIZE == 3:
+            return Mesh.from_arrays(self._positions(ids), faces)
+        return Mesh.from_arrays(self._positions(ids), quads=faces)
+
+    def mesh(self):
+        """Returns the current mesh of the whole grid"""
+        faces = [self.block_faces[block] for block in sorted(self.block_faces)]
+        faces = np.concatenate(faces) if faces else np.zeros((0, self.FACE_SIZE), dtype=np.int64)
+        return self._make_mesh(self._vertex_ids(), faces)
+
+    def block_mesh(self, block):
+        """Returns the current mesh of just the faces in one block. It includes copies of any vertices it
+        shares with other blocks, so each block can be handled separately."""
+        faces = self.block_faces[block]
+        return self._make_mesh(np.unique(faces), faces)
+
+
+class IncrementalMarchingCubes3d(_IncrementalMesher):
+    """Meshes f by Marching Cubes, like marching_cubes_3d_vectorized with share_vertices=True,
+    and then re-meshes parts of it when told f has changed. See the module documentation."""
+    FACE_SIZE = 3
+
+    def __init__(self, f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX, block_size=None,
+                 config=None):
+        super().__init__(f, xmin, xmax, ymin, ymax, zmin, zmax, block_size, config)
+
+    def _allocate(self):
+        # Vertices are identified by the edge they lie on. Edges are numbered by axis, then position
+        self.edge_offsets = np.cumsum([0] + [np.prod(shape) for shape in self.edge_shapes])
+
+    def _block_faces(self, lo, hi):
+        points = tuple(slice(l, h + 1) for l, h in zip(lo, hi))
+        cells, tri_edges = cell_triangles(self.values[points])
+        edge_ids = []
+        for axis in range(3):
+            shape = [h - l + 1 for l, h in zip(lo, hi)]
+            shape[axis] -= 1
+            index = np.indices(shape)
+            edge_ids.append(self.edge_offsets[axis] +
+                            np.ravel_multi_index(tuple(i + l for i, l in zip(index, lo)), self.edge_shapes[axis]))
+        return triangle_vertices(edge_ids, cells, tri_edges)
+
+    def _vertex_ids(self):
+        return np.concatenate([offset + np.flatnonzero(crossed)
+                               for offset, crossed in zip(self.edge_offsets, self.crossed)])
+
+    def _positions(self, ids):
+        result = np.empty((len(ids), 3))
+        axis = np.searchsorted(self.edge_offsets[1:], ids, "right")
+        for a in range(3):
+            on_axis = axis == a
+            result[on_axis] = self.edge_positions[a].reshape(-1, 3)[ids[on_axis] - self.edge_offsets[a]]
+        return result
+
+
+class IncrementalDualContour3d(_IncrementalMesher):
+    """Meshes f by Dual Contouring, like dual_contour_3d, and then re-meshes parts of it when told f (and f_normal)
+    have changed. See the module documentation."""
+    FACE_SIZE = 4
+    # The faces around an edge use the vertices of the cells below it
+    FACE_BORDER = 1
+
+    def __init__(self, f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                 block_size=None, config=None):
+        self.f_normal = f_normal
+        super().__init__(f, xmin, xmax, ymin, ymax, zmin, zmax, block_size, config)
+
+    def _allocate(self):
+        # Vertices are identified by the cell they are in
+        self.edge_normals = [np.zeros(shape + (3,)) for shape in self.edge_shapes]
+        self.has_vertex = np.zeros(self.cell_shape, dtype=bool)
+        self.vertex = np.zeros(self.cell_shape + (3,))
+
+    def _update_edges(self, changed):
+        for axis, (edges, mask, positions) in enumerate(changed):
+            self.edge_normals[axis][edges][mask] = evaluate_normals_batch(self.f_normal, *positions.T,
+                                                                          config=self.config)
+
+    def _update_cells(self, lo, hi):
+        # Gather the stored Hermite data of the edges of these cells, and re-solve their vertices
+        points = tuple(slice(l, h + 1) for l, h in zip(lo, hi))
+        edge_index = []
+        positions = []
+        normals = []
+        offset = 0
+        for axis in range(3):
+            edges = list(points)
+            edges[axis] = slice(lo[axis], hi[axis])
+            edges = tuple(edges)
+            crossed = self.crossed[axis][edges]
+            index = np.full(crossed.shape, -1, dtype=np.int64)
+            index[crossed] = np.arange(offset, offset + np.count_nonzero(crossed))
+            offset += np.count_nonzero(crossed)
+            edge_index.append(index)
+            positions.append(self.edge_positions[axis][edges][crossed])
+            normals.append(self.edge_normals[axis][edges][crossed])
+        hermite = HermiteData(edge_index, np.concatenate(positions), np.concatenate(normals))
+        vertices, vert_index = dual_contour_3d_vertices(
+            self.f_normal, self.values[points], *[lattice[s] for lattice, s in zip(self.lattice, points)],
+            hermite=hermite, config=self.config)
+        cells = tuple(slice(l, h) for l, h in zip(lo, hi))
+        self.has_vertex[cells] = vert_index >= 0
+        self.vertex[cells][vert_index >= 0] = vertices
+
+    def _block_faces(self, lo, hi):
+        # Include the cells just below the block, as neighbours
+        first = [1 if l > 0 else 0 for l in lo]
+        start = [l - b for l, b in zip(lo, first)]
+        index = np.indices([h - s for s, h in zip(start, hi)])
+        cell_ids = np.ravel_multi_index(tuple(i + s for i, s in zip(index, start)), self.cell_shape)
+        solid = self.values[tuple(slice(s, h + 1) for s, h in zip(start, hi))] > 0
+        return dual_contour_3d_faces(solid, cell_ids, first_owner=first)
+
+    def _vertex_ids(self):
+        return np.flatnonzero(self.has_vertex)
+
+    def _positions(self, ids):
+        return self.vertex.reshape(-1, 3)[ids]
+
+
+__all__ = ["IncrementalMarchingCubes3d", "IncrementalDualContour3d"]
+
+if __name__ == "__main__":
+    circle_function = dual_contour_3d.circle_function
+    mesher = IncrementalDualContour3d(circle_function, dual_contour_3d.normal_from_function(circle_function))
+    mesher.mark_dirty((0, 0, 0), (1, 1, 1))
+    with open("output.obj", "w") as f:
+        make_obj(f, mesher.mesh())
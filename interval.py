@@ -0,0 +1,224 @@
+"""Provides interval arithmetic, for bounding f over a whole region without evaluating it everywhere.
+
+An Interval is a range of numbers, lo to hi. Arithmetic on Intervals gives an Interval containing every result
+the same arithmetic could give on numbers from those ranges. So calling f on an Interval per axis bounds f over
+a box. Where the bounds don't include zero, the box can't contain any of the boundary, and can be skipped.
+Unlike the lipschitz option of sample_grid, this is safe for any f, not just signed distance functions.
+
+Wrap f with bounded to give it the interval method that the extractors look for. E.g.
+
+    f = bounded(intersect_function)
+    edges = marching_cubes_2d(f, sparse=True)
+    mesh = dual_contour_3d(f, normal_from_function(f), sparse=True)
+
+f can use arithmetic, abs, comparisons, and the builtin min and max, but needs the functions in this module
+(sqrt, exp, minimum, ...) or their numpy equivalents in place of the math module. A comparison is only allowed
+when its answer is the same for every number in the intervals, so the builtin min and max only work on intervals
+that don't overlap, while minimum and maximum always work. That's why the example functions, like
+intersect_function, use np.minimum and np.maximum. Where f does something that can't be bounded,
+the box is assumed to contain boundary, which is always safe, but skips less."""
+
+import math
+
+import numpy as np
+
+from common import is_vectorized
+
+
+class AmbiguousComparison(Exception):
+    """Raised when comparing Intervals that overlap, where the answer depends on which numbers in them are used"""
+
+
+class Interval:
+    """The numbers from lo to hi, inclusive"""
+    def __init__(self, lo, hi):
+        self.lo = lo
+        self.hi = hi
+
+    def __repr__(self):
+        return "Interval({!r}, {!r})".format(self.lo, self.hi)
+
+    def __add__(self, other):
+        other = _interval(other)
+        return Interval(self.lo + other.lo, self.hi + other.hi)
+
+    def __radd__(self, other):
+        return self + other
+
+    def __sub__(self, other):
+        other = _interval(other)
+        return Interval(self.lo - other.hi, self.hi - other.lo)
+
+    def __rsub__(self, other):
+        return _interval(other) - self
+
+    def __mul__(self, other):
+        other = _interval(other)
+        products = (self.lo * other.lo, self.lo * other.hi, self.hi * other.lo, self.hi * other.hi)
+        if any(math.isnan(p) for p in products):
+            # Zero times infinity could be anything
+            return Interval(-math.inf, math.inf)
+        return Interval(min(products), max(products))
+
+    def __rmul__(self, other):
+        return self * other
+
+    def __truediv__(self, other):
+        other = _interval(other)
+        if other.lo <= 0 <= other.hi:
+            return Interval(-math.inf, math.inf)
+        return self * Interval(1 / other.hi, 1 / other.lo)
+
+    def __rtruediv__(self, other):
+        return _interval(other) / self
+
+    def __pow__(self, other):
+        if isinstance(other, Interval):
+            return exp(other * log(self))
+        if float(other).is_integer() and other >= 0:
+            other = int(other)
+            lo, hi = self.lo ** other, self.hi ** other
+            if other % 2 == 1 or self.lo >= 0:
+                return Interval(lo, hi)
+            if self.hi <= 0:
+                return Interval(hi, lo)
+            return Interval(0, max(lo, hi))
+        # Otherwise, only defined for positive numbers, where it is monotonic
+        lo, hi = max(self.lo, 0) ** other, max(self.hi, 0) ** other
+        return Interval(min(lo, hi), max(lo, hi))
+
+    def __rpow__(self, other):
+        return exp(self * math.log(other))
+
+    def __neg__(self):
+        return Interval(-self.hi, -self.lo)
+
+    def __pos__(self):
+        return self
+
+    def __abs__(self):
+        if self.lo >= 0:
+            return self
+        if self.hi <= 0:
+            return -self
+        return Interval(0, max(-self.lo, self.hi))
+
+    def __lt__(self, other):
+        other = _interval(other)
+        return _decide(self.hi < other.lo, self.lo >= other.hi)
+
+    def __le__(self, other):
+        other = _interval(other)
+        return _decide(self.hi <= other.lo, self.lo > other.hi)
+
+    def __gt__(self, other):
+        return _interval(other) < self
+
+    def __ge__(self, other):
+        return _interval(other) <= self
+
+    def __eq__(self, other):
+        other = _interval(other)
+        return _decide(self.lo == self.hi == other.lo == other.hi, self.hi < other.lo or self.lo > other.hi)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __array_ufunc__(self, ufunc, method, *inputs, **kwargs):
+        """Lets numpy functions like numpy.sqrt be applied to Intervals"""
+        if method != "__call__" or kwargs:
+            return NotImplemented
+        if ufunc in _MONOTONIC and len(inputs) == 1:
+            x = inputs[0]
+            return Interval(*_MONOTONIC[ufunc](x.lo, x.hi))
+        if ufunc in _BINARY and len(inputs) == 2:
+            return _BINARY[ufunc](*[_interval(x) for x in inputs])
+        return NotImplemented
+
+
+def _interval(x):
+    return x if isinstance(x, Interval) else Interval(x, x)
+
+
+def _decide(certainly_true, certainly_false):
+    if certainly_true:
+        return True
+    if certainly_false:
+        return False
+    raise AmbiguousComparison()
+
+
+# For each supported single argument ufunc, its bounds, given the bounds of the input
+_MONOTONIC = {
+    np.sqrt: lambda lo, hi: (math.sqrt(max(lo, 0)), math.sqrt(max(hi, 0))),
+    np.exp: lambda lo, hi: (math.exp(lo), math.exp(hi)),
+    np.log: lambda lo, hi: (math.log(lo) if lo > 0 else -math.inf, math.log(hi) if hi > 0 else -math.inf),
+    np.absolute: lambda lo, hi: (abs(Interval(lo, hi)).lo, abs(Interval(lo, hi)).hi),
+    np.negative: lambda lo, hi: (-hi, -lo),
+    np.square: lambda lo, hi: ((Interval(lo, hi) ** 2).lo, (Interval(lo, hi) ** 2).hi),
+}
+
+# Two argument ufuncs, in terms of the operators above
+_BINARY = {
+    np.add: lambda a, b: a + b,
+    np.subtract: lambda a, b: a - b,
+    np.multiply: lambda a, b: a * b,
+    np.true_divide: lambda a, b: a / b,
+    np.minimum: lambda a, b: Interval(min(a.lo, b.lo), min(a.hi, b.hi)),
+    np.maximum: lambda a, b: Interval(max(a.lo, b.lo), max(a.hi, b.hi)),
+    np.hypot: lambda a, b: sqrt(a * a + b * b),
+}
+
+
+def sqrt(x):
+    return np.sqrt(x)
+
+
+def exp(x):
+    return np.exp(x)
+
+
+def log(x):
+    return np.log(x)
+
+
+def minimum(a, b):
+    """Like min, but also works for overlapping intervals"""
+    return np.minimum(a, b)
+
+
+def maximum(a, b):
+    """Like max, but also works for overlapping intervals"""
+    return np.maximum(a, b)
+
+
+class Bounded:
+    """Wraps f, adding an interval method that bounds f over a box using interval arithmetic.
+    Otherwise it behaves exactly like f. See the module documentation."""
+    def __init__(self, f):
+        self.f = f
+        self.vectorized = is_vectorized(f)
+
+    def __call__(self, *p):
+        return self.f(*p)
+
+    def interval(self, lo, hi):
+        """Returns the lowest and highest value f could have anywhere in the box from lo to hi,
+        each a tuple with an entry per axis"""
+        try:
+            result = self.f(*[Interval(float(l), float(h)) for l, h in zip(lo, hi)])
+        except (AmbiguousComparison, TypeError, ArithmeticError):
+            # f does something intervals can't bound, so anything is possible
+            return -math.inf, math.inf
+        result = _interval(result)
+        return result.lo, result.hi
+
+
+def bounded(f):
+    """Returns f with an interval method, so the extractors can skip regions where it can't be zero"""
+    return Bounded(f)
+
+
+__all__ = ["Interval", "AmbiguousComparison", "bounded", "sqrt", "exp", "log", "minimum", "maximum"]
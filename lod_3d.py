@@ -0,0 +1,322 @@
+"""Provides functions for meshing with a level of detail that varies across the domain, e.g. finely near the viewer
+and coarsely far away, without cracks where regions of different detail meet.
+
+The level of detail is given by a function lod(x, y, z), returning the level wanted around that point.
+Level l means cells 2 ** l times the usual cell size, so level 0 is the usual full detail.
+
+For Marching Cubes, the domain is split into blocks of block_size cells along each side, and each block is meshed
+at a single level, the one lod gives at its center. Neighbouring blocks are kept within one level of each other.
+Where a block meets a finer one, its cells along the boundary are handled as transition cells, much like Transvoxel:
+the faces and edges they share with the finer block are split to match it, sampling f at the extra points.
+Rather than another lookup table, the surface in a transition cell is found by cutting each of its (split) faces
+the same way the Marching Cubes table cuts a face, joining the cuts into loops, and triangulating the loops.
+Both sides of every face agree on the cuts, so the mesh is watertight.
+
+For Dual Contouring, the octree of dual_contour_3d_octree is merged up to the level lod gives, and the usual octree
+contouring already joins leaves of different sizes without cracks."""
+
+import itertools
+import math
+
+import numpy as np
+
+from common import Grid, adapt_fraction_array, evaluate_batch
+from config import resolve
+import settings
+from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
+from utils_3d import Mesh, make_obj, sample_grid
+from marching_cubes_3d import cell_triangles, EDGE_AXIS, EDGE_START
+from dual_contour_3d_octree import dual_contour_3d_octree
+import dual_contour_3d
+
+# Vertex keys have room for this many levels
+MAX_LEVELS = 32
+
+
+def _max_level(n):
+    """The largest level whose cells exactly tile a run of n cells"""
+    return (n & -n).bit_length() - 1
+
+
+def _balance(levels):
+    """Lowers levels until no block is more than one level coarser than any of its 26 neighbours"""
+    while True:
+        padded = np.pad(levels, 1, constant_values=MAX_LEVELS)
+        nx, ny, nz = levels.shape
+        limit = np.min([padded[dx:dx + nx, dy:dy + ny, dz:dz + nz]
+                        for dx, dy, dz in itertools.product(range(3), repeat=3)], axis=0) + 1
+        balanced = np.minimum(levels, limit)
+        if np.array_equal(balanced, levels):
+            return levels
+        levels = balanced
+
+
+def block_levels(lod, grid, block_size, config=None):
+    """Works out the level of each block of block_size cells of grid (a common.Grid).
+    config (see config.Config) gives the batch size lod is evaluated in, if it is vectorized.
+    Levels are rounded down, limited to ones whose cells exactly tile the block, and balanced."""
+    counts = [math.ceil(n / block_size) for n in grid.shape]
+    lo = [np.arange(c) * block_size for c in counts]
+    hi = [np.minimum(l + block_size, n) for l, n in zip(lo, grid.shape)]
+    centers = [m + (l + h) / 2 * s for m, s, l, h in zip(grid.origin, grid.spacing, lo, hi)]
+    centers = np.meshgrid(*centers, indexing="ij")
+    wanted = evaluate_batch(lod, *[c.ravel() for c in centers], config=config).reshape(counts)
+    limit = np.full(counts, MAX_LEVELS - 1)
+    for axis in range(3):
+        axis_limit = np.array([_max_level(int(n)) for n in hi[axis] - lo[axis]])
+        limit = np.minimum(limit, np.expand_dims(axis_limit, [a for a in range(3) if a != axis]))
+    levels = np.clip(np.floor(wanted), 0, limit).astype(np.int64)
+    return _balance(levels)
+
+
+def _polygon_cuts(solid):
+    """Cuts a polygon, given the solidity of its corners in anticlockwise order as seen from outside the cell.
+    Like the Marching Cubes table, each run of solid corners is cut off by its own segment.
+    Returns the segments as pairs of indices of polygon edges (edge i runs from corner i to i + 1),
+    from the edge entering the run to the edge leaving it."""
+    k = len(solid)
+    crossed = [i for i in range(k) if solid[i] != solid[(i + 1) % k]]
+    cuts = []
+    for j, i in enumerate(crossed):
+        if not solid[i]:
+            cuts.append((i, crossed[(j + 1) % len(crossed)]))
+    return cuts
+
+
+class _LodGrid:
+    """The blocks of a grid and their levels. Lattice points are identified by their index in the grid of
+    the finest level, and every position is worked out from that index in the same way,
+    so blocks agree exactly on any points they share."""
+    def __init__(self, f, grid, block_size, levels, config):
+        self.f = f
+        self.grid = grid
+        self.config = config
+        self.shape = grid.shape
+        self.block_size = block_size
+        self.levels = levels
+
+    def position(self, axis, index):
+        return self.grid.origin[axis] + np.asarray(index) * self.grid.spacing[axis]
+
+    def edge_level(self, p0, axis):
+        """The finest level of the blocks containing the edge along axis starting at lattice point p0"""
+        b = self.block_size
+        options = []
+        for a in range(3):
+            q = p0[a]
+            if a != axis and q % b == 0 and 0 < q < self.shape[a]:
+                options.append((q // b - 1, q // b))
+            else:
+                options.append((min(q // b, self.levels.shape[a] - 1),))
+        return min(self.levels[block] for block in itertools.product(*options))
+
+    def finer_neighbour(self, block, axis, side):
+        """Whether the block next to this one along axis, on the given side, is at a finer level"""
+        neighbour = list(block)
+        neighbour[axis] += 1 if side else -1
+        if not 0 <= neighbour[axis] < self.levels.shape[axis]:
+            return False
+        return self.levels[tuple(neighbour)] < self.levels[block]
+
+    def cell_faces(self, block, corner, h):
+        """Returns the polygons bounding the cell at lattice point corner with size h, each a list of lattice points
+        in anticlockwise order seen from outside the cell, with edges and faces split to match finer neighbours.
+        Returns None if no splitting is needed, and the cell is a regular Marching Cubes cell."""
+        level = self.levels[block]
+        lo = [c * self.block_size for c in block]
+        hi = [min(l + self.block_size, n) for l, n in zip(lo, self.shape)]
+        faces = []
+        special = False
+        for axis in range(3):
+            u, v = (axis + 1) % 3, (axis + 2) % 3
+            for side in (0, 1):
+                # Anticlockwise seen from outside, i.e. from the side of the face away from the cell
+                square = [(0, 0), (1, 0), (1, 1), (0, 1)]
+                if not side:
+                    square.reverse()
+                on_boundary = corner[axis] + side * h == (hi[axis] if side else lo[axis])
+                if on_boundary and self.finer_neighbour(block, axis, side):
+                    # Split into the 4 faces of the neighbouring cells
+                    special = True
+                    half = h // 2
+                    for su, sv in itertools.product((0, 1), repeat=2):
+                        face = []
+                        for du, dv in square:
+                            point = list(corner)
+                            point[axis] += side * h
+                            point[u] += (su + du) * half
+                            point[v] += (sv + dv) * half
+                            face.append(tuple(point))
+                        faces.append(face)
+                    continue
+                face = []
+                points = []
+                for du, dv in square:
+                    point = list(corner)
+                    point[axis] += side * h
+                    point[u] += du * h
+                    point[v] += dv * h
+                    points.append(tuple(point))
+                for p, q in zip(points, points[1:] + points[:1]):
+                    face.append(p)
+                    edge_axis = u if p[u] != q[u] else v
+                    start = min(p, q)
+                    if self.edge_level(start, edge_axis) < level:
+                        special = True
+                        middle = list(start)
+                        middle[edge_axis] += h // 2
+                        face.append(tuple(middle))
+                faces.append(face)
+        return faces if special else None
+
+    def block_corners(self, block):
+        """Meshes one block. Returns a row per corner of each triangle, describing the edge the corner is on:
+        its start lattice point, axis and level (which also gives its length), and the values of f at its ends."""
+        level = int(self.levels[block])
+        h = 2 ** level
+        b = self.block_size
+        lo = np.array(block) * b
+        hi = np.minimum(lo + b, self.shape)
+        values = sample_grid(self.f, *[self.position(a, np.arange(lo[a], hi[a] + 1, h)).tolist() for a in range(3)],
+                             config=self.config)
+        cell_shape = tuple(s - 1 for s in values.shape)
+
+        # Transition cells can only be next to a finer block
+        transition = {}
+        neighbours = self.levels[tuple(slice(max(c - 1, 0), c + 2) for c in block)]
+        if neighbours.min() < level:
+            for cell in itertools.product(*[range(n) for n in cell_shape]):
+                if all(0 < c < n - 1 for c, n in zip(cell, cell_shape)):
+                    continue
+                corner = tuple(int(l + c * h) for l, c in zip(lo, cell))
+                faces = self.cell_faces(block, corner, h)
+                if faces is not None:
+                    transition[cell] = faces
+
+        # The regular cells
+        cells, tri_edges = cell_triangles(values)
+        cells = np.concatenate(cells, axis=1)
+        if transition:
+            is_transition = np.zeros(cell_shape, dtype=bool)
+            is_transition[tuple(np.array(list(transition)).T)] = True
+            keep = ~is_transition[tuple(cells.T)]
+            cells, tri_edges = cells[keep], tri_edges[keep]
+        axis = EDGE_AXIS[tri_edges].ravel()
+        start = (cells[:, None, :] + EDGE_START[tri_edges]).reshape(-1, 3)
+        end = start + np.eye(3, dtype=np.int64)[axis]
+        rows = [(lo + start * h, axis, np.full(len(axis), level), values[tuple(start.T)], values[tuple(end.T)])]
+        if transition:
+            rows.append(self._transition_corners(values, lo, level, list(transition.values())))
+        return [np.concatenate(parts) for parts in zip(*rows)]
+
+    def _transition_corners(self, values, lo, level, cells):
+        """Like block_corners, for the transition cells, given by their faces"""
+        h = 2 ** level
+        # The points of the split faces that aren't on the block's own lattice need sampling
+        extra = sorted({p for faces in cells for face in faces for p in face
+                        if any((c - l) % h for c, l in zip(p, lo))})
+        if extra:
+            points = np.array(extra)
+            extra = dict(zip(extra, evaluate_batch(self.f, *[self.position(a, points[:, a]) for a in range(3)],
+                                                 config=self.config)))
+        else:
+            extra = {}
+
+        def value(p):
+            if p in extra:
+                return extra[p]
+            return values[tuple((c - l) // h for c, l in zip(p, lo))]
+
+        rows = []
+        for faces in cells:
+            # Cut each face, and link up the cuts into loops. Crossings are identified by their edge.
+            following = {}
+            for face in faces:
+                face_values = [value(p) for p in face]
+                solid = [v > 0 for v in face_values]
+                for enter, leave in _polygon_cuts(solid):
+                    crossing = []
+                    for i in (enter, leave):
+                        j = (i + 1) % len(face)
+                        p, q = (face[i], face[j]) if face[i] < face[j] else (face[j], face[i])
+                        v0, v1 = (face_values[i], face_values[j]) if face[i] < face[j] else (face_values[j], face_values[i])
+                        edge_axis = next(a for a in range(3) if p[a] != q[a])
+                        edge_level = level if q[edge_axis] - p[edge_axis] == h else level - 1
+                        crossing.append((p, edge_axis, edge_level, v0, v1))
+                    following[crossing[0]] = crossing[1]
+            while following:
+                loop = [next(iter(following))]
+                while True:
+                    crossing = following.pop(loop[-1])
+                    if crossing == loop[0]:
+                        break
+                    loop.append(crossing)
+                for i in range(1, len(loop) - 1):
+                    rows.extend((loop[0], loop[i], loop[i + 1]))
+        if not rows:
+            return np.zeros((0, 3), dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), \
+                np.zeros(0), np.zeros(0)
+        p, axis, edge_level, v0, v1 = zip(*rows)
+        return np.array(p, dtype=np.int64), np.array(axis), np.array(edge_level), np.array(v0), np.array(v1)
+
+    def crossing_positions(self, start, axis, level, v0, v1):
+        """Works out where the boundary crosses each edge, interpolating like the other extractors"""
+        positions = np.stack([self.position(a, start[:, a]) for a in range(3)], axis=1)
+        t = adapt_fraction_array(v0, v1, self.config)
+        rows = np.arange(len(axis))
+        positions[rows, axis] += t * (2.0 ** level * self.grid.spacing[axis])
+        return positions
+
+
+def marching_cubes_3d_lod(f, lod, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                          block_size=None, config=None):
+    """Runs Marching Cubes over the specified range, with the level of detail in each block of block_size cells
+    (settings.LOD_BLOCK_SIZE by default) given by lod, see the module documentation.
+    Vertices are shared between triangles, and where lod is 0 everywhere, the result is the same as
+    marching_cubes_3d_vectorized with share_vertices=True, up to the order of vertices and faces.
+    config defaults to the current settings, see config.Config."""
+    config = resolve(config)
+    block_size = block_size or settings.LOD_BLOCK_SIZE
+    lattice = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config)
+    shape = lattice.shape
+    if min(shape) <= 0:
+        return Mesh()
+    grid = _LodGrid(f, lattice, block_size, block_levels(lod, lattice, block_size, config), config)
+    corners = [grid.block_corners(block) for block in np.ndindex(grid.levels.shape)]
+    start, axis, level, v0, v1 = [np.concatenate(parts) for parts in zip(*corners)]
+
+    # Blocks sharing an edge describe it identically, so there is one vertex per key
+    point = np.ravel_multi_index(tuple(start.T), tuple(n + 1 for n in shape))
+    keys = (point * 3 + axis) * MAX_LEVELS + level
+    keys, first, tris = np.unique(keys, return_index=True, return_inverse=True)
+    positions = grid.crossing_positions(start[first], axis[first], level[first], v0[first], v1[first])
+    return Mesh.from_arrays(positions, tris.reshape(-1, 3))
+
+
+def dual_contour_3d_lod(f, f_normal, lod, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                        tolerance=-1, config=None):
+    """Runs Dual Contouring over the specified range, with octree nodes merged into a single vertex up to the level
+    given by lod, as well as wherever the error is at most tolerance (by default, only by lod).
+    See dual_contour_3d_octree."""
+    return dual_contour_3d_octree(f, f_normal, xmin, xmax, ymin, ymax, zmin, zmax, tolerance=tolerance, lod=lod,
+                                  config=config)
+
+
+def distance_lod(center, distance, max_level=MAX_LEVELS - 1):
+    """Returns a lod function that is level 0 within distance of center, and coarsens by a level each time
+    the distance doubles, up to max_level"""
+    cx, cy, cz = center
+
+    def lod(x, y, z):
+        d = math.sqrt((x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2)
+        return min(max(math.floor(math.log2(max(d, distance) / distance)), 0), max_level)
+    return lod
+
+
+__all__ = ["marching_cubes_3d_lod", "dual_contour_3d_lod", "block_levels", "distance_lod"]
+
+if __name__ == "__main__":
+    circle_function = dual_contour_3d.circle_function
+    mesh = marching_cubes_3d_lod(circle_function, distance_lod((3, 0, 0), 2), block_size=2)
+    with open("output.obj", "w") as f:
+        make_obj(f, mesh)
@@ -1,20 +1,30 @@
 """Provides a function for performing 2D Marching Cubes"""
 
-import math
+import numpy as np
 
-from common import Edge, adapt, frange
-from settings import XMIN, XMAX, YMIN, YMAX, CELL_SIZE
-from utils_2d import V2, make_svg
+from common import Edge, Grid, adapt
+from config import resolve
+from settings import XMIN, XMAX, YMIN, YMAX
+from utils_2d import V2, make_svg, presample, find_active_cells
 
 
-def marching_cubes_2d_single_cell(f, x, y):
-    """Returns a list of edges that approximate f's boundary for a single cell"""
+def marching_cubes_2d_single_cell(f, x, y, config=None):
+    """Returns a list of edges that approximate f's boundary for a single cell.
+    config (see config.Config) gives the size of the cell, and how to interpolate along its edges."""
+    config = resolve(config)
+    size_x, size_y = config.sizes(2)
+
+    def adapt_x(v0, v1):
+        return adapt(v0, v1, config, 0)
+
+    def adapt_y(v0, v1):
+        return adapt(v0, v1, config, 1)
 
     # Evaluate
-    x0y0 = f(x            , y )
-    x0y1 = f(x            , y + CELL_SIZE)
-    x1y0 = f(x + CELL_SIZE, y)
-    x1y1 = f(x + CELL_SIZE, y + CELL_SIZE)
+    x0y0 = f(x         , y )
+    x0y1 = f(x         , y + size_y)
+    x1y0 = f(x + size_x, y)
+    x1y1 = f(x + size_x, y + size_y)
 
     # There are 16 different cases that these points can be inside or outside.
     # We use binary counting to map the 4 truth values to a number between 0 and 15 inclusive.
@@ -35,56 +45,70 @@ def marching_cubes_2d_single_cell(f, x, y):
         return []
     if case == 1 or case == 14:
         # Single corner
-        return [Edge(V2(x + 0 + adapt(x0y0, x1y0), y), V2(x + 0, y + adapt(x0y0, x0y1))).swap(case == 14)]
+        return [Edge(V2(x + 0 + adapt_x(x0y0, x1y0), y), V2(x + 0, y + adapt_y(x0y0, x0y1))).swap(case == 14)]
     if case == 2 or case == 13:
         # Single corner
-        return [Edge(V2(x + 0, y + adapt(x0y0, x0y1)), V2(x + adapt(x0y1, x1y1), y + CELL_SIZE)).swap(case == 13)]
+        return [Edge(V2(x + 0, y + adapt_y(x0y0, x0y1)), V2(x + adapt_x(x0y1, x1y1), y + size_y)).swap(case == 13)]
     if case == 4 or case == 11:
         # Single corner
-        return [Edge(V2(x + CELL_SIZE, y + adapt(x1y0, x1y1)), V2(x + adapt(x0y0, x1y0), y + 0)).swap(case == 11)]
+        return [Edge(V2(x + size_x, y + adapt_y(x1y0, x1y1)), V2(x + adapt_x(x0y0, x1y0), y + 0)).swap(case == 11)]
     if case == 8 or case == 7:
         # Single corner
-        return [Edge(V2(x + adapt(x0y1, x1y1), y + CELL_SIZE), V2(x + CELL_SIZE, y + adapt(x1y0, x1y1))).swap(case == 7)]
+        return [Edge(V2(x + adapt_x(x0y1, x1y1), y + size_y), V2(x + size_x, y + adapt_y(x1y0, x1y1))).swap(case == 7)]
     if case == 3 or case == 12:
         # Vertical split
-        return [Edge(V2(x + adapt(x0y0, x1y0), y + 0), V2(x + adapt(x0y1, x1y1), y + CELL_SIZE)).swap(case == 12)]
+        return [Edge(V2(x + adapt_x(x0y0, x1y0), y + 0), V2(x + adapt_x(x0y1, x1y1), y + size_y)).swap(case == 12)]
     if case == 5 or case == 10:
         # Horizontal split
-        return [Edge(V2(x + 0, y + adapt(x0y0, x0y1)), V2(x + CELL_SIZE, y + adapt(x1y0, x1y1))).swap(case == 5)]
+        return [Edge(V2(x + 0, y + adapt_y(x0y0, x0y1)), V2(x + size_x, y + adapt_y(x1y0, x1y1))).swap(case == 5)]
     if case == 9:
         # Two opposite corners, copy cases 1 and 8
-        return [Edge(V2(x + 0 + adapt(x0y0, x1y0), y), V2(x + 0, y + adapt(x0y0, x0y1))),
-                Edge(V2(x + adapt(x0y1, x1y1), y + 1), V2(x + CELL_SIZE, y + adapt(x1y0, x1y1)))]
+        return [Edge(V2(x + 0 + adapt_x(x0y0, x1y0), y), V2(x + 0, y + adapt_y(x0y0, x0y1))),
+                Edge(V2(x + adapt_x(x0y1, x1y1), y + size_y), V2(x + size_x, y + adapt_y(x1y0, x1y1)))]
     if case == 6:
         # Two opposite corners, copy cases 2 and 4
-        return [Edge(V2(x + CELL_SIZE, y+adapt(x1y0, x1y1)), V2(x+adapt(x0y0, x1y0), y + 0)),
-                Edge(V2(x + 0, y+adapt(x0y0, x0y1)), V2(x + adapt(x0y1, x1y1), y + CELL_SIZE))]
+        return [Edge(V2(x + size_x, y+adapt_y(x1y0, x1y1)), V2(x+adapt_x(x0y0, x1y0), y + 0)),
+                Edge(V2(x + 0, y+adapt_y(x0y0, x0y1)), V2(x + adapt_x(x0y1, x1y1), y + size_y))]
 
     assert False, "All cases exhausted"
 
 
-def marching_cubes_2d(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX):
-    # For each cube, evaluate independently.
-    # If this wasn't demonstration code, you might actually evaluate them together for efficiency
+def marching_cubes_2d(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, config=None, sparse=False):
+    """Iterates over the cells between the specified range, and evaluates f to produce a boundary by Marching Cubes.
+    Returns an unordered list of Edge objects. config defaults to the current settings, see config.Config.
+    If sparse is set and f has an interval method (see interval.bounded), only the cells
+    that might contain the boundary are visited, see find_active_cells."""
+    config = resolve(config)
+    grid = Grid.from_bounds((xmin, ymin), (xmax, ymax), config)
+    if sparse:
+        active = find_active_cells(f, grid)
+    else:
+        # For each cube, evaluate independently.
+        # If this wasn't demonstration code, you might actually evaluate them together for efficiency
+        # (which is what presample does, for vectorized f and volumes)
+        f = presample(f, grid, config)
     edges = []
-    for x in frange(xmin, xmax, CELL_SIZE):
-        for y in frange(ymin, ymax, CELL_SIZE):
-            edges.extend(marching_cubes_2d_single_cell(f, x, y))
+    for index, (x, y) in grid.cell_positions():
+        if not sparse or active[index]:
+            edges.extend(marching_cubes_2d_single_cell(f, x, y, config))
     return edges
 
 
 def circle_function(x, y):
-    return 2.5 - math.sqrt(x*x + y*y)
+    return 2.5 - np.sqrt(x*x + y*y)
 
 
 def square_function(x, y):
-    return 2.5 - max(abs(x), abs(y))
+    # np.maximum rather than max, so this also works on arrays and overlapping Intervals (see interval.bounded)
+    return 2.5 - np.maximum(abs(x), abs(y))
 
 
 def t_shape_function(x, y):
-    if (x, y) in ((0, 0), (0, 1), (0, -1), (1, 0)):
-        return 1
-    return -1
+    """1 at the lattice points (0, 0), (0, 1), (0, -1) and (1, 0), and -1 at every other lattice point.
+    Between lattice points, it slopes linearly, and is written with np.minimum and np.maximum (rather than
+    comparisons, which overlapping Intervals can't answer), so interval.bounded can skip regions away from the T."""
+    bumps = [1 - 2 * np.minimum(abs(x - px) + abs(y - py), 1) for px, py in ((0, 0), (0, 1), (0, -1), (1, 0))]
+    return np.maximum(np.maximum(bumps[0], bumps[1]), np.maximum(bumps[2], bumps[3]))
 
 __all__ = ["marching_cubes_2d"]
 
@@ -1,9 +1,11 @@
 """Provides a function for performing 3D Marching Cubes"""
 
-from common import adapt, frange
-from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX, CELL_SIZE
-import math
-from utils_3d import V3, Tri, Mesh, make_obj
+from common import Grid, adapt, adapt_fraction_array, is_vectorized, signed_distance
+from config import current, resolve
+import settings
+from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
+import numpy as np
+from utils_3d import V3, Mesh, make_obj, sample_grid, find_crossings, find_active_blocks
 
 # My convention for vertices is:
 VERTICES = [
@@ -297,15 +299,32 @@ cases = [[],
  [[3, 0, 8]],
  []]
 
+# The same table, as arrays, for the vectorized implementation.
+# CASE_TRIS[case, i] is the i-th triangle of that case, with unused rows padded with -1.
+# CASE_COUNTS[case] is how many triangles are actually used.
+CASE_COUNTS = np.array([len(c) for c in cases], dtype=np.int64)
+CASE_TRIS = np.full((256, CASE_COUNTS.max(), 3), -1, dtype=np.int64)
+for case, tris in enumerate(cases):
+    if tris:
+        CASE_TRIS[case, :len(tris)] = tris
 
-def marching_cubes_3d_single_cell(f, x, y, z):
+VERTICES_ARRAY = np.array(VERTICES, dtype=np.int64)
+EDGES_ARRAY = np.array(EDGES, dtype=np.int64)
+# For each edge, which axis it runs along, and the offset of its lowest vertex in the cell
+EDGE_AXIS = np.argmax(VERTICES_ARRAY[EDGES_ARRAY[:, 0]] != VERTICES_ARRAY[EDGES_ARRAY[:, 1]], axis=1)
+EDGE_START = np.minimum(VERTICES_ARRAY[EDGES_ARRAY[:, 0]], VERTICES_ARRAY[EDGES_ARRAY[:, 1]])
+
+
+def marching_cubes_3d_single_cell(f, x, y, z, config=None):
+    config = resolve(config)
+    sizes = config.sizes(3)
     # Evaluate f on each vertex of the cube
     f_eval = [None] * 8
     for v in range(8):
         v_pos = VERTICES[v]
-        f_eval[v] = f(x + v_pos[0] * CELL_SIZE,
-                      y + v_pos[1] * CELL_SIZE,
-                      z + v_pos[2] * CELL_SIZE)
+        f_eval[v] = f(x + v_pos[0] * sizes[0],
+                      y + v_pos[1] * sizes[1],
+                      z + v_pos[2] * sizes[2])
     # Determine which case we are
     case = sum(2**v for v in range(8) if f_eval[v] > 0)
     # Ok, what faces do we need (in terms of edges)
@@ -316,18 +335,19 @@ def marching_cubes_3d_single_cell(f, x, y, z):
         # Find the two vertices specified by this edge, and interpolate between
         # them according to adapt, as in the 2d case
         v0, v1 = EDGES[edge]
+        axis = EDGE_AXIS[edge]
         f0 = f_eval[v0]
         f1 = f_eval[v1]
-        t0 = CELL_SIZE - adapt(f0, f1)
-        t1 = CELL_SIZE - t0
+        t0 = sizes[axis] - adapt(f0, f1, config, axis)
+        t1 = sizes[axis] - t0
         vert_pos0 = VERTICES[v0]
         vert_pos1 = VERTICES[v1]
-        return V3(x + vert_pos0[0] * t0 + vert_pos1[0] * t1,
-                  y + vert_pos0[1] * t0 + vert_pos1[1] * t1,
-                  z + vert_pos0[2] * t0 + vert_pos1[2] * t1)
+        # Along the other axes, the edge is at one side of the cell or the other
+        position = [c + p * size for c, p, size in zip((x, y, z), vert_pos0, sizes)]
+        position[axis] = (x, y, z)[axis] + vert_pos0[axis] * t0 + vert_pos1[axis] * t1
+        return V3(*position)
 
-    output_verts = []
-    output_tris = []
+    output = Mesh()
 
     for face in faces:
         # For each face, find the vertices of that face, and output it.
@@ -335,33 +355,179 @@ def marching_cubes_3d_single_cell(f, x, y, z):
         # A fancier implementation might do so.
         edges = face
         verts = list(map(edge_to_boundary_vertex, edges))
-        next_vert_index = len(output_verts) + 1
-        tri = Tri(
-            next_vert_index,
-            next_vert_index+1,
-            next_vert_index+2,
-        )
-        output_verts.extend(verts)
-        output_tris.append(tri)
-    return Mesh(output_verts, output_tris)
-
-
-def marching_cubes_3d(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX):
-    """Iterates over a cells of size one between the specified range, and evaluates f to produce
-        a boundary by Marching Cubes. Returns a Mesh object."""
+        output.add_tri(*[output.add_vertex(v.x, v.y, v.z) for v in verts])
+    return output
+
+
+def marching_cubes_3d(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                      sparse=False, lipschitz=None, config=None):
+    """Iterates over the cells of size config.cell_size between the specified range (see common.Grid),
+        and evaluates f to produce a boundary by Marching Cubes. Returns a Mesh object.
+        If sparse is set, only cells in blocks that might contain the boundary are visited, see find_active_blocks.
+        config defaults to the current settings, see config.Config."""
+    config = resolve(config)
+    grid = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config)
     # For each cube, evaluate independently.
     # If this wasn't demonstration code, you might actually evaluate them together for efficiency
     mesh = Mesh()
-    for x in frange(xmin, xmax, CELL_SIZE):
-        for y in frange(ymin, ymax, CELL_SIZE):
-            for z in frange(zmin, zmax, CELL_SIZE):
-                cell_mesh = marching_cubes_3d_single_cell(f, x, y, z)
-                mesh.extend(cell_mesh)
+    if (hasattr(f, "sample") or is_vectorized(f)) and not sparse:
+        # Already gridded fields (see volume.Volume) are read a slab at a time, rather than a point at a time,
+        # and vectorized ones are evaluated a slab at a time. This gives the same triangles in the same order.
+        for batch in marching_cubes_3d_stream(f, xmin, xmax, ymin, ymax, zmin, zmax, config=config):
+            mesh.extend(batch)
+        return mesh
+    visit = None
+    if sparse:
+        xs, ys, zs = [c.tolist() for c in grid.coords]
+        active, _ = find_active_blocks(f, xs, ys, zs, lipschitz=lipschitz)
+        # Cells are still visited in the usual order, so the output is the same as without sparse
+        visit = np.zeros(grid.shape, dtype=bool)
+        for ix0, ix1, iy0, iy1, iz0, iz1 in active:
+            visit[ix0:ix1, iy0:iy1, iz0:iz1] = True
+    for index, (x, y, z) in grid.cell_positions():
+        if visit is not None and not visit[index]:
+            continue
+        cell_mesh = marching_cubes_3d_single_cell(f, x, y, z, config)
+        mesh.extend(cell_mesh)
     return mesh
 
 
+def cell_triangles(values):
+    """Works out the triangles Marching Cubes outputs for every cell of a lattice of values at once.
+    Cells are visited in the same order as the loops in marching_cubes_3d, and each cell's triangles come out
+    in table order.
+    Returns the index of the cell of each triangle, as three arrays with shape (T, 1),
+    and a (T, 3) array of the edges (see EDGES) of the cell that each corner of the triangle lies on."""
+    solid = values > 0
+    nx, ny, nz = values.shape[0] - 1, values.shape[1] - 1, values.shape[2] - 1
+
+    # Work out the case of every cell at once, using the same bit assignments as the single cell version
+    case = np.zeros((nx, ny, nz), dtype=np.uint8)
+    for v, (dx, dy, dz) in enumerate(VERTICES):
+        case |= solid[dx:dx + nx, dy:dy + ny, dz:dz + nz].astype(np.uint8) << v
+    case = case.ravel()
+
+    # Expand each cell into its triangles.
+    counts = CASE_COUNTS[case]
+    cell = np.repeat(np.arange(len(case)), counts)
+    first_tri = np.cumsum(counts) - counts
+    tri_in_cell = np.arange(len(cell)) - first_tri[cell]
+    tri_edges = CASE_TRIS[case[cell], tri_in_cell]
+
+    ix, iy, iz = np.unravel_index(cell, (nx, ny, nz))
+    return (ix[:, None], iy[:, None], iz[:, None]), tri_edges
+
+
+def number_crossings(crossings, offset=0):
+    """Given the result of find_crossings, gives each crossed edge a vertex index, counting up from offset.
+    Vertices are ordered by axis, then by position of the edge.
+    Returns a list with an array per axis, giving the index of the vertex of each edge, or -1 if it isn't crossed."""
+    edge_vertex = []
+    for mask, positions in crossings:
+        index = np.full(mask.shape, -1, dtype=np.int64)
+        index[mask] = np.arange(offset, offset + len(positions))
+        edge_vertex.append(index)
+        offset += len(positions)
+    return edge_vertex
+
+
+def triangle_vertices(edge_vertex, cells, tri_edges):
+    """Looks up the vertex for each corner of each triangle from cell_triangles, by finding which lattice edge
+    it lies on. edge_vertex gives the vertex index of every edge, as returned by number_crossings."""
+    ix, iy, iz = cells
+    axis = EDGE_AXIS[tri_edges]
+    start = EDGE_START[tri_edges]
+    tri_verts = np.empty(tri_edges.shape, dtype=np.int64)
+    for a in range(3):
+        on_axis = axis == a
+        tri_verts[on_axis] = edge_vertex[a][
+            (ix + start[..., 0])[on_axis],
+            (iy + start[..., 1])[on_axis],
+            (iz + start[..., 2])[on_axis],
+        ]
+    return tri_verts
+
+
+def marching_cubes_3d_grid(values, xs, ys, zs, share_vertices=False, config=None):
+    """Runs Marching Cubes over a lattice of pre-computed values of f, handling every cell at once with numpy.
+    values[ix, iy, iz] should be f(xs[ix], ys[iy], zs[iz]).
+    Produces the same triangles, in the same order, as calling marching_cubes_3d_single_cell on each cell.
+    If share_vertices is set, then each edge of the lattice gets a single vertex, re-used by every triangle
+    touching it, giving a connected mesh with far fewer vertices.
+    config should match the one the lattice was made with, see config.Config."""
+    config = resolve(config)
+    values = np.asarray(values, dtype=float)
+    if min(values.shape) <= 1:
+        return Mesh()
+    (ix, iy, iz), tri_edges = cell_triangles(values)
+
+    if share_vertices:
+        crossings = find_crossings(values, xs, ys, zs, config)
+        tri_verts = triangle_vertices(number_crossings(crossings), (ix, iy, iz), tri_edges)
+        positions = np.concatenate([p for _, p in crossings])
+        return Mesh.from_arrays(positions, tri_verts)
+
+    # Now find the boundary vertex for every corner of every triangle,
+    # mirroring edge_to_boundary_vertex
+    vert_pos0 = VERTICES_ARRAY[EDGES_ARRAY[tri_edges, 0]]
+    vert_pos1 = VERTICES_ARRAY[EDGES_ARRAY[tri_edges, 1]]
+    f0 = values[ix + vert_pos0[..., 0], iy + vert_pos0[..., 1], iz + vert_pos0[..., 2]]
+    f1 = values[ix + vert_pos1[..., 0], iy + vert_pos1[..., 1], iz + vert_pos1[..., 2]]
+    axis = EDGE_AXIS[tri_edges]
+    sizes = np.array(config.sizes(3))
+    size = sizes[axis]
+    t0 = size - adapt_fraction_array(f0, f1, config) * size
+    t1 = size - t0
+    corner = np.stack([
+        np.asarray(xs, dtype=float)[ix],
+        np.asarray(ys, dtype=float)[iy],
+        np.asarray(zs, dtype=float)[iz],
+    ], axis=-1)
+    along = np.arange(3) == axis[..., None]
+    positions = np.where(along, corner + vert_pos0 * t0[..., None] + vert_pos1 * t1[..., None],
+                         corner + vert_pos0 * sizes)
+
+    # Like the single cell version, each triangle gets its own vertices
+    positions = positions.reshape(-1, 3)
+    return Mesh.from_arrays(positions, np.arange(len(positions)).reshape(-1, 3))
+
+
+def marching_cubes_3d_vectorized(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                                 share_vertices=False, sparse=False, lipschitz=None, config=None):
+    """Same as marching_cubes_3d, but evaluates f exactly once per grid point up front,
+    then processes all the cells together using numpy.
+    See marching_cubes_3d_grid for share_vertices, and sample_grid for sparse and lipschitz."""
+    config = resolve(config)
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    values = sample_grid(f, xs, ys, zs, sparse, lipschitz, config)
+    return marching_cubes_3d_grid(values, xs, ys, zs, share_vertices, config)
+
+
+def marching_cubes_3d_stream(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                             batch_size=None, config=None):
+    """Same as marching_cubes_3d, but rather than returning a single Mesh, yields a Mesh for each slab of
+    batch_size (settings.CHUNK_SIZE by default) cells along x as soon as it is done, so only one slab is ever in memory.
+    Each batch has its own vertices, numbered from 0. Pass them to ObjWriter or PlyWriter, which keep track of
+    the offset. Together, the batches have exactly the same triangles as marching_cubes_3d, in the same order."""
+    config = resolve(config)
+    batch_size = batch_size or settings.CHUNK_SIZE
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    # The lattice points on the boundary between slabs are kept from one slab to the next,
+    # so f is still only evaluated once per point
+    previous = None
+    for i0 in range(0, len(xs) - 1, batch_size):
+        i1 = min(i0 + batch_size, len(xs) - 1)
+        if previous is None:
+            values = sample_grid(f, xs[i0:i1 + 1], ys, zs, config=config)
+        else:
+            values = np.concatenate([previous, sample_grid(f, xs[i0 + 1:i1 + 1], ys, zs, config=config)])
+        previous = values[-1:]
+        yield marching_cubes_3d_grid(values, xs[i0:i1 + 1], ys, zs, config=config)
+
+
+@signed_distance
 def circle_function(x, y, z):
-    return 2.5 - math.sqrt(x*x + y*y + z*z)
+    return 2.5 - np.sqrt(x*x + y*y + z*z)
 
 
 def make_circle_obj(filename):
@@ -374,7 +540,7 @@ def make_circle_obj(filename):
 def make_cases_obj():
     """Writes obj files demonstrating the main cases of marching cubes"""
     import marching_cubes_gen as gen
-    assert CELL_SIZE == 1
+    cell_config = current(cell_size=1)
     mesh = Mesh()
     highlights = Mesh()
     offset = V3(0, 0, 0)
@@ -385,7 +551,7 @@ def make_cases_obj():
         def f(x, y, z):
             vert = gen.VERTICES.index((x, y, z))
             return 1 if vert in verts else -1
-        case_mesh = marching_cubes_3d_single_cell(f, 0, 0, 0, cell_size=1)
+        case_mesh = marching_cubes_3d_single_cell(f, 0, 0, 0, cell_config)
         case_mesh = case_mesh.translate(offset)
         mesh.extend(case_mesh)
 
@@ -404,7 +570,7 @@ def make_cases_obj():
     with open("case_highlights.obj", "w") as f:
         make_obj(f, highlights)
 
-__all__ = ["marching_cubes_3d"]
+__all__ = ["marching_cubes_3d", "marching_cubes_3d_vectorized", "marching_cubes_3d_grid", "marching_cubes_3d_stream"]
 
 if __name__ == "__main__":
     make_circle_obj("output.obj")
@@ -0,0 +1,174 @@
+"""Provides functions for meshing with several processes at once.
+
+The domain is split along the z axis into slabs, and each slab is sampled and meshed in a separate worker process,
+using a concurrent.futures.ProcessPoolExecutor. Evaluating f dominates the run time for anything but the simplest
+functions, so this scales with the number of workers.
+
+Rather than numbering their vertices themselves, the workers label each vertex by what it belongs to in the whole
+grid: the lattice edge it lies on for Marching Cubes, or the cell it is in for Dual Contouring. Slabs that share a
+boundary plane produce identical vertices for it, with identical labels, so the results can be merged into a single
+mesh without cracks or duplicated vertices.
+
+f and f_normal are sent to the workers, so must be pickleable: a function defined at the top level of a module,
+or the result of normal_from_function applied to one, will do, but not a lambda or nested function.
+Alternatively, they can be given by name, as a string "module:function".
+The config (see config.Config) is resolved before the work is handed out, and sent along with it, but other
+settings are re-imported by each worker, so changes made to them at runtime only reach it on platforms that fork."""
+
+import importlib
+import math
+import os
+import pickle
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from common import Grid
+from config import resolve
+import settings
+from settings import XMIN, XMAX, YMIN, YMAX, ZMIN, ZMAX
+from utils_3d import Mesh, make_obj, sample_grid, find_crossings
+from marching_cubes_3d import cell_triangles, triangle_vertices
+from dual_contour_3d import dual_contour_3d_vertices, dual_contour_3d_faces
+import dual_contour_3d
+
+
+def resolve_function(f):
+    """Returns f, or if f is a string "module:function", imports that module and returns the function"""
+    if not isinstance(f, str):
+        return f
+    module_name, _, name = f.partition(":")
+    return getattr(importlib.import_module(module_name), name)
+
+
+def _check_pickleable(f, name):
+    """Fails early with a clearer message than the executor gives"""
+    try:
+        pickle.dumps(f)
+    except (pickle.PicklingError, AttributeError, TypeError) as e:
+        raise TypeError("{} must be pickleable to send it to the worker processes. "
+                        "Use a function defined at the top level of a module, "
+                        "or give it by name as \"module:function\"".format(name)) from e
+
+
+def _slabs(nz, workers, chunk_size):
+    """Splits the nz cells along z into slabs, returning the range of lattice points of each.
+    By default there are a few slabs per worker, so that a slab with more boundary in it than the others
+    doesn't hold everything up."""
+    if chunk_size is None:
+        chunk_size = max(1, math.ceil(nz / (4 * workers)))
+    return [(k0, min(k0 + chunk_size, nz)) for k0 in range(0, nz, chunk_size)]
+
+
+def _map(fn, tasks, workers):
+    """Runs fn on each task, returning the results in order"""
+    if workers == 1:
+        return [fn(*task) for task in tasks]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(fn, *task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def _marching_cubes_slab(f, xs, ys, zs, k0, k1, sparse, lipschitz, config):
+    """Runs in a worker. Meshes the cells between lattice planes k0 and k1.
+    Returns the id of each crossed edge (unique across the whole grid), the crossing positions,
+    and the ids of the edges at the corners of each triangle."""
+    f = resolve_function(f)
+    slab_zs = zs[k0:k1 + 1]
+    values = sample_grid(f, xs, ys, slab_zs, sparse, lipschitz, config)
+    crossings = find_crossings(values, xs, ys, slab_zs, config)
+
+    # Edges are numbered by axis, then position in the whole grid, as in number_crossings
+    edge_id = []
+    offset = 0
+    for axis, (mask, _) in enumerate(crossings):
+        shape = [len(xs), len(ys), len(zs)]
+        shape[axis] -= 1
+        ix, iy, iz = np.indices(mask.shape)
+        edge_id.append(offset + np.ravel_multi_index((ix, iy, iz + k0), shape))
+        offset += np.prod(shape)
+
+    cells, tri_edges = cell_triangles(values)
+    ids = np.concatenate([ids[mask] for ids, (mask, _) in zip(edge_id, crossings)])
+    positions = np.concatenate([p for _, p in crossings])
+    return ids, positions, triangle_vertices(edge_id, cells, tri_edges)
+
+
+def _dual_contour_slab(f, f_normal, xs, ys, zs, k0, k1, sparse, lipschitz, config):
+    """Runs in a worker. Finds the vertices of the cells between lattice planes k0 and k1, and the faces those
+    cells are responsible for. Returns the id of the cell of each vertex (unique across the whole grid),
+    the vertex positions, and the ids of the cells at the corners of each quad."""
+    f = resolve_function(f)
+    f_normal = resolve_function(f_normal)
+    # Faces on the plane k0 need the signs of the lattice points below it, and the cells below it as neighbours.
+    # Those cells get their vertices from the previous slab.
+    first = max(k0 - 1, 0)
+    values = sample_grid(f, xs, ys, zs[first:k1 + 1], sparse, lipschitz, config)
+    cell_shape = (len(xs) - 1, len(ys) - 1, len(zs) - 1)
+    ix, iy, iz = np.indices((cell_shape[0], cell_shape[1], k1 - first))
+    cell_id = np.ravel_multi_index((ix, iy, iz + first), cell_shape)
+
+    own = k0 - first
+    positions, vert_index = dual_contour_3d_vertices(f_normal, values[:, :, own:], xs, ys, zs[k0:k1 + 1],
+                                                     config=config)
+    ids = cell_id[:, :, own:][vert_index >= 0]
+    quads = dual_contour_3d_faces(values > 0, cell_id, first_owner=(0, 0, own))
+    return ids, positions, quads
+
+
+def _merge(results):
+    """Combines the results of the workers, keeping one vertex for each id, and replacing the ids
+    in the faces with vertex indices. Vertices are ordered by id."""
+    ids = np.concatenate([r[0] for r in results])
+    positions = np.concatenate([r[1] for r in results])
+    faces = np.concatenate([r[2] for r in results])
+    ids, first = np.unique(ids, return_index=True)
+    indices = np.searchsorted(ids, faces)
+    assert np.array_equal(ids[np.minimum(indices, len(ids) - 1)], faces), "a face uses a vertex no worker made"
+    return positions[first], indices
+
+
+def marching_cubes_3d_parallel(f, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                               workers=None, chunk_size=None, sparse=False, lipschitz=None, config=None):
+    """Runs Marching Cubes over the specified range, splitting the work between worker processes.
+    The result is the same as marching_cubes_3d_vectorized with share_vertices=True, up to the order of the faces.
+    workers defaults to settings.WORKERS, and chunk_size is the thickness in cells of each slab
+    handed to a worker. See sample_grid for sparse and lipschitz, and config.Config for config."""
+    config = resolve(config)
+    workers = workers or settings.WORKERS or os.cpu_count()
+    _check_pickleable(f, "f")
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    if min(len(xs), len(ys), len(zs)) <= 1:
+        return Mesh()
+    tasks = [(f, xs, ys, zs, k0, k1, sparse, lipschitz, config)
+             for k0, k1 in _slabs(len(zs) - 1, workers, chunk_size)]
+    positions, tris = _merge(_map(_marching_cubes_slab, tasks, workers))
+    return Mesh.from_arrays(positions, tris)
+
+
+def dual_contour_3d_parallel(f, f_normal, xmin=XMIN, xmax=XMAX, ymin=YMIN, ymax=YMAX, zmin=ZMIN, zmax=ZMAX,
+                             workers=None, chunk_size=None, sparse=False, lipschitz=None, config=None):
+    """Runs Dual Contouring over the specified range, splitting the work between worker processes.
+    The result is the same as dual_contour_3d, up to the order of the faces.
+    workers defaults to settings.WORKERS, and chunk_size is the thickness in cells of each slab
+    handed to a worker. See sample_grid for sparse and lipschitz, and config.Config for config."""
+    config = resolve(config)
+    workers = workers or settings.WORKERS or os.cpu_count()
+    _check_pickleable(f, "f")
+    _check_pickleable(f_normal, "f_normal")
+    xs, ys, zs = Grid.from_bounds((xmin, ymin, zmin), (xmax, ymax, zmax), config).coords
+    if min(len(xs), len(ys), len(zs)) <= 1:
+        return Mesh()
+    tasks = [(f, f_normal, xs, ys, zs, k0, k1, sparse, lipschitz, config)
+             for k0, k1 in _slabs(len(zs) - 1, workers, chunk_size)]
+    positions, quads = _merge(_map(_dual_contour_slab, tasks, workers))
+    return Mesh.from_arrays(positions, quads=quads)
+
+
+__all__ = ["marching_cubes_3d_parallel", "dual_contour_3d_parallel", "resolve_function"]
+
+if __name__ == "__main__":
+    circle_function = dual_contour_3d.circle_function
+    mesh = dual_contour_3d_parallel(circle_function, dual_contour_3d.normal_from_function(circle_function))
+    with open("output.obj", "w") as f:
+        make_obj(f, mesh)
@@ -1,9 +1,17 @@
+import itertools
+
 import numpy
 import numpy.linalg
 
 from utils_2d import V2
 from utils_3d import V3
-import settings
+from config import resolve
+
+
+# Singular values of A smaller than this, relative to the largest, count as zero, so the single cell and batch
+# solvers agree on which QEFs have no unique minimum.
+# The batch solvers work with A^T A, whose eigenvalues are their squares.
+SINGULAR_TOLERANCE = 1e-6
 
 
 class QEF:
@@ -22,7 +30,7 @@ class QEF:
 
     def eval_with_pos(self, x):
         """Evaluates the QEF at a position, returning the same format solve does."""
-        return self.evaluate(x), x
+        return self.evaluate(x) ** 2, x
 
     @staticmethod
     def make_2d(positions, normals):
@@ -54,9 +62,9 @@ class QEF:
     def solve(self):
         """Finds the point that minimizes the error of this QEF,
         and returns a tuple of the error squared and the point itself"""
-        result, residual, rank, s = numpy.linalg.lstsq(self.A, self.b, rcond=None)
+        result, residual, rank, s = numpy.linalg.lstsq(self.A, self.b, rcond=SINGULAR_TOLERANCE)
         if len(residual) == 0:
-            residual = self.evaluate(result)
+            residual = self.evaluate(result) ** 2
         else:
             residual = residual[0]
         # Result only contains the solution for the unfixed axis,
@@ -72,7 +80,7 @@ class QEF:
         return residual, position
 
 
-def solve_qef_2d(x, y, positions, normals):
+def solve_qef_2d(x, y, positions, normals, config=None):
     # The error term we are trying to minimize is sum( dot(x-v[i], n[i]) ^ 2)
     # This should be minimized over the unit square with top left point (x, y)
 
@@ -84,9 +92,10 @@ def solve_qef_2d(x, y, positions, normals):
     # This is demonstration code and isn't optimized, there are many good C++ implementations
     # out there if you need speed.
 
-    CELL_SIZE = settings.CELL_SIZE
+    config = resolve(config)
+    size_x, size_y = config.sizes(2)
 
-    if settings.BIAS:
+    if config.bias:
         # Add extra normals that add extra error the further we go
         # from the cell, this encourages the final result to be
         # inside the cell
@@ -98,18 +107,18 @@ def solve_qef_2d(x, y, positions, normals):
         # pull towards.
         mass_point = numpy.mean(positions, axis=0)
 
-        normals.append([settings.BIAS_STRENGTH, 0])
+        normals.append([config.bias_strength, 0])
         positions.append(mass_point)
-        normals.append([0, settings.BIAS_STRENGTH])
+        normals.append([0, config.bias_strength])
         positions.append(mass_point)
 
     qef = QEF.make_2d(positions, normals)
 
     residual, v = qef.solve()
 
-    if settings.BOUNDARY:
+    if config.boundary:
         def inside(r):
-            return x <= r[1][0] <= x + CELL_SIZE and y <= r[1][1] <= y + CELL_SIZE
+            return x <= r[1][0] <= x + size_x and y <= r[1][1] <= y + size_y
 
         # It's entirely possible that the best solution to the qef is not actually
         # inside the cell.
@@ -117,9 +126,9 @@ def solve_qef_2d(x, y, positions, normals):
             # If so, we constrain the the qef to the horizontal and vertical
             # lines bordering the cell, and find the best point of those
             r1 = qef.fix_axis(0, x + 0).solve()
-            r2 = qef.fix_axis(0, x + CELL_SIZE).solve()
+            r2 = qef.fix_axis(0, x + size_x).solve()
             r3 = qef.fix_axis(1, y + 0).solve()
-            r4 = qef.fix_axis(1, y + CELL_SIZE).solve()
+            r4 = qef.fix_axis(1, y + size_y).solve()
 
             rs = list(filter(inside, [r1, r2, r3, r4]))
 
@@ -128,24 +137,24 @@ def solve_qef_2d(x, y, positions, normals):
                 # cause solutions outside the box. So finally, we evaluate which corner
                 # of the cell looks best
                 r1 = qef.eval_with_pos((x + 0, y + 0))
-                r2 = qef.eval_with_pos((x + 0, y + CELL_SIZE))
-                r3 = qef.eval_with_pos((x + CELL_SIZE, y + 0))
-                r4 = qef.eval_with_pos((x + CELL_SIZE, y + CELL_SIZE))
+                r2 = qef.eval_with_pos((x + 0, y + size_y))
+                r3 = qef.eval_with_pos((x + size_x, y + 0))
+                r4 = qef.eval_with_pos((x + size_x, y + size_y))
 
                 rs = list(filter(inside, [r1, r2, r3, r4]))
 
             # Pick the best of the available options
-            residual, v = min(rs)
+            residual, v = _least_error(rs, qef, (x, y), (x + size_x, y + size_y))
 
-    if settings.CLIP:
+    if config.clip:
         # Crudely force v to be inside the cell
-        v[0] = numpy.clip(v[0], x, x + CELL_SIZE)
-        v[1] = numpy.clip(v[1], y, y + CELL_SIZE)
+        v[0] = numpy.clip(v[0], x, x + size_x)
+        v[1] = numpy.clip(v[1], y, y + size_y)
 
     return V2(v[0], v[1])
 
 
-def solve_qef_3d(x, y, z, positions, normals):
+def solve_qef_3d(x, y, z, positions, normals, config=None):
     # The error term we are trying to minimize is sum( dot(x-v[i], n[i]) ^ 2)
     # This should be minimized over the unit square with top left point (x, y)
 
@@ -157,9 +166,10 @@ def solve_qef_3d(x, y, z, positions, normals):
     # This is demonstration code and isn't optimized, there are many good C++ implementations
     # out there if you need speed.
 
-    CELL_SIZE = settings.CELL_SIZE
+    config = resolve(config)
+    size_x, size_y, size_z = config.sizes(3)
 
-    if settings.BIAS:
+    if config.bias:
         # Add extra normals that add extra error the further we go
         # from the cell, this encourages the final result to be
         # inside the cell
@@ -171,20 +181,20 @@ def solve_qef_3d(x, y, z, positions, normals):
         # pull towards.
         mass_point = numpy.mean(positions, axis=0)
 
-        normals.append([settings.BIAS_STRENGTH, 0, 0])
+        normals.append([config.bias_strength, 0, 0])
         positions.append(mass_point)
-        normals.append([0, settings.BIAS_STRENGTH, 0])
+        normals.append([0, config.bias_strength, 0])
         positions.append(mass_point)
-        normals.append([0, 0, settings.BIAS_STRENGTH])
+        normals.append([0, 0, config.bias_strength])
         positions.append(mass_point)
 
     qef = QEF.make_3d(positions, normals)
 
     residual, v = qef.solve()
 
-    if settings.BOUNDARY:
+    if config.boundary:
         def inside(r):
-            return x <= r[1][0] <= x + CELL_SIZE and y <= r[1][1] <= y + CELL_SIZE and z <= r[1][2] <= z + CELL_SIZE
+            return x <= r[1][0] <= x + size_x and y <= r[1][1] <= y + size_y and z <= r[1][2] <= z + size_z
 
         # It's entirely possible that the best solution to the qef is not actually
         # inside the cell.
@@ -192,11 +202,11 @@ def solve_qef_3d(x, y, z, positions, normals):
             # If so, we constrain the the qef to the 6
             # planes bordering the cell, and find the best point of those
             r1 = qef.fix_axis(0, x + 0).solve()
-            r2 = qef.fix_axis(0, x + CELL_SIZE).solve()
+            r2 = qef.fix_axis(0, x + size_x).solve()
             r3 = qef.fix_axis(1, y + 0).solve()
-            r4 = qef.fix_axis(1, y + CELL_SIZE).solve()
+            r4 = qef.fix_axis(1, y + size_y).solve()
             r5 = qef.fix_axis(2, z + 0).solve()
-            r6 = qef.fix_axis(2, z + CELL_SIZE).solve()
+            r6 = qef.fix_axis(2, z + size_z).solve()
 
             rs = list(filter(inside, [r1, r2, r3, r4, r5, r6]))
 
@@ -205,17 +215,17 @@ def solve_qef_3d(x, y, z, positions, normals):
                 # cause solutions outside the box.
                 # So now try the 12 lines bordering the cell
                 r1  = qef.fix_axis(1, y + 0).fix_axis(0, x + 0).solve()
-                r2  = qef.fix_axis(1, y + CELL_SIZE).fix_axis(0, x + 0).solve()
-                r3  = qef.fix_axis(1, y + 0).fix_axis(0, x + CELL_SIZE).solve()
-                r4  = qef.fix_axis(1, y + CELL_SIZE).fix_axis(0, x + CELL_SIZE).solve()
+                r2  = qef.fix_axis(1, y + size_y).fix_axis(0, x + 0).solve()
+                r3  = qef.fix_axis(1, y + 0).fix_axis(0, x + size_x).solve()
+                r4  = qef.fix_axis(1, y + size_y).fix_axis(0, x + size_x).solve()
                 r5  = qef.fix_axis(2, z + 0).fix_axis(0, x + 0).solve()
-                r6  = qef.fix_axis(2, z + CELL_SIZE).fix_axis(0, x + 0).solve()
-                r7  = qef.fix_axis(2, z + 0).fix_axis(0, x + CELL_SIZE).solve()
-                r8  = qef.fix_axis(2, z + CELL_SIZE).fix_axis(0, x + CELL_SIZE).solve()
+                r6  = qef.fix_axis(2, z + size_z).fix_axis(0, x + 0).solve()
+                r7  = qef.fix_axis(2, z + 0).fix_axis(0, x + size_x).solve()
+                r8  = qef.fix_axis(2, z + size_z).fix_axis(0, x + size_x).solve()
                 r9  = qef.fix_axis(2, z + 0).fix_axis(1, y + 0).solve()
-                r10 = qef.fix_axis(2, z + CELL_SIZE).fix_axis(1, y + 0).solve()
-                r11 = qef.fix_axis(2, z + 0).fix_axis(1, y + CELL_SIZE).solve()
-                r12 = qef.fix_axis(2, z + CELL_SIZE).fix_axis(1, y + CELL_SIZE).solve()
+                r10 = qef.fix_axis(2, z + size_z).fix_axis(1, y + 0).solve()
+                r11 = qef.fix_axis(2, z + 0).fix_axis(1, y + size_y).solve()
+                r12 = qef.fix_axis(2, z + size_z).fix_axis(1, y + size_y).solve()
 
                 rs = list(filter(inside, [r1, r2, r3, r4, r5, r6, r7, r8, r9, r10, r11, r12]))
 
@@ -223,23 +233,325 @@ def solve_qef_3d(x, y, z, positions, normals):
                 # So finally, we evaluate which corner
                 # of the cell looks best
                 r1 = qef.eval_with_pos((x + 0, y + 0, z + 0))
-                r2 = qef.eval_with_pos((x + 0, y + 0, z + CELL_SIZE))
-                r3 = qef.eval_with_pos((x + 0, y + CELL_SIZE, z + 0))
-                r4 = qef.eval_with_pos((x + 0, y + CELL_SIZE, z + CELL_SIZE))
-                r5 = qef.eval_with_pos((x + CELL_SIZE, y + 0, z + 0))
-                r6 = qef.eval_with_pos((x + CELL_SIZE, y + 0, z + CELL_SIZE))
-                r7 = qef.eval_with_pos((x + CELL_SIZE, y + CELL_SIZE, z + 0))
-                r8 = qef.eval_with_pos((x + CELL_SIZE, y + CELL_SIZE, z + CELL_SIZE))
+                r2 = qef.eval_with_pos((x + 0, y + 0, z + size_z))
+                r3 = qef.eval_with_pos((x + 0, y + size_y, z + 0))
+                r4 = qef.eval_with_pos((x + 0, y + size_y, z + size_z))
+                r5 = qef.eval_with_pos((x + size_x, y + 0, z + 0))
+                r6 = qef.eval_with_pos((x + size_x, y + 0, z + size_z))
+                r7 = qef.eval_with_pos((x + size_x, y + size_y, z + 0))
+                r8 = qef.eval_with_pos((x + size_x, y + size_y, z + size_z))
 
                 rs = list(filter(inside, [r1, r2, r3, r4, r5, r6, r7, r8]))
 
             # Pick the best of the available options
-            residual, v = min(rs)
+            residual, v = _least_error(rs, qef, (x, y, z), (x + size_x, y + size_y, z + size_z))
 
-    if settings.CLIP:
+    if config.clip:
         # Crudely force v to be inside the cell
-        v[0] = numpy.clip(v[0], x, x + CELL_SIZE)
-        v[1] = numpy.clip(v[1], y, y + CELL_SIZE)
-        v[2] = numpy.clip(v[2], z, z + CELL_SIZE)
+        v[0] = numpy.clip(v[0], x, x + size_x)
+        v[1] = numpy.clip(v[1], y, y + size_y)
+        v[2] = numpy.clip(v[2], z, z + size_z)
+
+    return V3(v[0], v[1], v[2])
+
+
+# Errors closer than this, relative to the size of the terms summed to make them, count as equal
+ERROR_TOLERANCE = 1e-9
+
+
+def _error_tolerance(ata_trace, btb, lo, hi):
+    """How close two errors of a QEF, for points in the cell from lo to hi, have to be to count as a tie.
+    The single cell and batch solvers work the errors out differently, so they only agree up to rounding error,
+    which depends on the size of the terms rather than of the error itself. Works on arrays of cells too."""
+    reach = numpy.maximum(numpy.abs(lo), numpy.abs(hi))
+    return ERROR_TOLERANCE * (btb + ata_trace * (reach * reach).sum(axis=-1))
+
+
+def _least_error(results, qef, lo, hi):
+    """Like min(results), for a list of (error, position) of the QEF in the cell from lo to hi,
+    but with errors within rounding error of the least counted as equal, and those ties broken by position."""
+    A, b = numpy.asarray(qef.A), numpy.asarray(qef.b)
+    tolerance = _error_tolerance((A * A).sum(), (b * b).sum(), numpy.array(lo), numpy.array(hi))
+    least = min(error for error, _ in results)
+    error, position = min((list(position), error) for error, position in results if error <= least + tolerance)[::-1]
+    return error, position
+
+
+def qef_dtype(dims=3):
+    """The numpy structured dtype used to store QEFData in arrays.
+    Only the upper triangle of the symmetric matrix A^T A is stored, so in 3d each QEF takes 10 floats,
+    plus 4 numbers for working out the mass point."""
+    return numpy.dtype([
+        ("ata", float, (dims * (dims + 1) // 2,)),
+        ("atb", float, (dims,)),
+        ("btb", float),
+        ("mass_point_sum", float, (dims,)),
+        ("count", numpy.int64),
+    ])
+
 
-    return V3(v[0], v[1], v[2])
\ No newline at end of file
+QEF_DTYPE = qef_dtype(3)
+
+
+class QEFData:
+    """A compact form of QEF, that stores A^T A, A^T b and b^T b rather than A and b themselves,
+    so its size doesn't depend on how many normals went into it.
+    It also tracks the average of the positions (the mass point), used for the bias.
+    QEFData objects can be added together, giving the QEF that measures the error from all the normals of both,
+    which is useful for combining neighbouring cells."""
+    def __init__(self, ata, atb, btb, mass_point_sum, count):
+        self.ata = numpy.array(ata, dtype=float)
+        self.atb = numpy.array(atb, dtype=float)
+        self.btb = float(btb)
+        self.mass_point_sum = numpy.array(mass_point_sum, dtype=float)
+        self.count = int(count)
+
+    @staticmethod
+    def empty(dims=3):
+        """Returns a QEFData with no normals in it"""
+        return QEFData(numpy.zeros((dims, dims)), numpy.zeros(dims), 0, numpy.zeros(dims), 0)
+
+    @staticmethod
+    def make(positions, normals):
+        """Returns a QEFData that measures the the error from a bunch of normals, each emanating from given positions"""
+        positions = numpy.asarray(positions, dtype=float)
+        normals = numpy.asarray(normals, dtype=float)
+        b = (positions * normals).sum(axis=-1)
+        return QEFData(normals.T @ normals, normals.T @ b, b @ b, positions.sum(axis=0), len(positions))
+
+    def __add__(self, other):
+        return QEFData(self.ata + other.ata, self.atb + other.atb, self.btb + other.btb,
+                       self.mass_point_sum + other.mass_point_sum, self.count + other.count)
+
+    @property
+    def mass_point(self):
+        return self.mass_point_sum / self.count
+
+    def evaluate(self, x):
+        """Evaluates the squared error of the function at a given point."""
+        x = numpy.asarray(x, dtype=float)
+        return x @ self.ata @ x - 2 * x @ self.atb + self.btb
+
+    def solve(self, mins, cell_size=None, config=None):
+        """Finds the best vertex inside the cell with lowest corner mins, following the same settings as solve_qef_3d.
+        Returns the position as an array."""
+        return solve_qef_data_batch(numpy.asarray(mins, dtype=float)[None], self.to_array(), cell_size, config)[0]
+
+    def to_array(self):
+        """Returns this as a length 1 array of dtype qef_dtype()"""
+        dims = len(self.atb)
+        result = numpy.zeros(1, dtype=qef_dtype(dims))
+        result["ata"] = self.ata[numpy.triu_indices(dims)]
+        result["atb"] = self.atb
+        result["btb"] = self.btb
+        result["mass_point_sum"] = self.mass_point_sum
+        result["count"] = self.count
+        return result
+
+    @staticmethod
+    def from_array(record):
+        """Reads back a single entry of an array of dtype qef_dtype()"""
+        ata, atb, btb, mass_point_sum = unpack_qef_data(numpy.asarray(record).reshape(1))[:4]
+        return QEFData(ata[0], atb[0], btb[0], mass_point_sum[0], numpy.asarray(record)["count"])
+
+
+def make_qef_data_batch(positions, normals, mask=None):
+    """Builds an array of QEFData, one per cell, without needing to go through any Python objects.
+    positions and normals are (N, K, D) arrays, with each cell's data padded out to the same length K.
+    mask is an optional (N, K) boolean array saying which of those rows are actually used.
+    Returns an (N,) array of dtype qef_dtype(D)."""
+    positions = numpy.asarray(positions, dtype=float)
+    normals = numpy.asarray(normals, dtype=float)
+    dims = positions.shape[-1]
+    if mask is None:
+        mask = numpy.ones(positions.shape[:2], dtype=bool)
+    weights = mask.astype(float)
+
+    b = numpy.einsum("nki,nki->nk", positions, normals)
+    weighted_normals = normals * weights[..., None]
+    ata = numpy.einsum("nki,nkj->nij", weighted_normals, normals)
+
+    result = numpy.zeros(len(positions), dtype=qef_dtype(dims))
+    result["ata"] = ata[:, numpy.triu_indices(dims)[0], numpy.triu_indices(dims)[1]]
+    result["atb"] = numpy.einsum("nki,nk->ni", weighted_normals, b)
+    result["btb"] = numpy.einsum("nk,nk->n", weights, b * b)
+    result["mass_point_sum"] = (positions * weights[..., None]).sum(axis=1)
+    result["count"] = mask.sum(axis=1)
+    return result
+
+
+def sum_qef_data(data, axis=None):
+    """Adds together an array of QEFData, over the given axis (or all of them)"""
+    if axis is None:
+        axis = tuple(range(data.ndim))
+    elif isinstance(axis, int):
+        # The fields can have extra dimensions of their own, so count from the front
+        axis = axis % data.ndim
+    sums = {name: data[name].sum(axis=axis) for name in data.dtype.names}
+    result = numpy.zeros(sums["btb"].shape, dtype=data.dtype)
+    for name, value in sums.items():
+        result[name] = value
+    return result
+
+
+def unpack_qef_data(data):
+    """Expands an array of QEFData into full A^T A matrices, A^T b, b^T b, mass point sums and mass points"""
+    dims = data["atb"].shape[-1]
+    rows, cols = numpy.triu_indices(dims)
+    ata = numpy.zeros(data.shape + (dims, dims))
+    ata[..., rows, cols] = data["ata"]
+    ata[..., cols, rows] = data["ata"]
+    count = numpy.maximum(data["count"], 1)[..., None]
+    return ata, data["atb"], data["btb"], data["mass_point_sum"], data["mass_point_sum"] / count
+
+
+def solve_qef_data_batch(mins, data, cell_size=None, config=None):
+    """Solves an array of QEFData, with the same rules as solve_qef_2d / solve_qef_3d.
+    mins is an (N, D) array of the lowest corner of each cell. cell_size defaults to the cell size of config,
+    and can also be an array giving the (cubic) size of each cell.
+    Returns an (N, D) array of the vertex for each cell."""
+    ata, atb, btb, _, mass_point = unpack_qef_data(data)
+    return _solve_normal_equations_batch(numpy.asarray(mins, dtype=float), ata, atb, btb, mass_point, cell_size,
+                                         config)
+
+
+def solve_qef_batch(mins, positions, normals, mask=None, config=None):
+    """Solves many QEFs at once, one per cell, giving the same results as calling solve_qef_2d / solve_qef_3d
+    on each cell in turn. Works in either 2 or 3 dimensions.
+
+    mins is an (N, D) array of the lowest corner of each cell.
+    positions and normals are (N, K, D) arrays, with each cell's data padded out to the same length K.
+    mask is an optional (N, K) boolean array saying which of those rows are actually used.
+
+    Returns an (N, D) array of the vertex for each cell."""
+    # Rather than keep A and b around, we just need the normal equations, A^T A x = A^T b,
+    # and b^T b for working out the error.
+    return solve_qef_data_batch(mins, make_qef_data_batch(positions, normals, mask), config=config)
+
+
+def _solve_normal_equations_batch(mins, ata, atb, btb, mass_point, cell_size=None, config=None):
+    """Does the work of solve_qef_batch, given the QEF of each cell in the form of A^T A, A^T b and b^T b."""
+    config = resolve(config)
+    dims = ata.shape[-1]
+    if cell_size is None:
+        maxs = mins + numpy.array(config.sizes(dims))
+    else:
+        maxs = mins + numpy.reshape(cell_size, (-1, 1))
+
+    if config.bias:
+        # Adding an extra normal along each axis, at the mass point, is the same as this
+        strength = config.bias_strength ** 2
+        ata = ata + strength * numpy.eye(dims)
+        atb = atb + strength * mass_point
+        btb = btb + strength * (mass_point * mass_point).sum(axis=-1)
+
+    no_axes = numpy.zeros(dims, dtype=bool)
+    v, _ = _solve_with_fixed_axes(ata, atb, btb, no_axes, mins)
+
+    if config.boundary:
+        def inside(p, lo, hi):
+            return numpy.all((lo <= p) & (p <= hi), axis=-1)
+
+        outside = numpy.nonzero(~inside(v, mins, maxs))[0]
+        if len(outside) > 0:
+            v[outside] = _solve_on_boundary_batch(ata[outside], atb[outside], btb[outside],
+                                                  mins[outside], maxs[outside])
+
+    if config.clip:
+        # Crudely force v to be inside the cell
+        v = numpy.clip(v, mins, maxs)
+
+    return v
+
+
+def _solve_on_boundary_batch(ata, atb, btb, lo, hi):
+    """Finds the best point on the boundary of each cell, for QEFs whose unconstrained minimum is outside it.
+    As with the single cell version, the candidates are the faces of the cell, with one axis fixed to one side
+    (6 planes in 3d), then two axes (12 lines), and so on until all axes are fixed (8 corners). The first of those
+    stages with any candidates inside the cell picks the best of them.
+
+    Rather than solving each candidate separately, stage by stage, all of them are solved together.
+    The matrix to invert only depends on which axes are fixed, not which sides they are fixed to,
+    so there is a single pseudo-inverse for each set of fixed axes, shared by all its candidates."""
+    n, dims = lo.shape
+    candidates = []
+    stages = []
+    for fixed_count in range(1, dims + 1):
+        for fixed_axes in itertools.combinations(range(dims), fixed_count):
+            fixed = numpy.zeros(dims, dtype=bool)
+            fixed[list(fixed_axes)] = True
+            free = ~fixed
+            # Every combination of sides for the fixed axes, as an (n, sides, dims) array
+            sides = numpy.array(list(itertools.product((0, 1), repeat=fixed_count)), dtype=bool)
+            position = numpy.repeat(lo[:, None, :], len(sides), axis=1)
+            fixed_values = numpy.where(sides, hi[:, None, fixed_axes], lo[:, None, fixed_axes])
+            position[:, :, fixed] = fixed_values
+            if free.any():
+                pinv = _pinv_symmetric_batch(ata[:, free][:, :, free])
+                rhs = atb[:, None, free] - numpy.einsum("nij,nsj->nsi", ata[:, free][:, :, fixed], fixed_values)
+                position[:, :, free] = numpy.einsum("nij,nsj->nsi", pinv, rhs)
+            candidates.append(position)
+            stages.extend([fixed_count] * len(sides))
+    candidates = numpy.concatenate(candidates, axis=1)
+    stages = numpy.array(stages)
+    errors = (numpy.einsum("nsi,nij,nsj->ns", candidates, ata, candidates)
+              - 2 * numpy.einsum("nsi,ni->ns", candidates, atb)
+              + btb[:, None])
+
+    # Pick the earliest stage with a candidate inside the cell, then the lowest error,
+    # breaking ties (up to rounding error) by position, like _least_error does in the single cell version
+    inside = numpy.all((lo[:, None] <= candidates) & (candidates <= hi[:, None]), axis=-1)
+    rank = numpy.where(inside, stages, dims + 1)
+    errors = numpy.where(rank == rank.min(axis=1, keepdims=True), errors, numpy.inf)
+    choice = numpy.argmin(errors, axis=1)
+    tolerance = _error_tolerance(numpy.trace(ata, axis1=1, axis2=2), btb, lo, hi)
+    tied = errors <= errors[numpy.arange(n), choice][:, None] + tolerance[:, None]
+    ties = numpy.nonzero(tied.sum(axis=1) > 1)[0]
+    if len(ties) > 0:
+        keys = (errors[ties],) + tuple(candidates[ties, :, axis] for axis in reversed(range(dims))) + (~tied[ties],)
+        choice[ties] = numpy.lexsort(keys, axis=-1)[:, 0]
+    return candidates[numpy.arange(n), choice]
+
+
+def _pinv_symmetric_batch(m, rcond=SINGULAR_TOLERANCE ** 2):
+    """The pseudo-inverse of a batch of symmetric matrices, like numpy.linalg.pinv with hermitian=True,
+    but worked out directly for 1x1 and 2x2 matrices, which is much faster."""
+    size = m.shape[-1]
+    if size == 1:
+        return numpy.divide(1, m, out=numpy.zeros_like(m), where=m != 0)
+    if size != 2:
+        return numpy.linalg.pinv(m, rcond=rcond, hermitian=True)
+    a, b, c = m[:, 0, 0], m[:, 0, 1], m[:, 1, 1]
+    # The eigenvalues, largest first
+    mean = (a + c) / 2
+    spread = numpy.hypot((a - c) / 2, b)
+    large, small = mean + spread, mean - spread
+    cutoff = rcond * numpy.maximum(numpy.abs(large), numpy.abs(small))
+    result = numpy.zeros_like(m)
+    # Full rank, so the pseudo-inverse is the inverse
+    full = (numpy.abs(small) > cutoff) & (numpy.abs(large) > cutoff)
+    det = a[full] * c[full] - b[full] * b[full]
+    result[full] = numpy.stack([c[full], -b[full], -b[full], a[full]], axis=-1).reshape(-1, 2, 2) / det[:, None, None]
+    # Rank 1, i.e. m = l u u^T for the one eigenvalue l that isn't ~0, so the pseudo-inverse is u u^T / l = m / l^2
+    single = ~full & (numpy.abs(large) + numpy.abs(small) > 0)
+    eigenvalue = numpy.where(numpy.abs(large) >= numpy.abs(small), large, small)[single]
+    result[single] = m[single] / (eigenvalue * eigenvalue)[:, None, None]
+    return result
+
+
+def _solve_with_fixed_axes(ata, atb, btb, fixed, values):
+    """Minimizes a batch of QEFs, given in normal equation form, with the axes marked in fixed
+    held at the corresponding entries of values.
+    Returns the positions found, and the squared error at each of them."""
+    free = ~fixed
+    position = numpy.array(values, dtype=float)
+    if free.any():
+        ata_free = ata[:, free][:, :, free]
+        rhs = atb[:, free] - numpy.einsum("nij,nj->ni", ata[:, free][:, :, fixed], position[:, fixed])
+        # Use the pseudo-inverse, so that like lstsq we get the smallest solution when there is no unique answer
+        pinv = numpy.linalg.pinv(ata_free, rcond=SINGULAR_TOLERANCE ** 2, hermitian=True)
+        position[:, free] = numpy.einsum("nij,nj->ni", pinv, rhs)
+    error = (numpy.einsum("ni,nij,nj->n", position, ata, position)
+             - 2 * numpy.einsum("ni,ni->n", position, atb)
+             + btb)
+    return position, error
@@ -0,0 +1,351 @@
+"""Provides signed distance functions built from simple shapes, for use as f with the 3d extractors.
+
+Shapes are made with sphere, box, cylinder and plane, moved with their translate, scale and rotate methods,
+and combined with | (union), & (intersection), - (difference) and their smooth versions. E.g.
+
+    shape = (sphere(2.5) - cylinder(1, 6)) | box((1, 1, 4)).rotate((1, 0, 0), math.pi / 4)
+    mesh = dual_contour_3d(shape, shape.normal, sparse=True)
+
+Like the other example functions, values are positive inside the shape and negative outside.
+Every shape is vectorized (see common.vectorized), and can be pickled, so works with parallel_3d.
+
+evaluate gives both the value and the exact gradient in a single pass over the tree, so normal can be used as
+f_normal without the extra evaluations of normal_from_function. interval gives bounds on the value over a box,
+which sample_grid uses (with sparse set) to skip regions that can't contain the boundary. Unlike passing
+lipschitz, this is exact even after smooth operations or scaling."""
+
+import abc
+import math
+
+import numpy as np
+
+from utils_3d import V3, make_obj
+
+
+class SDF(abc.ABC):
+    """Base class of the nodes of a shape expression"""
+    vectorized = True
+
+    def __call__(self, x, y, z):
+        value = self.value(*_coords(x, y, z))
+        return float(value) if np.ndim(value) == 0 else value
+
+    def value(self, x, y, z):
+        """The value at points given as arrays of coordinates"""
+        return self.evaluate(x, y, z)[0]
+
+    @abc.abstractmethod
+    def evaluate(self, x, y, z):
+        """Returns the value and gradient (as a tuple of arrays, one per axis) at points given as arrays
+        of coordinates"""
+
+    @abc.abstractmethod
+    def interval(self, lo, hi):
+        """Returns the lowest and highest value the shape could have anywhere in the box from lo to hi.
+        lo and hi are (x, y, z) tuples, whose entries can also be arrays, giving many boxes at once.
+        The bounds are not always tight, but are always safe."""
+
+    def normal(self, x, y, z):
+        """The normalized gradient, for use as f_normal"""
+        _, gradient = self.evaluate(*_coords(x, y, z))
+        if np.ndim(gradient[0]) == 0:
+            gradient = [float(g) for g in gradient]
+        return V3(*gradient).normalize()
+
+    normal.vectorized = True
+
+    def __or__(self, other):
+        return _Union(self, other)
+
+    def __and__(self, other):
+        return _Intersection(self, other)
+
+    def __sub__(self, other):
+        return _Intersection(self, _Complement(other))
+
+    def __neg__(self):
+        return _Complement(self)
+
+    def smooth_union(self, other, k):
+        """Like |, but blends the shapes together over a distance of about k where they meet"""
+        return _SmoothMax(self, other, k)
+
+    def smooth_intersection(self, other, k):
+        return _Complement(_SmoothMax(_Complement(self), _Complement(other), k))
+
+    def smooth_difference(self, other, k):
+        return self.smooth_intersection(_Complement(other), k)
+
+    def translate(self, offset):
+        return _Translate(self, offset)
+
+    def scale(self, factor):
+        """Scales the shape by factor about the origin"""
+        return _Scale(self, factor)
+
+    def rotate(self, axis, angle):
+        """Rotates the shape about the origin, by angle radians around axis"""
+        return _Rotate(self, _rotation_matrix(axis, angle))
+
+
+def _coords(x, y, z):
+    return [np.asarray(c, dtype=float) for c in (x, y, z)]
+
+
+def _box_distance(q, dq):
+    """Returns the signed distance (positive outside) from a box, given q, how far outside each of its slabs the
+    point is along the axes of the box, and dq, the gradient of each entry of q"""
+    outside = np.sqrt(sum(np.maximum(c, 0) ** 2 for c in q))
+    inside = np.minimum(np.maximum.reduce(q), 0)
+    # Outside, the gradient points away from the nearest point of the box.
+    # Inside, it points out of the nearest face.
+    nearest = np.argmax(q, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        gradient = [sum(np.where(outside > 0, np.maximum(c, 0) / outside, nearest == i) * g[axis]
+                        for i, (c, g) in enumerate(zip(q, dq)))
+                    for axis in range(3)]
+    return outside + inside, gradient
+
+
+def _box_distance_interval(q_lo, q_hi):
+    """The bounds of _box_distance, given bounds on each entry of q"""
+    lo = np.sqrt(sum(np.maximum(c, 0) ** 2 for c in q_lo)) + np.minimum(np.maximum.reduce(q_lo), 0)
+    hi = np.sqrt(sum(np.maximum(c, 0) ** 2 for c in q_hi)) + np.minimum(np.maximum.reduce(q_hi), 0)
+    return lo, hi
+
+
+def _distance_interval(lo, hi, c):
+    """The nearest and furthest that a point between lo and hi can be from c, along one axis"""
+    lo = np.asarray(lo, dtype=float) - c
+    hi = np.asarray(hi, dtype=float) - c
+    return np.maximum(np.maximum(lo, -hi), 0), np.maximum(np.abs(lo), np.abs(hi))
+
+
+class _Sphere(SDF):
+    def __init__(self, radius, center):
+        self.radius = radius
+        self.center = tuple(float(c) for c in center)
+
+    def evaluate(self, x, y, z):
+        d = [p - c for p, c in zip((x, y, z), self.center)]
+        length = np.sqrt(sum(c * c for c in d))
+        # At the center, any direction will do
+        safe = np.where(length > 0, length, 1)
+        return self.radius - length, tuple(-c / safe for c in d)
+
+    def interval(self, lo, hi):
+        near, far = zip(*[_distance_interval(l, h, c) for l, h, c in zip(lo, hi, self.center)])
+        return (self.radius - np.sqrt(sum(c * c for c in far)),
+                self.radius - np.sqrt(sum(c * c for c in near)))
+
+
+class _Box(SDF):
+    def __init__(self, size, center):
+        self.half = tuple(s / 2 for s in np.broadcast_to(size, (3,)).tolist())
+        self.center = tuple(float(c) for c in center)
+
+    def evaluate(self, x, y, z):
+        d = [p - c for p, c in zip((x, y, z), self.center)]
+        q = [np.abs(c) - h for c, h in zip(d, self.half)]
+        dq = [[np.where(c >= 0, 1.0, -1.0) if i == axis else 0 for axis in range(3)] for i, c in enumerate(d)]
+        distance, gradient = _box_distance(q, dq)
+        return -distance, tuple(-g for g in gradient)
+
+    def interval(self, lo, hi):
+        near, far = zip(*[_distance_interval(l, h, c) for l, h, c in zip(lo, hi, self.center)])
+        d_lo, d_hi = _box_distance_interval([n - h for n, h in zip(near, self.half)],
+                                            [f - h for f, h in zip(far, self.half)])
+        return -d_hi, -d_lo
+
+
+class _Cylinder(SDF):
+    def __init__(self, radius, height, center):
+        self.radius = radius
+        self.half_height = height / 2
+        self.center = tuple(float(c) for c in center)
+
+    def evaluate(self, x, y, z):
+        dx, dy, dz = [p - c for p, c in zip((x, y, z), self.center)]
+        radial = np.sqrt(dx * dx + dy * dy)
+        safe = np.where(radial > 0, radial, 1)
+        q = [radial - self.radius, np.abs(dz) - self.half_height]
+        dq = [[dx / safe, dy / safe, 0], [0, 0, np.where(dz >= 0, 1.0, -1.0)]]
+        distance, gradient = _box_distance(q, dq)
+        return -distance, tuple(-g for g in gradient)
+
+    def interval(self, lo, hi):
+        (nx, fx), (ny, fy), (nz, fz) = [_distance_interval(l, h, c) for l, h, c in zip(lo, hi, self.center)]
+        d_lo, d_hi = _box_distance_interval([np.sqrt(nx * nx + ny * ny) - self.radius, nz - self.half_height],
+                                            [np.sqrt(fx * fx + fy * fy) - self.radius, fz - self.half_height])
+        return -d_hi, -d_lo
+
+
+class _Plane(SDF):
+    def __init__(self, normal, offset):
+        length = math.sqrt(sum(n * n for n in normal))
+        self.normal_vector = tuple(n / length for n in normal)
+        self.offset = offset
+
+    def evaluate(self, x, y, z):
+        value = self.offset - sum(n * p for n, p in zip(self.normal_vector, (x, y, z)))
+        return value, tuple(np.full(np.shape(value), -n) for n in self.normal_vector)
+
+    def interval(self, lo, hi):
+        # Linear, so the extremes are at opposite corners
+        terms = [(n * np.asarray(l, dtype=float), n * np.asarray(h, dtype=float))
+                 for n, l, h in zip(self.normal_vector, lo, hi)]
+        return (self.offset - sum(np.maximum(a, b) for a, b in terms),
+                self.offset - sum(np.minimum(a, b) for a, b in terms))
+
+
+class _Union(SDF):
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def evaluate(self, x, y, z):
+        (a, ga), (b, gb) = self.a.evaluate(x, y, z), self.b.evaluate(x, y, z)
+        use_a = a >= b
+        return np.where(use_a, a, b), tuple(np.where(use_a, u, v) for u, v in zip(ga, gb))
+
+    def interval(self, lo, hi):
+        (a_lo, a_hi), (b_lo, b_hi) = self.a.interval(lo, hi), self.b.interval(lo, hi)
+        return np.maximum(a_lo, b_lo), np.maximum(a_hi, b_hi)
+
+
+class _Intersection(SDF):
+    def __init__(self, a, b):
+        self.a = a
+        self.b = b
+
+    def evaluate(self, x, y, z):
+        (a, ga), (b, gb) = self.a.evaluate(x, y, z), self.b.evaluate(x, y, z)
+        use_a = a <= b
+        return np.where(use_a, a, b), tuple(np.where(use_a, u, v) for u, v in zip(ga, gb))
+
+    def interval(self, lo, hi):
+        (a_lo, a_hi), (b_lo, b_hi) = self.a.interval(lo, hi), self.b.interval(lo, hi)
+        return np.minimum(a_lo, b_lo), np.minimum(a_hi, b_hi)
+
+
+class _Complement(SDF):
+    def __init__(self, a):
+        self.a = a
+
+    def evaluate(self, x, y, z):
+        value, gradient = self.a.evaluate(x, y, z)
+        return -value, tuple(-g for g in gradient)
+
+    def interval(self, lo, hi):
+        a_lo, a_hi = self.a.interval(lo, hi)
+        return -a_hi, -a_lo
+
+
+class _SmoothMax(SDF):
+    """The polynomial smooth maximum of a and b, which is above their maximum by at most k / 4"""
+    def __init__(self, a, b, k):
+        assert k > 0, "k must be positive"
+        self.a = a
+        self.b = b
+        self.k = k
+
+    def evaluate(self, x, y, z):
+        (a, ga), (b, gb) = self.a.evaluate(x, y, z), self.b.evaluate(x, y, z)
+        h = np.clip(0.5 + 0.5 * (a - b) / self.k, 0, 1)
+        value = b + (a - b) * h + self.k * h * (1 - h)
+        return value, tuple(h * u + (1 - h) * v for u, v in zip(ga, gb))
+
+    def interval(self, lo, hi):
+        (a_lo, a_hi), (b_lo, b_hi) = self.a.interval(lo, hi), self.b.interval(lo, hi)
+        return np.maximum(a_lo, b_lo), np.maximum(a_hi, b_hi) + self.k / 4
+
+
+class _Translate(SDF):
+    def __init__(self, a, offset):
+        self.a = a
+        self.offset = tuple(float(o) for o in offset)
+
+    def evaluate(self, x, y, z):
+        return self.a.evaluate(*[p - o for p, o in zip((x, y, z), self.offset)])
+
+    def interval(self, lo, hi):
+        return self.a.interval([np.asarray(l) - o for l, o in zip(lo, self.offset)],
+                               [np.asarray(h) - o for h, o in zip(hi, self.offset)])
+
+
+class _Scale(SDF):
+    def __init__(self, a, factor):
+        assert factor > 0, "factor must be positive"
+        self.a = a
+        self.factor = factor
+
+    def evaluate(self, x, y, z):
+        value, gradient = self.a.evaluate(x / self.factor, y / self.factor, z / self.factor)
+        return value * self.factor, gradient
+
+    def interval(self, lo, hi):
+        a_lo, a_hi = self.a.interval([np.asarray(l) / self.factor for l in lo],
+                                     [np.asarray(h) / self.factor for h in hi])
+        return a_lo * self.factor, a_hi * self.factor
+
+
+class _Rotate(SDF):
+    def __init__(self, a, matrix):
+        self.a = a
+        self.matrix = matrix
+
+    def evaluate(self, x, y, z):
+        # Rotate the point back into the frame of a, and the gradient out of it again
+        m = self.matrix
+        local = [m[0, i] * x + m[1, i] * y + m[2, i] * z for i in range(3)]
+        value, g = self.a.evaluate(*local)
+        return value, tuple(m[i, 0] * g[0] + m[i, 1] * g[1] + m[i, 2] * g[2] for i in range(3))
+
+    def interval(self, lo, hi):
+        # Use the box around the rotated box
+        m = self.matrix
+        center = [(np.asarray(l) + np.asarray(h)) / 2 for l, h in zip(lo, hi)]
+        half = [(np.asarray(h) - np.asarray(l)) / 2 for l, h in zip(lo, hi)]
+        local_center = [sum(m[j, i] * center[j] for j in range(3)) for i in range(3)]
+        local_half = [sum(abs(m[j, i]) * half[j] for j in range(3)) for i in range(3)]
+        return self.a.interval([c - h for c, h in zip(local_center, local_half)],
+                               [c + h for c, h in zip(local_center, local_half)])
+
+
+def _rotation_matrix(axis, angle):
+    x, y, z = np.asarray(axis, dtype=float) / np.linalg.norm(axis)
+    c, s = math.cos(angle), math.sin(angle)
+    return np.array([
+        [c + x * x * (1 - c), x * y * (1 - c) - z * s, x * z * (1 - c) + y * s],
+        [y * x * (1 - c) + z * s, c + y * y * (1 - c), y * z * (1 - c) - x * s],
+        [z * x * (1 - c) - y * s, z * y * (1 - c) + x * s, c + z * z * (1 - c)],
+    ])
+
+
+def sphere(radius, center=(0, 0, 0)):
+    return _Sphere(radius, center)
+
+
+def box(size, center=(0, 0, 0)):
+    """An axis aligned box. size is the length of each side, or a single number for a cube."""
+    return _Box(size, center)
+
+
+def cylinder(radius, height, center=(0, 0, 0)):
+    """A capped cylinder along the z axis"""
+    return _Cylinder(radius, height, center)
+
+
+def plane(normal, offset=0):
+    """The half space of points p with dot(normal, p) < offset, for a unit length normal"""
+    return _Plane(normal, offset)
+
+
+__all__ = ["SDF", "sphere", "box", "cylinder", "plane"]
+
+if __name__ == "__main__":
+    from dual_contour_3d import dual_contour_3d
+    shape = (sphere(2.5) - cylinder(1, 6)).smooth_union(box((1, 1, 4)).rotate((1, 0, 0), math.pi / 4), 0.5)
+    mesh = dual_contour_3d(shape, shape.normal, sparse=True)
+    with open("output.obj", "w") as f:
+        make_obj(f, mesh)
@@ -28,5 +28,23 @@ ZMAX = 3
 # Size of single cell in grid
 CELL_SIZE = 1
 
+# When only sampling the parts of the grid near the boundary, the size (in cells) of the smallest blocks considered
+SPARSE_BLOCK_SIZE = 8
+
+# When meshing a slab at a time, the thickness (in cells) of each slab
+CHUNK_SIZE = 16
+
+# The most points passed to a vectorized f in a single call (see common.vectorized)
+BATCH_SIZE = 65536
+
+# When re-meshing parts of a grid after edits, the size (in cells) of the blocks the mesh is kept in
+REMESH_BLOCK_SIZE = 8
+
+# When meshing with a varying level of detail, the size (in cells) of the regions that share a single level
+LOD_BLOCK_SIZE = 16
+
+# When meshing in parallel, the number of worker processes to use. None uses one per CPU
+WORKERS = None
+
 # Small value used to avoid floating point issues.
 EPS = 1e-8
\ No newline at end of file
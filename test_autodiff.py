@@ -0,0 +1,24 @@
+"""Checks that the example functions can be differentiated automatically"""
+
+import numpy as np
+import pytest
+
+import dual_contour_2d
+import dual_contour_3d
+import marching_cubes_2d
+import marching_cubes_3d
+from autodiff import normal_from_autodiff
+
+
+@pytest.mark.parametrize("module, point", [
+    (dual_contour_2d, (1.0, -2.0)),
+    (marching_cubes_2d, (1.0, -2.0)),
+    (dual_contour_3d, (1.0, -2.0, 0.5)),
+    (marching_cubes_3d, (1.0, -2.0, 0.5)),
+])
+def test_circle_normal(module, point):
+    value = module.circle_function(*point)
+    assert isinstance(value, float)
+    normal = normal_from_autodiff(module.circle_function)(*point)
+    expected = -np.array(point) / np.linalg.norm(point)
+    np.testing.assert_allclose([normal.x, normal.y] + ([normal.z] if len(point) == 3 else []), expected)
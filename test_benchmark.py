@@ -0,0 +1,41 @@
+"""Checks how benchmark.compare decides what counts as a regression"""
+
+from benchmark import cases, compare
+
+
+def _results(time, peak_memory=1000):
+    result = {"extractor": "dual_contour_2d", "field": "circle", "cells": 6, "time": time,
+              "peak_memory": peak_memory, "f_calls": 49, "f_normal_calls": 20, "vertices": 20, "faces": 20}
+    return {"results": [result]}
+
+
+def test_small_changes_in_time_are_noise():
+    _, regressed = compare(_results(0.003), _results(0.001))
+    assert not regressed
+
+
+def test_large_changes_in_time_regress():
+    lines, regressed = compare(_results(0.1), _results(0.05))
+    assert regressed
+    assert "SLOWER" in lines[0]
+
+
+def test_min_time():
+    _, regressed = compare(_results(0.1), _results(0.05), min_time=0.1)
+    assert not regressed
+    _, regressed = compare(_results(0.003), _results(0.001), min_time=0)
+    assert regressed
+
+
+def test_more_memory_regresses():
+    lines, regressed = compare(_results(0.001, 2000), _results(0.001, 1000))
+    assert regressed
+    assert "MORE MEMORY" in lines[0]
+
+
+def test_every_field_in_both_dimensions():
+    listed = {(extractor, field) for extractor, field, _ in cases(sizes_2d=[6], sizes_3d=[6])}
+    for field in ("circle", "square", "intersect", "t_shape"):
+        assert ("marching_cubes_2d", field) in listed and ("marching_cubes_3d", field) in listed
+    # t_shape has no normal, so is only used with Marching Cubes
+    assert ("dual_contour_3d", "square") in listed and ("dual_contour_3d", "t_shape") not in listed
@@ -0,0 +1,68 @@
+"""Checks that every extractor follows the config it is given, rather than the settings module"""
+
+import numpy as np
+
+import settings
+from chunked_3d import dual_contour_3d_chunks, marching_cubes_3d_chunks, join_chunks
+from common import vectorized
+from config import current
+from dual_contour_3d import dual_contour_3d, circle_function, circle_normal
+from dual_contour_3d_octree import dual_contour_3d_octree
+from incremental_3d import IncrementalDualContour3d, IncrementalMarchingCubes3d
+from lod_3d import dual_contour_3d_lod, marching_cubes_3d_lod
+from marching_cubes_3d import marching_cubes_3d_vectorized
+from parallel_3d import dual_contour_3d_parallel, marching_cubes_3d_parallel
+
+
+# Cells that aren't square, and differ from the settings
+CONFIG = current(cell_size=(0.5, 0.75, 0.25))
+
+
+def _vertices(mesh):
+    return np.unique(np.round(mesh.positions, 9), axis=0)
+
+
+def _same(mesh, expected):
+    assert len(expected.positions) > 0
+    np.testing.assert_allclose(_vertices(mesh), _vertices(expected), atol=1e-9)
+    assert len(mesh.tris) + len(mesh.quads) == len(expected.tris) + len(expected.quads)
+
+
+def test_marching_cubes():
+    expected = marching_cubes_3d_vectorized(circle_function, share_vertices=True, config=CONFIG)
+    _same(join_chunks(marching_cubes_3d_chunks(circle_function, chunk_size=3, config=CONFIG)), expected)
+    _same(marching_cubes_3d_parallel(circle_function, workers=1, config=CONFIG), expected)
+    _same(IncrementalMarchingCubes3d(circle_function, config=CONFIG).mesh(), expected)
+    _same(marching_cubes_3d_lod(circle_function, lambda x, y, z: 0, config=CONFIG), expected)
+
+
+def test_dual_contour():
+    expected = dual_contour_3d(circle_function, circle_normal, config=CONFIG)
+    _same(join_chunks(dual_contour_3d_chunks(circle_function, circle_normal, chunk_size=3, config=CONFIG)),
+          expected)
+    _same(dual_contour_3d_parallel(circle_function, circle_normal, workers=1, config=CONFIG), expected)
+    _same(IncrementalDualContour3d(circle_function, circle_normal, config=CONFIG).mesh(), expected)
+    _same(dual_contour_3d_octree(circle_function, circle_normal, tolerance=-1, config=CONFIG), expected)
+    _same(dual_contour_3d_lod(circle_function, circle_normal, lambda x, y, z: 0, config=CONFIG), expected)
+
+
+def test_chunk_size_read_at_call_time(monkeypatch):
+    expected = join_chunks(marching_cubes_3d_chunks(circle_function, chunk_size=2))
+    monkeypatch.setattr(settings, "CHUNK_SIZE", 2)
+    chunks = list(marching_cubes_3d_chunks(circle_function))
+    assert len(chunks) == 3
+    _same(join_chunks(chunks), expected)
+
+
+def test_batch_size_from_config(monkeypatch):
+    sizes = []
+
+    @vectorized
+    def f(x, y, z):
+        sizes.append(len(x))
+        return 2.5 - np.sqrt(x * x + y * y + z * z)
+
+    monkeypatch.setattr(settings, "BATCH_SIZE", 1)
+    mesh = marching_cubes_3d_vectorized(f, config=current(batch_size=100))
+    assert len(mesh.tris) > 0
+    assert max(sizes) == 100
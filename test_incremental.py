@@ -0,0 +1,68 @@
+"""Checks that editing f and calling mark_dirty gives the same mesh as meshing everything again"""
+
+import math
+
+import numpy as np
+import pytest
+
+from dual_contour_3d import dual_contour_3d, normal_from_function
+from incremental_3d import IncrementalDualContour3d, IncrementalMarchingCubes3d
+from marching_cubes_3d import marching_cubes_3d_vectorized
+
+BOUNDS = (-6, 6) * 3
+
+# Spheres added one at a time, as (x, y, z, radius)
+EDITS = [(4.5, 0.3, 0.2, 1.3), (-1, -4.2, 1.1, 1.0), (0, 0, 5.5, 1.7)]
+
+
+class _Editable:
+    """A sphere, with more spheres unioned onto it by edits, counting how often it is called"""
+    def __init__(self):
+        self.bumps = []
+        self.calls = 0
+
+    def __call__(self, x, y, z):
+        self.calls += 1
+        value = 4.5 - math.sqrt(x * x + y * y + z * z)
+        for cx, cy, cz, r in self.bumps:
+            value = max(value, r - math.sqrt((x - cx) ** 2 + (y - cy) ** 2 + (z - cz) ** 2))
+        return value
+
+
+def _key(mesh):
+    faces = mesh.tris if len(mesh.tris) else mesh.quads
+    return mesh.positions, sorted(map(tuple, faces.tolist()))
+
+
+@pytest.mark.parametrize("block_size", [2, 3, 8])
+@pytest.mark.parametrize("method", ["marching_cubes", "dual_contour"])
+def test_edit_matches_full_remesh(method, block_size):
+    f = _Editable()
+    f_normal = normal_from_function(f)
+    if method == "marching_cubes":
+        mesher = IncrementalMarchingCubes3d(f, *BOUNDS, block_size=block_size)
+    else:
+        mesher = IncrementalDualContour3d(f, f_normal, *BOUNDS, block_size=block_size)
+    initial_calls = f.calls
+
+    for edit in EDITS:
+        f.bumps.append(edit)
+        f.calls = 0
+        blocks = mesher.mark_dirty([c - edit[3] - 0.05 for c in edit[:3]], [c + edit[3] + 0.05 for c in edit[:3]])
+        # Only the region around the edit is evaluated again
+        assert 0 < f.calls < initial_calls / 2
+        assert len(blocks) > 0
+
+        if method == "marching_cubes":
+            expected = marching_cubes_3d_vectorized(f, *BOUNDS, share_vertices=True)
+        else:
+            expected = dual_contour_3d(f, f_normal, *BOUNDS)
+        positions, faces = _key(mesher.mesh())
+        expected_positions, expected_faces = _key(expected)
+        np.testing.assert_allclose(positions, expected_positions, atol=1e-9)
+        assert faces == expected_faces
+
+    # The blocks together make up the whole mesh
+    whole = mesher.mesh()
+    blocks = [mesher.block_mesh(block) for block in mesher.block_faces]
+    assert sum(len(b.tris) + len(b.quads) for b in blocks) == len(whole.tris) + len(whole.quads)
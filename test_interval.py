@@ -0,0 +1,72 @@
+"""Checks that interval.bounded gives safe bounds for the example functions, and that the 2d extractors use them"""
+
+import itertools
+
+import numpy as np
+import pytest
+
+import dual_contour_2d
+import dual_contour_3d
+import marching_cubes_2d
+from common import Grid
+from interval import bounded
+from settings import XMIN, XMAX, YMIN, YMAX
+from utils_2d import find_active_cells
+
+FIELDS_2D = {
+    "circle": dual_contour_2d.circle_function,
+    "square": dual_contour_2d.square_function,
+    "intersect": dual_contour_2d.intersect_function,
+    "t_shape": dual_contour_2d.t_shape_function,
+    "marching_cubes_square": marching_cubes_2d.square_function,
+    "marching_cubes_t_shape": marching_cubes_2d.t_shape_function,
+}
+
+
+def _edges(edges):
+    return sorted((e.v1.x, e.v1.y, e.v2.x, e.v2.y) for e in edges)
+
+
+@pytest.mark.parametrize("field", FIELDS_2D)
+def test_bounds_are_finite_and_safe(field):
+    f = bounded(FIELDS_2D[field])
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        lo = rng.uniform(-3, 3, size=2)
+        hi = lo + rng.uniform(0, 2, size=2)
+        low, high = f.interval(tuple(lo), tuple(hi))
+        # Overlapping Intervals go through np.minimum and np.maximum, so never give up on bounding
+        assert np.isfinite(low) and np.isfinite(high)
+        for x, y in itertools.chain(itertools.product(*zip(lo, hi)), lo + rng.random((20, 2)) * (hi - lo)):
+            assert low - 1e-9 <= f(x, y) <= high + 1e-9
+
+
+def test_3d_intersect_is_bounded():
+    f = bounded(dual_contour_3d.intersect_function)
+    # x - y and x + y overlap over this box, which the builtin min can't handle
+    low, high = f.interval((1, -1, 0), (2, 1, 1))
+    assert (low, high) == pytest.approx((-0.8, 2.2))
+
+
+@pytest.mark.parametrize("field", ["circle", "square", "intersect", "t_shape"])
+def test_sparse_2d_matches_dense(field):
+    f = FIELDS_2D[field]
+    grid = Grid.from_bounds((XMIN, YMIN), (XMAX, YMAX))
+    active = find_active_cells(bounded(f), grid)
+    assert 0 < active.sum() < active.size
+    dense = marching_cubes_2d.marching_cubes_2d(f)
+    assert _edges(marching_cubes_2d.marching_cubes_2d(bounded(f), sparse=True)) == _edges(dense)
+    if field != "t_shape":
+        f_normal = dual_contour_2d.normal_from_function(f)
+        dense = dual_contour_2d.dual_contour_2d(f, f_normal)
+        assert _edges(dual_contour_2d.dual_contour_2d(bounded(f), f_normal, sparse=True)) == _edges(dense)
+
+
+def test_sparse_2d_without_interval_visits_every_cell():
+    f = dual_contour_2d.circle_function
+    grid = Grid.from_bounds((XMIN, YMIN), (XMAX, YMAX))
+    assert find_active_cells(f, grid).all()
+    dense = marching_cubes_2d.marching_cubes_2d(f)
+    assert _edges(marching_cubes_2d.marching_cubes_2d(f, sparse=True)) == _edges(dense)
+    dense = dual_contour_2d.dual_contour_2d(f, dual_contour_2d.circle_normal)
+    assert _edges(dual_contour_2d.dual_contour_2d(f, dual_contour_2d.circle_normal, sparse=True)) == _edges(dense)
@@ -0,0 +1,79 @@
+"""Checks that meshes with a varying level of detail have no cracks where the level changes"""
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from common import Grid, vectorized
+from config import current
+from lod_3d import block_levels, distance_lod, dual_contour_3d_lod, marching_cubes_3d_lod
+from marching_cubes_3d import marching_cubes_3d_vectorized
+from utils_3d import V3
+
+BOUNDS = (-8, 8) * 3
+
+
+@vectorized
+def sphere_function(x, y, z):
+    return 6 - np.sqrt(x * x + y * y + z * z)
+
+
+def sphere_normal(x, y, z):
+    return V3(-x, -y, -z).normalize()
+
+
+def _edge_counts(mesh):
+    counts = Counter()
+    directed = Counter()
+    for faces in mesh.face_runs():
+        for face in faces.tolist():
+            for a, b in zip(face, face[1:] + face[:1]):
+                counts[min(a, b), max(a, b)] += 1
+                directed[a, b] += 1
+    return counts, directed
+
+
+def _assert_watertight(mesh):
+    counts, directed = _edge_counts(mesh)
+    assert counts and set(counts.values()) == {2}
+    assert set(directed.values()) == {1}
+
+
+@pytest.mark.parametrize("block_size", [2, 4, 8])
+def test_marching_cubes_watertight(block_size):
+    lod = distance_lod((6, 0, 0), 2)
+    grid = Grid.from_bounds(BOUNDS[::2], BOUNDS[1::2], current())
+    levels = block_levels(lod, grid, block_size)
+    assert len(np.unique(levels)) > 1
+    mesh = marching_cubes_3d_lod(sphere_function, lod, *BOUNDS, block_size=block_size)
+    _assert_watertight(mesh)
+    # Coarser blocks need fewer triangles than full detail
+    full = marching_cubes_3d_vectorized(sphere_function, *BOUNDS, share_vertices=True)
+    assert len(mesh.tris) < len(full.tris)
+
+
+def test_marching_cubes_full_detail_matches():
+    mesh = marching_cubes_3d_lod(sphere_function, lambda x, y, z: 0, *BOUNDS, block_size=4)
+    full = marching_cubes_3d_vectorized(sphere_function, *BOUNDS, share_vertices=True)
+    assert len(mesh.tris) == len(full.tris)
+    np.testing.assert_allclose(np.unique(mesh.positions, axis=0), np.unique(full.positions, axis=0))
+
+
+def test_dual_contour_watertight():
+    mesh = dual_contour_3d_lod(sphere_function, sphere_normal, distance_lod((6, 0, 0), 2), *BOUNDS)
+    _assert_watertight(mesh)
+    assert len(mesh.tris) > 0
+
+
+def test_distance_lod():
+    lod = distance_lod((1, 2, 3), 2, max_level=3)
+    assert lod(1, 2, 3) == 0
+    assert lod(2.9, 2, 3) == 0
+    assert lod(1, 2, 7) == 1
+    assert lod(1, 2, 3 + 8.1) == 2
+    assert lod(1, -14, 3) == 3
+    assert lod(1000, 2, 3) == 3
+    # Never finer further away
+    levels = [lod(1 + d, 2, 3) for d in np.linspace(0, 40, 200)]
+    assert levels == sorted(levels)
@@ -0,0 +1,64 @@
+"""Checks that the numpy and streaming versions of Marching Cubes give the same mesh as the cell by cell one"""
+
+import numpy as np
+import pytest
+
+from config import current
+from dual_contour_3d import circle_function, intersect_function
+from marching_cubes_3d import marching_cubes_3d, marching_cubes_3d_stream, marching_cubes_3d_vectorized
+
+
+def noise_function(x, y, z):
+    """Lots of small blobs, to hit many of the cases"""
+    return np.sin(3 * x) * np.sin(2.5 * y + 1) * np.sin(2 * z + 0.5) - 0.1
+
+
+FIELDS = {
+    "circle": circle_function,
+    "intersect": intersect_function,
+    "noise": noise_function,
+}
+
+CONFIGS = {
+    "default": None,
+    "cell_size": current(cell_size=(0.5, 0.75, 0.25)),
+}
+
+
+def _triangles(mesh):
+    """The corners of each triangle, in order"""
+    return mesh.positions[mesh.tris]
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+@pytest.mark.parametrize("field", FIELDS)
+def test_vectorized_matches_scalar(field, config):
+    f, config = FIELDS[field], CONFIGS[config]
+    expected = marching_cubes_3d(f, config=config)
+    mesh = marching_cubes_3d_vectorized(f, config=config)
+    assert len(expected.tris) > 0
+    np.testing.assert_array_equal(mesh.positions, expected.positions)
+    np.testing.assert_array_equal(mesh.tris, expected.tris)
+
+
+@pytest.mark.parametrize("config", CONFIGS)
+@pytest.mark.parametrize("field", FIELDS)
+def test_shared_vertices_match_scalar(field, config):
+    f, config = FIELDS[field], CONFIGS[config]
+    expected = marching_cubes_3d(f, config=config)
+    mesh = marching_cubes_3d_vectorized(f, share_vertices=True, config=config)
+    # The same triangles in the same order, with one vertex per crossed edge. Each edge's vertex is worked out
+    # once, rather than once per cell around it, which can differ in the last bit.
+    np.testing.assert_allclose(_triangles(mesh), _triangles(expected), rtol=0, atol=1e-12)
+    assert len(np.unique(mesh.tris)) == len(mesh.positions) < len(expected.positions)
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 100])
+@pytest.mark.parametrize("config", CONFIGS)
+@pytest.mark.parametrize("field", FIELDS)
+def test_stream_matches_scalar(field, config, batch_size):
+    f, config = FIELDS[field], CONFIGS[config]
+    expected = marching_cubes_3d(f, config=config)
+    pieces = list(marching_cubes_3d_stream(f, batch_size=batch_size, config=config))
+    triangles = np.concatenate([_triangles(piece) for piece in pieces])
+    np.testing.assert_allclose(triangles, _triangles(expected), rtol=0, atol=1e-12)
@@ -0,0 +1,77 @@
+"""Checks that the octree gives a closed surface, and the same mesh as dual_contour_3d when not simplifying"""
+
+from collections import Counter
+
+import numpy as np
+import pytest
+
+from dual_contour_3d import dual_contour_3d, circle_function, circle_normal, intersect_function, normal_from_function
+from dual_contour_3d_octree import dual_contour_3d_octree
+from sdf import box, sphere
+
+FIELDS = {
+    "circle": (circle_function, circle_normal),
+    "intersect": (intersect_function, normal_from_function(intersect_function)),
+}
+
+SHAPE = box((3, 3, 3)) | sphere(1.5, (1.5, 1.5, 1.5))
+
+# Closed shapes, so every edge of the mesh should be shared by exactly two faces
+CLOSED = {
+    "circle": (circle_function, circle_normal),
+    "shape": (SHAPE, SHAPE.normal),
+}
+
+
+def _faces(mesh):
+    """The set of faces, by vertex positions, ignoring the order of vertices and faces"""
+    positions = np.round(mesh.positions, 9)
+    result = set()
+    for faces in mesh.face_runs():
+        for face in faces:
+            corners = [tuple(positions[i]) for i in face]
+            first = corners.index(min(corners))
+            result.add(tuple(corners[first:] + corners[:first]))
+    return result
+
+
+def _edge_counts(mesh):
+    """How many times each edge is used, and how many times in each direction"""
+    counts = Counter()
+    directed = Counter()
+    for faces in mesh.face_runs():
+        for face in faces.tolist():
+            for a, b in zip(face, face[1:] + face[:1]):
+                counts[min(a, b), max(a, b)] += 1
+                directed[a, b] += 1
+    return counts, directed
+
+
+@pytest.mark.parametrize("field", FIELDS)
+def test_unsimplified_matches_dual_contour(field):
+    f, f_normal = FIELDS[field]
+    octree = dual_contour_3d_octree(f, f_normal, tolerance=-1)
+    uniform = dual_contour_3d(f, f_normal)
+    assert len(octree.tris) == 0
+    assert len(octree.quads) == len(uniform.quads) > 0
+    assert _faces(octree) == _faces(uniform)
+
+
+@pytest.mark.parametrize("tolerance", [-1, 1e-4, 1e-2])
+@pytest.mark.parametrize("field", CLOSED)
+def test_manifold(field, tolerance):
+    f, f_normal = CLOSED[field]
+    mesh = dual_contour_3d_octree(f, f_normal, tolerance=tolerance)
+    counts, directed = _edge_counts(mesh)
+    assert counts and set(counts.values()) == {2}
+    # Consistently wound, so each edge is used once in each direction
+    assert set(directed.values()) == {1}
+    # Every vertex is used
+    used = np.unique(np.concatenate([faces.ravel() for faces in mesh.face_runs()]))
+    assert len(used) == len(mesh.positions)
+
+
+def test_simplifies_flat_regions():
+    full = dual_contour_3d_octree(SHAPE, SHAPE.normal, tolerance=-1)
+    simplified = dual_contour_3d_octree(SHAPE, SHAPE.normal)
+    assert len(simplified.positions) < len(full.positions)
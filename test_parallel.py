@@ -0,0 +1,66 @@
+"""Checks that meshing in worker processes gives the same mesh as meshing in this one"""
+
+import numpy as np
+import pytest
+
+from dual_contour_3d import dual_contour_3d, circle_function, circle_normal, intersect_function, normal_from_function
+from marching_cubes_3d import marching_cubes_3d_vectorized
+from parallel_3d import _merge, dual_contour_3d_parallel, marching_cubes_3d_parallel
+
+# Both top level functions, so they can be sent to the workers
+FIELDS = {
+    "circle": circle_function,
+    "intersect": intersect_function,
+}
+
+
+def _key(mesh):
+    faces = mesh.tris if len(mesh.tris) else mesh.quads
+    return mesh.positions, sorted(map(tuple, faces.tolist()))
+
+
+def _assert_same(a, b):
+    positions_a, faces_a = _key(a)
+    positions_b, faces_b = _key(b)
+    np.testing.assert_array_equal(positions_a, positions_b)
+    assert faces_a == faces_b and len(faces_a) > 0
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 4])
+@pytest.mark.parametrize("field", FIELDS)
+def test_marching_cubes_workers_match_serial(field, chunk_size):
+    f = FIELDS[field]
+    serial = marching_cubes_3d_parallel(f, workers=1, chunk_size=chunk_size)
+    _assert_same(serial, marching_cubes_3d_vectorized(f, share_vertices=True))
+    _assert_same(marching_cubes_3d_parallel(f, workers=2, chunk_size=chunk_size), serial)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 4])
+@pytest.mark.parametrize("field", FIELDS)
+def test_dual_contour_workers_match_serial(field, chunk_size):
+    f = FIELDS[field]
+    f_normal = normal_from_function(f)
+    serial = dual_contour_3d_parallel(f, f_normal, workers=1, chunk_size=chunk_size)
+    _assert_same(serial, dual_contour_3d(f, f_normal))
+    _assert_same(dual_contour_3d_parallel(f, f_normal, workers=2, chunk_size=chunk_size), serial)
+
+
+def test_functions_by_name():
+    serial = dual_contour_3d_parallel(circle_function, circle_normal, workers=1)
+    by_name = dual_contour_3d_parallel("dual_contour_3d:circle_function", "dual_contour_3d:circle_normal", workers=2)
+    _assert_same(by_name, serial)
+
+
+def test_unpickleable_function():
+    with pytest.raises(TypeError):
+        marching_cubes_3d_parallel(lambda x, y, z: x, workers=2)
+
+
+def test_merge_rejects_unknown_vertices():
+    results = [(np.array([3, 5]), np.zeros((2, 3)), np.array([[3, 5, 3]])),
+               (np.array([5, 8]), np.ones((2, 3)), np.array([[5, 8, 7]]))]
+    with pytest.raises(AssertionError):
+        _merge(results)
+    positions, faces = _merge(results[:1] + [(np.array([5, 8]), np.ones((2, 3)), np.array([[5, 8, 8]]))])
+    np.testing.assert_array_equal(faces, [[0, 1, 0], [1, 2, 2]])
+    np.testing.assert_array_equal(positions, [[0, 0, 0], [0, 0, 0], [1, 1, 1]])
@@ -0,0 +1,85 @@
+"""Checks the shapes of sdf against point by point evaluation, and that their intervals are safe"""
+
+import math
+
+import numpy as np
+import pytest
+
+from sdf import SDF, box, cylinder, plane, sphere
+
+SHAPES = {
+    "sphere": sphere(2, (0.5, 0, -0.25)),
+    "box": box((1, 2, 3), (0, 0.5, 0)),
+    "cylinder": cylinder(1.5, 2, (0, 0, 0.5)),
+    "plane": plane((1, 2, -1), 0.5),
+    "union": sphere(1.5) | box(2, (1, 1, 0)),
+    "intersection": sphere(2) & cylinder(1, 5),
+    "difference": box(3) - sphere(1.8),
+    "complement": -sphere(1),
+    "smooth_union": sphere(1.5).smooth_union(box(2, (1, 1, 0)), 0.5),
+    "smooth_intersection": sphere(2).smooth_intersection(cylinder(1, 5), 0.5),
+    "smooth_difference": box(3).smooth_difference(sphere(1.8), 0.5),
+    "translate": box((1, 2, 1)).translate((0.5, -1, 2)),
+    "scale": (sphere(1) - cylinder(0.5, 3)).scale(2),
+    "rotate": box((1, 1, 4)).rotate((1, 1, 0), math.pi / 5),
+    "nested": (sphere(2.5) - cylinder(1, 6)).smooth_union(box((1, 1, 4)).rotate((1, 0, 0), math.pi / 4), 0.5),
+}
+
+
+def _points(n, seed=0):
+    return np.random.default_rng(seed).uniform(-3, 3, size=(3, n))
+
+
+def test_is_abstract():
+    with pytest.raises(TypeError):
+        SDF()
+
+
+@pytest.mark.parametrize("name", SHAPES)
+def test_evaluate_matches_points(name):
+    shape = SHAPES[name]
+    x, y, z = _points(200)
+    value, gradient = shape.evaluate(x, y, z)
+    np.testing.assert_allclose(shape(x, y, z), value)
+    for i in range(len(x)):
+        v, g = shape.evaluate(*[np.asarray(c[i]) for c in (x, y, z)])
+        assert shape(x[i], y[i], z[i]) == pytest.approx(float(v), abs=1e-12)
+        np.testing.assert_allclose(value[i], v, atol=1e-12)
+        np.testing.assert_allclose([c[i] for c in np.broadcast_arrays(*gradient)], np.ravel(g), atol=1e-12)
+        n = shape.normal(x[i], y[i], z[i])
+        np.testing.assert_allclose(np.linalg.norm([n.x, n.y, n.z]), 1)
+
+
+@pytest.mark.parametrize("name", SHAPES)
+def test_gradient_matches_differences(name):
+    shape = SHAPES[name]
+    x, y, z = _points(200, seed=1)
+    _, gradient = shape.evaluate(x, y, z)
+    h = 1e-6
+    differences = [(shape(*[c + h * (axis == i) for i, c in enumerate((x, y, z))]) -
+                    shape(*[c - h * (axis == i) for i, c in enumerate((x, y, z))])) / (2 * h)
+                   for axis in range(3)]
+    # Away from the creases, where the gradient jumps
+    close = np.all([np.isclose(g, d, atol=1e-4) for g, d in zip(np.broadcast_arrays(*gradient), differences)], axis=0)
+    assert np.mean(close) > 0.95
+
+
+@pytest.mark.parametrize("name", SHAPES)
+def test_interval_brackets_samples(name):
+    shape = SHAPES[name]
+    rng = np.random.default_rng(2)
+    n = 100
+    lo = rng.uniform(-3, 3, size=(3, n))
+    hi = lo + rng.uniform(0, 1.5, size=(3, n))
+    bounds = shape.interval(tuple(lo), tuple(hi))
+    for i in range(n):
+        # The corners, and random points inside the box
+        t = np.concatenate([np.array(np.meshgrid([0, 1], [0, 1], [0, 1])).reshape(3, -1),
+                            rng.random((3, 50))], axis=1)
+        points = lo[:, i, None] + t * (hi - lo)[:, i, None]
+        values = shape(*points)
+        assert bounds[0][i] <= values.min() + 1e-9
+        assert values.max() <= bounds[1][i] + 1e-9
+    # Scalar boxes give the same bounds
+    single = shape.interval(tuple(lo[:, 0]), tuple(hi[:, 0]))
+    np.testing.assert_allclose(np.ravel(single), [bounds[0][0], bounds[1][0]])
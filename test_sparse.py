@@ -0,0 +1,43 @@
+"""Checks that sparse sampling never changes the output of the 3d extractors, even without a lipschitz bound"""
+
+import io
+
+import pytest
+
+from dual_contour_3d import dual_contour_3d, circle_function, circle_normal, intersect_function, normal_from_function
+from dual_contour_3d_octree import dual_contour_3d_octree
+from marching_cubes_3d import marching_cubes_3d, marching_cubes_3d_vectorized
+from utils_3d import make_obj
+
+
+FIELDS = {
+    "circle": (circle_function, circle_normal),
+    "intersect": (intersect_function, normal_from_function(intersect_function)),
+}
+
+EXTRACTORS = {
+    "marching_cubes_3d": lambda f, f_normal, *bounds, **kw: marching_cubes_3d(f, *bounds, **kw),
+    "marching_cubes_3d_vectorized": lambda f, f_normal, *bounds, **kw: marching_cubes_3d_vectorized(f, *bounds, **kw),
+    "dual_contour_3d": dual_contour_3d,
+    "dual_contour_3d_octree": dual_contour_3d_octree,
+}
+
+# Large enough to span several sparse blocks
+BOUNDS = (-10, 10) * 3
+
+
+def _obj(mesh):
+    file = io.StringIO()
+    make_obj(file, mesh)
+    return file.getvalue()
+
+
+@pytest.mark.parametrize("field", FIELDS)
+@pytest.mark.parametrize("extractor", EXTRACTORS)
+def test_sparse_matches_dense(extractor, field):
+    f, f_normal = FIELDS[field]
+    run = EXTRACTORS[extractor]
+    dense = run(f, f_normal, *BOUNDS)
+    sparse = run(f, f_normal, *BOUNDS, sparse=True)
+    assert "f " in _obj(dense)
+    assert _obj(sparse) == _obj(dense)
@@ -0,0 +1,121 @@
+"""Checks that volumes are meshed without reading the whole array into memory"""
+
+import numpy as np
+import pytest
+
+import settings
+from dual_contour_2d import dual_contour_2d
+from dual_contour_3d import dual_contour_3d
+from marching_cubes_2d import marching_cubes_2d
+from utils_3d import V3
+from volume import Volume, load_npy
+
+
+def _sphere(n):
+    """A signed distance field of a sphere, on n grid points along each axis centered on the origin"""
+    p = np.arange(n) - (n - 1) / 2
+    x, y, z = np.meshgrid(p, p, p, indexing="ij")
+    return (n / 3 - np.sqrt(x * x + y * y + z * z)).astype(np.float32)
+
+
+def _faces(mesh):
+    """The set of faces, by vertex positions, ignoring the order of vertices and faces"""
+    positions = np.round(mesh.positions, 9)
+    result = set()
+    for quad in mesh.quads:
+        corners = [tuple(positions[i]) for i in quad]
+        first = corners.index(min(corners))
+        result.add(tuple(corners[first:] + corners[:first]))
+    return result
+
+
+def test_sample_matches_calls():
+    rng = np.random.default_rng(0)
+    volume = Volume(rng.normal(size=(9, 7, 8)), origin=(1, -2, 0.5), spacing=(0.5, 1, 0.75))
+    xs, ys, zs = np.linspace(1.2, 4.4, 11), np.linspace(-1.5, 2.5, 5), np.linspace(0.5, 3.0, 4)
+    expected = np.array([[[volume(x, y, z) for z in zs] for y in ys] for x in xs])
+    np.testing.assert_allclose(volume.sample(xs, ys, zs), expected)
+
+
+class _Reads:
+    """Wraps an array, recording the largest part of it read at once"""
+    def __init__(self, data):
+        self.data = data
+        self.ndim = data.ndim
+        self.shape = data.shape
+        self.largest = 0
+
+    def __getitem__(self, index):
+        result = self.data[index]
+        self.largest = max(self.largest, np.size(result))
+        return result
+
+
+class _Samples(Volume):
+    """A Volume recording the most lattice points sampled at once"""
+    largest = 0
+
+    def sample(self, *coords):
+        result = super().sample(*coords)
+        self.largest = max(self.largest, result.size)
+        return result
+
+
+def test_dual_contour_memmap_is_not_materialized(tmp_path):
+    n = 64
+    np.save(tmp_path / "sphere.npy", _sphere(n))
+    memmap = load_npy(tmp_path / "sphere.npy").data
+    assert isinstance(memmap, np.memmap)
+    volume = _Samples(_Reads(memmap))
+    bounds = volume.bounds()
+    chunk = settings.CHUNK_SIZE
+    assert settings.CELL_SIZE == 1 and chunk < n / 2
+
+    def normal(x, y, z):
+        c = (n - 1) / 2
+        return V3(c - x, c - y, c - z).normalize()
+
+    mesh = dual_contour_3d(volume, normal, *bounds)
+    # The lattice is sampled a slab of planes along z at a time,
+    # reading just the part of the array around it a few planes along x at a time
+    assert volume.largest <= n * n * (chunk + 1)
+    assert volume.data.largest <= (chunk + 2) * n * (chunk + 2)
+
+    values = np.asarray(memmap, dtype=float)
+    expected = dual_contour_3d(None, normal, *bounds, values=values)
+    assert len(mesh.quads) > 0
+    assert _faces(mesh) == _faces(expected)
+
+
+def _circle(n):
+    """Like _sphere, in 2d"""
+    p = np.arange(n) - (n - 1) / 2
+    x, y = np.meshgrid(p, p, indexing="ij")
+    return n / 3 - np.sqrt(x * x + y * y)
+
+
+def _edges(edges):
+    return [(e.v1.x, e.v1.y, e.v2.x, e.v2.y) for e in edges]
+
+
+@pytest.mark.parametrize("extractor", ["marching_cubes_2d", "dual_contour_2d"])
+def test_2d_reads_a_tile_at_a_time(extractor):
+    n = 64
+    volume = _Samples(_Reads(_circle(n)))
+    chunk = settings.CHUNK_SIZE
+    assert settings.CELL_SIZE == 1 and chunk < n / 2
+
+    def point_by_point(x, y):
+        return volume(x, y)
+
+    if extractor == "marching_cubes_2d":
+        edges = marching_cubes_2d(volume, *volume.bounds())
+        expected = marching_cubes_2d(point_by_point, *volume.bounds())
+    else:
+        edges = dual_contour_2d(volume, volume.normal, *volume.bounds())
+        expected = dual_contour_2d(point_by_point, volume.normal, *volume.bounds())
+    # Sampled all together, but read a few rows at a time
+    assert volume.largest == n * n
+    assert volume.data.largest <= (chunk + 1) * n
+    assert len(edges) > 0
+    assert _edges(edges) == _edges(expected)
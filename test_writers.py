@@ -0,0 +1,193 @@
+"""Checks that meshes read back the same from each of the file formats, and the compatibility views of Mesh"""
+
+import io
+import json
+import struct
+
+import numpy as np
+import pytest
+
+from dual_contour_3d import circle_function
+from marching_cubes_3d import marching_cubes_3d, marching_cubes_3d_stream
+from utils_3d import V3, Mesh, ObjWriter, PlyWriter, Quad, Tri, make_glb, make_obj, make_ply, make_stl
+
+
+def _mixed_mesh(dtype=np.float64):
+    """A mesh with triangles and quads interleaved"""
+    verts = [V3(0, 0, 0), V3(1, 0, 0), V3(1, 1, 0), V3(0, 1, 0), V3(0, 0, 1), V3(1, 0, 1.5)]
+    faces = [Quad(1, 2, 3, 4), Tri(1, 2, 5), Tri(2, 6, 5), Quad(5, 6, 3, 4), Tri(4, 1, 5)]
+    return Mesh(verts, faces, dtype=dtype)
+
+
+def _faces(mesh):
+    """The faces in order, as tuples of 0-based indices"""
+    return [tuple(f) for faces in mesh.face_runs() for f in faces.tolist()]
+
+
+def _read_obj(text):
+    positions, faces = [], []
+    for line in text.splitlines():
+        kind, *values = line.split()
+        if kind == "v":
+            positions.append([float(v) for v in values])
+        elif kind == "f":
+            faces.append(tuple(int(v) - 1 for v in values))
+    return np.array(positions).reshape(-1, 3), faces
+
+
+def _read_ply(data):
+    header, body = data.split(b"end_header\n", 1)
+    lines = header.decode("ascii").splitlines()
+    vertex_count = int(lines[2].split()[2])
+    face_count = int(lines[6].split()[2])
+    dtype = "<f8" if lines[3].split()[1] == "double" else "<f4"
+    positions = np.frombuffer(body, dtype=dtype, count=vertex_count * 3).reshape(-1, 3)
+    offset = positions.nbytes
+    faces = []
+    for _ in range(face_count):
+        n = body[offset]
+        faces.append(struct.unpack_from("<{}i".format(n), body, offset + 1))
+        offset += 1 + 4 * n
+    assert offset == len(body)
+    return positions, faces
+
+
+def _read_glb(data):
+    magic, version, length = struct.unpack_from("<4sII", data)
+    assert (magic, version, length) == (b"glTF", 2, len(data))
+    text_length, kind = struct.unpack_from("<I4s", data, 12)
+    assert kind == b"JSON"
+    document = json.loads(data[20:20 + text_length])
+    if "meshes" not in document:
+        assert 20 + text_length == len(data)
+        return document, np.zeros((0, 3)), np.zeros((0, 3))
+    binary_length, kind = struct.unpack_from("<I4s", data, 20 + text_length)
+    assert kind == b"BIN\0" and binary_length == document["buffers"][0]["byteLength"] > 0
+    binary = data[28 + text_length:]
+    positions_view, indices_view = document["bufferViews"]
+    positions = np.frombuffer(binary, "<f4", document["accessors"][0]["count"] * 3,
+                              positions_view["byteOffset"]).reshape(-1, 3)
+    indices = np.frombuffer(binary, "<u4", document["accessors"][1]["count"], indices_view["byteOffset"])
+    return document, positions, indices.reshape(-1, 3)
+
+
+def _triangles(faces):
+    """Splits quads into triangles, in the same way as Mesh.triangles"""
+    result = []
+    for f in faces:
+        result += [f] if len(f) == 3 else [(f[0], f[1], f[2]), (f[0], f[2], f[3])]
+    return result
+
+
+def test_face_order_is_kept():
+    mesh = _mixed_mesh()
+    expected = [(0, 1, 2, 3), (0, 1, 4), (1, 5, 4), (4, 5, 2, 3), (3, 0, 4)]
+    assert _faces(mesh) == expected
+    assert [face.v1 - 1 for face in mesh.faces] == [f[0] for f in expected]
+    assert [type(face) for face in mesh.faces] == [Quad, Tri, Tri, Quad, Tri]
+    assert mesh.faces[3].v4 == 4 and mesh.faces[-1].v1 == 4
+    assert _faces(mesh + mesh) == expected + [tuple(i + 6 for i in f) for f in expected]
+    assert _faces(mesh.translate(V3(1, 2, 3))) == expected
+
+    # Appending to a mesh that starts in the usual order
+    mesh = Mesh.from_arrays(np.zeros((6, 3)), [(0, 1, 2)], [(0, 1, 2, 3)])
+    mesh.add_tri(3, 4, 5)
+    assert _faces(mesh) == [(0, 1, 2), (0, 1, 2, 3), (3, 4, 5)]
+
+
+def test_views_behave_like_lists():
+    mesh = _mixed_mesh()
+    verts = mesh.verts
+    assert [(v.x, v.y, v.z) for v in verts[1:3]] == [(1, 0, 0), (1, 1, 0)]
+    assert verts[-1].z == 1.5
+    verts.append(V3(2, 2, 2))
+    assert len(mesh.verts) == 7 and mesh.positions[-1].tolist() == [2, 2, 2]
+
+    faces = mesh.faces
+    assert [type(f) for f in faces[::2]] == [Quad, Tri, Tri]
+    faces.append(Tri(7, 1, 2))
+    faces.append(Quad(1, 2, 3, 7))
+    assert _faces(mesh)[-2:] == [(6, 0, 1), (0, 1, 2, 6)]
+    with pytest.raises(IndexError):
+        mesh.faces[len(mesh.faces)]
+
+
+@pytest.mark.parametrize("mixed", [False, True])
+def test_obj_round_trip(mixed):
+    mesh = _mixed_mesh() if mixed else marching_cubes_3d(circle_function)
+    file = io.StringIO()
+    make_obj(file, mesh)
+    positions, faces = _read_obj(file.getvalue())
+    np.testing.assert_array_equal(positions, mesh.positions)
+    assert faces == _faces(mesh)
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("mixed", [False, True])
+def test_ply_round_trip(mixed, dtype):
+    mesh = _mixed_mesh(dtype) if mixed else Mesh.from_arrays(marching_cubes_3d(circle_function).positions,
+                                                              marching_cubes_3d(circle_function).tris, dtype=dtype)
+    file = io.BytesIO()
+    make_ply(file, mesh)
+    positions, faces = _read_ply(file.getvalue())
+    assert positions.dtype == dtype
+    np.testing.assert_array_equal(positions, mesh.positions)
+    assert faces == _faces(mesh)
+
+
+@pytest.mark.parametrize("mixed", [False, True])
+def test_stl_round_trip(mixed):
+    mesh = _mixed_mesh() if mixed else marching_cubes_3d(circle_function)
+    file = io.BytesIO()
+    make_stl(file, mesh)
+    data = file.getvalue()
+    (count,) = struct.unpack_from("<I", data, 80)
+    records = np.frombuffer(data, dtype=[("normal", "<f4", 3), ("corners", "<f4", (3, 3)), ("attributes", "<u2")],
+                            offset=84)
+    triangles = _triangles(_faces(mesh))
+    assert count == len(records) == len(triangles)
+    np.testing.assert_array_equal(records["corners"], mesh.positions[np.array(triangles)].astype(np.float32))
+    np.testing.assert_allclose(np.linalg.norm(records["normal"], axis=-1), 1, rtol=1e-6)
+
+
+@pytest.mark.parametrize("mixed", [False, True])
+def test_glb_round_trip(mixed):
+    mesh = _mixed_mesh() if mixed else marching_cubes_3d(circle_function)
+    file = io.BytesIO()
+    make_glb(file, mesh)
+    document, positions, indices = _read_glb(file.getvalue())
+    np.testing.assert_array_equal(positions, mesh.positions.astype(np.float32))
+    assert [tuple(t) for t in indices.tolist()] == _triangles(_faces(mesh))
+    assert document["accessors"][0]["min"] == positions.min(axis=0).tolist()
+
+
+def test_empty_glb():
+    for mesh in (Mesh(), Mesh.from_arrays(np.ones((3, 3)))):
+        file = io.BytesIO()
+        make_glb(file, mesh)
+        document, positions, indices = _read_glb(file.getvalue())
+        assert document["scenes"] == [{}] and "buffers" not in document
+
+
+def test_streaming_writers_match_whole_mesh():
+    mesh = marching_cubes_3d(circle_function)
+    pieces = list(marching_cubes_3d_stream(circle_function, batch_size=2))
+    assert len(pieces) > 1
+
+    whole, streamed = io.StringIO(), io.StringIO()
+    make_obj(whole, mesh)
+    with ObjWriter(streamed) as writer:
+        for piece in pieces:
+            writer.write(piece)
+    positions, faces = _read_obj(streamed.getvalue())
+    expected_positions, expected_faces = _read_obj(whole.getvalue())
+    # Vertices on the boundary between slabs are repeated, so compare faces by their positions
+    np.testing.assert_array_equal(positions[np.array(faces)], expected_positions[np.array(expected_faces)])
+
+    file = io.BytesIO()
+    with PlyWriter(file) as writer:
+        for piece in pieces:
+            writer.write(piece)
+    ply_positions, ply_faces = _read_ply(file.getvalue())
+    np.testing.assert_array_equal(ply_positions, positions)
+    assert ply_faces == faces
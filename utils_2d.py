@@ -1,8 +1,9 @@
 """Contains utilities common to 2d meshing methods"""
 
-from settings import XMIN, XMAX, YMIN, YMAX, CELL_SIZE, EPS
-from common import frange
+from settings import XMIN, XMAX, YMIN, YMAX, EPS
+from common import Grid, is_vectorized, evaluate_batch
 import math
+import numpy as np
 
 class V2:
     def __init__(self, x, y):
@@ -10,10 +11,67 @@ class V2:
         self.y = y
 
     def normalize(self):
-        d = math.sqrt(self.x*self.x+self.y*self.y)
+        d = self.x*self.x+self.y*self.y
+        # Also works for vectors of arrays, as returned by vectorized f_normal
+        d = np.sqrt(d) if isinstance(d, np.ndarray) else math.sqrt(d)
         return V2(self.x / d, self.y / d)
 
 
+def presample(f, grid, config=None):
+    """If f has already been sampled on a grid (see volume.Volume), reads it at every lattice point of grid
+    (a common.Grid) with f.sample, a tile at a time. If f is vectorized (see common.vectorized), evaluates it at
+    every lattice point in batches of config.batch_size. Either way, returns a function that looks up those values,
+    only calling f for any other points. Otherwise returns f unchanged."""
+    if hasattr(f, "sample"):
+        values = f.sample(*grid.coords)
+    elif is_vectorized(f):
+        x, y = np.meshgrid(*grid.coords, indexing="ij")
+        values = evaluate_batch(f, x.ravel(), y.ravel(), config=config).reshape(x.shape)
+    else:
+        return f
+
+    def lookup(x, y):
+        index = grid.point((x, y))
+        return f(x, y) if index is None else float(values[index])
+    return lookup
+
+
+def find_active_cells(f, grid):
+    """Works out which cells of grid (a common.Grid) might contain part of the boundary, using f.interval
+    (see sdf and interval.bounded) to bound f over ever smaller squares of cells, like a quadtree.
+    Squares where the bounds don't include zero are skipped without evaluating f at all, and the rest are split
+    into four, down to single cells. Returns a boolean array with an entry per cell.
+    Without f.interval, nothing says how f behaves between lattice points, so every cell is active."""
+    if not hasattr(f, "interval"):
+        return np.ones(grid.shape, dtype=bool)
+    active = np.zeros(grid.shape, dtype=bool)
+    xs, ys = [c.tolist() for c in grid.coords]
+
+    def visit(ix, iy, size):
+        ix1 = min(ix + size, grid.shape[0])
+        iy1 = min(iy + size, grid.shape[1])
+        if ix >= ix1 or iy >= iy1:
+            return
+        low, high = f.interval((xs[ix], ys[iy]), (xs[ix1], ys[iy1]))
+        # Leave some room for rounding error
+        if low > EPS or high < -EPS:
+            return
+        if size == 1:
+            active[ix, iy] = True
+            return
+        half = size // 2
+        for dx in (0, half):
+            for dy in (0, half):
+                visit(ix + dx, iy + dy, half)
+
+    # Start from the smallest power of two that covers the grid
+    size = 1
+    while size < max(grid.shape, default=0):
+        size *= 2
+    visit(0, 0, size)
+    return active
+
+
 def element(e, **kwargs):
     """Utility function used for rendering svg"""
     s = "<" + e
@@ -32,14 +90,15 @@ def make_svg(file, edges, f):
 
     file.write("<g transform='scale({})'>\n".format(scale))
     # Draw grid
-    for x in frange(XMIN, XMAX, CELL_SIZE):
-        for y in frange(YMIN, YMAX, CELL_SIZE):
-            file.write(element("rect", x=x, y=y, width=CELL_SIZE, height=CELL_SIZE,
-                               style="stroke: grey; stroke-width: 0.02; fill: none"))
+    grid = Grid.from_bounds((XMIN, YMIN), (XMAX, YMAX))
+    width, height = grid.spacing.tolist()
+    for _, (x, y) in grid.cell_positions():
+        file.write(element("rect", x=x, y=y, width=width, height=height,
+                           style="stroke: grey; stroke-width: 0.02; fill: none"))
 
     # Draw filled / unfilled circles
-    for x in frange(XMIN, XMAX+CELL_SIZE, CELL_SIZE):
-        for y in frange(YMIN, YMAX+CELL_SIZE, CELL_SIZE):
+    for x in grid.coords[0].tolist():
+        for y in grid.coords[1].tolist():
             is_solid = f(x, y) > 0
             fill_color = ("black" if is_solid else "white")
             file.write(element("circle", cx=x, cy=y, r=0.05,
@@ -1,6 +1,14 @@
 """Contains utilities common to 3d meshing methods"""
 
+import json
 import math
+import shutil
+import struct
+import tempfile
+import numpy as np
+
+from common import adapt_array, evaluate_batch
+import settings
 
 class V3:
     """A vector in 3D space"""
@@ -10,7 +18,9 @@ class V3:
         self.z = z
 
     def normalize(self):
-        d = math.sqrt(self.x*self.x+self.y*self.y+self.z*self.z)
+        d = self.x*self.x+self.y*self.y+self.z*self.z
+        # Also works for vectors of arrays, as returned by vectorized f_normal
+        d = np.sqrt(d) if isinstance(d, np.ndarray) else math.sqrt(d)
         return V3(self.x / d, self.y / d, self.z / d)
 
 class Tri:
@@ -42,35 +52,531 @@ class Quad:
             return Quad(self.v1, self.v2, self.v3, self.v4)
 
 
+class _Buffer:
+    """A growable array of fixed width rows. Capacity doubles whenever it runs out,
+    so appending is O(1) amortised, like a Python list."""
+    def __init__(self, width, dtype):
+        self.data = np.empty((0, width), dtype=dtype)
+        self.count = 0
+
+    def extend(self, rows):
+        rows = np.asarray(rows, dtype=self.data.dtype).reshape(-1, self.data.shape[1])
+        needed = self.count + len(rows)
+        if needed > len(self.data):
+            data = np.empty((max(needed, 2 * len(self.data), 16), self.data.shape[1]), dtype=self.data.dtype)
+            data[:self.count] = self.data[:self.count]
+            self.data = data
+        self.data[self.count:needed] = rows
+        self.count = needed
+
+    @property
+    def array(self):
+        return self.data[:self.count]
+
+
 class Mesh:
-    """A collection of vertices, and faces between those vertices."""
-    def __init__(self, verts=None, faces=None):
-        self.verts = verts or []
-        self.faces = faces or []
+    """A collection of vertices, and faces between those vertices.
+    The vertices are stored as an (N, 3) array, positions, and the faces as arrays of 0-based vertex indices,
+    tris (T, 3) and quads (Q, 4). These arrays are views of growable buffers, so are only valid until the
+    mesh is next added to.
+
+    Faces keep the order they were added in, which the writers follow, though tris and quads are stored apart.
+    While every triangle comes before every quad, which is true of the meshes the extractors make,
+    that order costs nothing to keep.
+
+    For compatibility, a Mesh can also be built from lists of V3 and Tri/Quad (with 1-based indices, as in the
+    obj format), and verts and faces give sequences of those. They can be indexed, sliced, iterated over and
+    appended to, but unlike the lists they replace, don't support other changes, like assigning to an index."""
+    def __init__(self, verts=None, faces=None, dtype=np.float64):
+        self._positions = _Buffer(3, dtype)
+        self._tris = _Buffer(3, np.int32)
+        self._quads = _Buffer(4, np.int32)
+        # The kind of each face in order, 0 for a triangle or 1 for a quad, or None while tris all come first
+        self._order = None
+        if verts:
+            self._positions.extend([(v.x, v.y, v.z) for v in verts])
+        if faces:
+            self._add_kinds([isinstance(face, Quad) for face in faces])
+            self._tris.extend([(t.v1 - 1, t.v2 - 1, t.v3 - 1) for t in faces if isinstance(t, Tri)])
+            self._quads.extend([(q.v1 - 1, q.v2 - 1, q.v3 - 1, q.v4 - 1) for q in faces if isinstance(q, Quad)])
+
+    @classmethod
+    def from_arrays(cls, positions, tris=None, quads=None, dtype=np.float64):
+        """Makes a mesh from an array of vertex positions and arrays of 0-based triangle and quad indices"""
+        mesh = cls(dtype=dtype)
+        mesh._positions.extend(positions)
+        if tris is not None:
+            mesh._tris.extend(tris)
+        if quads is not None:
+            mesh._quads.extend(quads)
+        return mesh
+
+    @property
+    def positions(self):
+        return self._positions.array
+
+    @property
+    def tris(self):
+        return self._tris.array
+
+    @property
+    def quads(self):
+        return self._quads.array
 
-    def extend(self, other):
-        l = len(self.verts)
-        f = lambda v: v + l
-        self.verts.extend(other.verts)
-        self.faces.extend(face.map(f) for face in other.faces)
+    @property
+    def verts(self):
+        return _VertexView(self)
+
+    @property
+    def faces(self):
+        return _FaceView(self)
+
+    def add_vertex(self, x, y, z):
+        """Adds a vertex, returning its index"""
+        self._positions.extend((x, y, z))
+        return self._positions.count - 1
+
+    def add_tri(self, v1, v2, v3):
+        if self._quads.count or self._order is not None:
+            self._add_kinds([0])
+        self._tris.extend((v1, v2, v3))
+
+    def add_quad(self, v1, v2, v3, v4):
+        if self._order is not None:
+            self._order.extend(1)
+        self._quads.extend((v1, v2, v3, v4))
+
+    def _add_kinds(self, kinds):
+        """Records the kinds of faces about to be added, see _order"""
+        kinds = np.asarray(kinds, dtype=np.int8)
+        if self._order is None:
+            if not np.any(np.diff(kinds) < 0) and not (self._quads.count and len(kinds) and kinds[0] == 0):
+                return
+            order = _Buffer(1, np.int8)
+            order.extend(self.face_kinds())
+            self._order = order
+        self._order.extend(kinds)
+
+    def face_kinds(self):
+        """Returns the kind of each face in order, 0 for a triangle or 1 for a quad"""
+        if self._order is None:
+            return np.repeat(np.array([0, 1], dtype=np.int8), [self._tris.count, self._quads.count])
+        return self._order.array[:, 0]
+
+    def face_runs(self):
+        """Yields the faces in order, as arrays of consecutive triangles or consecutive quads"""
+        if self._order is None:
+            yield self.tris
+            yield self.quads
+            return
+        kinds = self.face_kinds()
+        starts = np.flatnonzero(np.diff(kinds)) + 1
+        arrays = (self.tris, self.quads)
+        next_index = [0, 0]
+        for start, end in zip(np.concatenate([[0], starts]), np.concatenate([starts, [len(kinds)]])):
+            kind = kinds[start]
+            i = next_index[kind]
+            next_index[kind] = i + end - start
+            yield arrays[kind][i:i + end - start]
+
+    def extend(self, other, offset=None):
+        """Adds the vertices and faces of other to this mesh. offset is added to the vertex indices of other's faces,
+        and defaults to the number of vertices already in this mesh."""
+        if offset is None:
+            offset = len(self.positions)
+        if other._order is not None or (self._quads.count and len(other.tris)) or self._order is not None:
+            self._add_kinds(other.face_kinds())
+        self._positions.extend(other.positions)
+        self._tris.extend(other.tris + offset)
+        self._quads.extend(other.quads + offset)
 
     def __add__(self, other):
-        r = Mesh()
+        r = Mesh(dtype=self.positions.dtype)
         r.extend(self)
         r.extend(other)
         return r
 
+    def triangles(self):
+        """Returns the faces in order as an array of triangles, splitting each quad in two"""
+        return np.concatenate([faces if faces.shape[1] == 3 else faces[:, [0, 1, 2, 0, 2, 3]].reshape(-1, 3)
+                               for faces in self.face_runs()])
+
     def translate(self, offset):
-        new_verts = [V3(v.x + offset.x, v.y + offset.y, v.z + offset.z) for v in self.verts]
-        return Mesh(new_verts, self.faces)
+        if isinstance(offset, V3):
+            offset = (offset.x, offset.y, offset.z)
+        result = Mesh(dtype=self.positions.dtype)
+        result.extend(self)
+        result.positions[...] = self.positions + np.asarray(offset)
+        return result
+
 
+class _VertexView:
+    """The vertices of a Mesh, as V3 objects"""
+    def __init__(self, mesh):
+        self.mesh = mesh
 
-def make_obj(f, mesh):
-    """Crude export to Wavefront mesh format"""
-    for v in mesh.verts:
-        f.write("v {} {} {}\n".format(v.x, v.y, v.z))
-    for face in mesh.faces:
-        if isinstance(face, Quad):
-            f.write("f {} {} {} {}\n".format(face.v1, face.v2, face.v3, face.v4))
+    def __len__(self):
+        return len(self.mesh.positions)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [V3(*p) for p in self.mesh.positions[i].tolist()]
+        return V3(*self.mesh.positions[i].tolist())
+
+    def __iter__(self):
+        for p in self.mesh.positions.tolist():
+            yield V3(*p)
+
+    def append(self, v):
+        self.mesh.add_vertex(v.x, v.y, v.z)
+
+
+class _FaceView:
+    """The faces of a Mesh, as Tri and Quad objects with 1-based indices"""
+    def __init__(self, mesh):
+        self.mesh = mesh
+
+    def __len__(self):
+        return len(self.mesh.tris) + len(self.mesh.quads)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return list(self)[i]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("face index out of range")
+        kinds = self.mesh.face_kinds()
+        # The number of faces of the same kind before this one
+        kind = kinds[i]
+        j = int(np.count_nonzero(kinds[:i] == kind))
+        if kind == 0:
+            return Tri(*(self.mesh.tris[j] + 1).tolist())
+        return Quad(*(self.mesh.quads[j] + 1).tolist())
+
+    def __iter__(self):
+        for faces in self.mesh.face_runs():
+            face = Tri if faces.shape[1] == 3 else Quad
+            for f in (faces + 1).tolist():
+                yield face(*f)
+
+    def append(self, face):
         if isinstance(face, Tri):
-            f.write("f {} {} {}\n".format(face.v1, face.v2, face.v3))
+            self.mesh.add_tri(face.v1 - 1, face.v2 - 1, face.v3 - 1)
+        else:
+            self.mesh.add_quad(face.v1 - 1, face.v2 - 1, face.v3 - 1, face.v4 - 1)
+
+
+def sample_grid(f, xs, ys, zs, sparse=False, lipschitz=None, config=None):
+    """Evaluates f once at every point of the lattice spanned by xs, ys and zs.
+    Returns an array of shape (len(xs), len(ys), len(zs)).
+
+    If sparse is set, f is only evaluated in blocks of the grid that might contain the boundary, see find_active_blocks.
+    Everywhere else is filled in with a value of the right sign, which is all the meshing methods need
+    away from the boundary.
+
+    If f has already been sampled on a grid (see volume.Volume), it is read with f.sample instead.
+    If f is vectorized (see common.vectorized), it is called on batches of config.batch_size points
+    rather than each point."""
+    if hasattr(f, "sample"):
+        return f.sample(xs, ys, zs)
+    values = np.empty((len(xs), len(ys), len(zs)))
+    if not sparse:
+        needed = np.ones(values.shape, dtype=bool)
+    else:
+        active, culled = find_active_blocks(f, xs, ys, zs, lipschitz=lipschitz)
+        for (ix0, ix1, iy0, iy1, iz0, iz1), value in culled:
+            values[ix0:ix1 + 1, iy0:iy1 + 1, iz0:iz1 + 1] = value
+        needed = np.zeros(values.shape, dtype=bool)
+        for ix0, ix1, iy0, iy1, iz0, iz1 in active:
+            needed[ix0:ix1 + 1, iy0:iy1 + 1, iz0:iz1 + 1] = True
+
+    index = np.nonzero(needed)
+    coords = [np.asarray(c, dtype=float)[i] for c, i in zip((xs, ys, zs), index)]
+    values[index] = evaluate_batch(f, *coords, config=config)
+    return values
+
+
+def find_active_blocks(f, xs, ys, zs, lipschitz=None, block_size=None):
+    """Splits the cells of the lattice into blocks of block_size cells along each side, and works out which
+    might contain part of the boundary, without evaluating f everywhere.
+
+    If lipschitz is given, f must not change faster than that per unit distance, as is true of a signed distance
+    function (with lipschitz=1). It defaults to the lipschitz attribute of f, if any, see common.signed_distance.
+    We start with large blocks, and evaluate f at the center of each. If f is further
+    from zero than the distance to the furthest corner allows, the block can't contain the boundary.
+    Otherwise, it's split into 8 smaller blocks, down to block_size. This is always safe.
+
+    If f has an interval method (like the shapes in sdf, or any f wrapped with interval.bounded), the same search
+    is done, but a block is skipped when the bounds interval gives for f over it don't include zero.
+    This is also always safe, and needs no lipschitz.
+
+    Otherwise, nothing says how f behaves between the points it's evaluated at, so every block is active.
+
+    Returns a list of the active blocks, and a list of the blocks that were skipped, each paired with a value
+    of f with the same sign as f everywhere in that block.
+    Blocks are described by the (inclusive) range of lattice points they cover: (ix0, ix1, iy0, iy1, iz0, iz1)"""
+    if block_size is None:
+        block_size = settings.SPARSE_BLOCK_SIZE
+    shape = (len(xs) - 1, len(ys) - 1, len(zs) - 1)
+    coords = (xs, ys, zs)
+    active = []
+    culled = []
+
+    def block(start, size):
+        """Clips a cube of cells to the grid, returning the range of lattice points, or None if empty"""
+        end = [min(s + size, n) for s, n in zip(start, shape)]
+        if any(s >= e for s, e in zip(start, end)):
+            return None
+        return start[0], end[0], start[1], end[1], start[2], end[2]
+
+    if lipschitz is None:
+        lipschitz = getattr(f, "lipschitz", None)
+    if lipschitz is not None or hasattr(f, "interval"):
+        def visit(start, size):
+            b = block(start, size)
+            if b is None:
+                return
+            lo = [coords[axis][b[2 * axis]] for axis in range(3)]
+            hi = [coords[axis][b[2 * axis + 1]] for axis in range(3)]
+            if hasattr(f, "interval"):
+                low, high = f.interval(lo, hi)
+                # Any value in the interval with the same sign as all of it will do,
+                # leaving some room for rounding error
+                skip = low > settings.EPS or high < -settings.EPS
+                value = float(low if low > 0 else high)
+            else:
+                center = [(l + h) / 2 for l, h in zip(lo, hi)]
+                radius = math.sqrt(sum((h - l) ** 2 for l, h in zip(lo, hi))) / 2
+                value = f(*center)
+                skip = abs(value) > lipschitz * radius
+            if skip:
+                culled.append((b, value))
+            elif size <= block_size:
+                active.append(b)
+            else:
+                half = size // 2
+                for dx in (0, half):
+                    for dy in (0, half):
+                        for dz in (0, half):
+                            visit((start[0] + dx, start[1] + dy, start[2] + dz), half)
+
+        # Start from the smallest power of two multiple of block_size that covers the grid
+        size = block_size
+        while size < max(shape):
+            size *= 2
+        visit((0, 0, 0), size)
+        return active, culled
+
+    # Nothing bounds f, so any block could contain part of the boundary
+    for ix in range(0, shape[0], block_size):
+        for iy in range(0, shape[1], block_size):
+            for iz in range(0, shape[2], block_size):
+                active.append(block((ix, iy, iz), block_size))
+    return active, culled
+
+
+def find_crossings(values, xs, ys, zs, config=None):
+    """Finds every edge of the lattice whose end points have opposite signs,
+    and where along that edge the boundary crosses it.
+    Returns a list with an entry per axis. Each entry is a pair of a boolean array of which edges along that axis
+    are crossed (edge [ix, iy, iz] starts at lattice point [ix, iy, iz]), and an array of the crossing positions,
+    in the order of the crossed edges. config (see config.Config) controls the interpolation."""
+    coords = [np.asarray(xs, dtype=float), np.asarray(ys, dtype=float), np.asarray(zs, dtype=float)]
+    result = []
+    for axis in range(3):
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[axis] = slice(None, -1)
+        hi[axis] = slice(1, None)
+        v0 = values[tuple(lo)]
+        v1 = values[tuple(hi)]
+        mask = (v0 > 0) != (v1 > 0)
+        index = np.nonzero(mask)
+        positions = np.stack([coords[a][index[a]] for a in range(3)], axis=-1)
+        positions[:, axis] += adapt_array(v0[mask], v1[mask], config, axis)
+        result.append((mask, positions))
+    return result
+
+
+# Number of rows formatted at once when writing text, to bound the size of the strings built
+WRITE_BATCH = 65536
+
+
+def _write_rows(f, template, rows):
+    """Writes a line per row of a 2d array, formatting each batch of rows with a single % operation"""
+    rows = rows.tolist()
+    for i in range(0, len(rows), WRITE_BATCH):
+        batch = rows[i:i + WRITE_BATCH]
+        f.write((template * len(batch)) % tuple(x for row in batch for x in row))
+
+
+def make_obj(f, mesh, offset=0):
+    """Crude export to Wavefront mesh format.
+    offset is added to the vertex indices of the faces, for when mesh is being appended to an existing file."""
+    # %r formats floats the same as str does, so this matches writing each line with str.format
+    _write_rows(f, "v %r %r %r\n", mesh.positions)
+    for faces in mesh.face_runs():
+        _write_rows(f, "f" + " %d" * faces.shape[1] + "\n", faces + (offset + 1))
+
+
+def _ply_header(vertex_count, face_count, dtype, width=0):
+    """The header of a binary PLY file. Counts are zero padded to width"""
+    vertex_type = "double" if dtype == np.float64 else "float"
+    return "\n".join([
+        "ply",
+        "format binary_little_endian 1.0",
+        "element vertex {:0{}d}".format(vertex_count, width),
+        "property {} x".format(vertex_type),
+        "property {} y".format(vertex_type),
+        "property {} z".format(vertex_type),
+        "element face {:0{}d}".format(face_count, width),
+        "property list uchar int vertex_indices",
+        "end_header",
+        ""
+    ]).encode("ascii")
+
+
+def make_ply(f, mesh):
+    """Export to binary PLY. f must be opened in binary mode.
+    Vertices are written at the precision they are stored in the mesh, and quads are kept as quads.
+    See PlyWriter for writing a piece at a time."""
+    positions = mesh.positions
+    f.write(_ply_header(len(positions), len(mesh.tris) + len(mesh.quads), positions.dtype))
+    f.write(positions.astype(positions.dtype.newbyteorder("<")).tobytes())
+    _write_ply_faces(f, mesh, 0)
+
+
+def _write_ply_faces(f, mesh, offset):
+    for faces in mesh.face_runs():
+        # Each face is its vertex count, followed by the indices
+        records = np.empty(len(faces), dtype=[("n", "u1"), ("v", "<i4", faces.shape[1])])
+        records["n"] = faces.shape[1]
+        records["v"] = faces + offset
+        f.write(records.tobytes())
+
+
+class ObjWriter:
+    """Writes a mesh to Wavefront mesh format a piece at a time, e.g. from marching_cubes_3d_stream.
+    Each piece has its own vertices, numbered from 0, and the writer keeps track of how many vertices
+    came before, to offset the faces."""
+    def __init__(self, f):
+        self.f = f
+        self.vertex_count = 0
+
+    def write(self, mesh):
+        make_obj(self.f, mesh, self.vertex_count)
+        self.vertex_count += len(mesh.positions)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class PlyWriter:
+    """Like ObjWriter, but writes binary PLY. f must be opened in binary mode, and be seekable.
+
+    PLY needs the number of vertices and faces in the header, and all the vertices before any of the faces.
+    So vertices go straight to f, while faces are held in a temporary file until close, when they are copied
+    over and the header filled in."""
+    # Counts in the header are zero padded to this width, so they can be filled in later without moving anything
+    COUNT_WIDTH = 12
+
+    def __init__(self, f, dtype=np.float64):
+        self.f = f
+        self.dtype = np.dtype(dtype).newbyteorder("<")
+        self.vertex_count = 0
+        self.face_count = 0
+        self.faces = tempfile.TemporaryFile()
+        self.start = f.tell()
+        f.write(self._header())
+
+    def _header(self):
+        return _ply_header(self.vertex_count, self.face_count, self.dtype, self.COUNT_WIDTH)
+
+    def write(self, mesh):
+        self.f.write(mesh.positions.astype(self.dtype).tobytes())
+        _write_ply_faces(self.faces, mesh, self.vertex_count)
+        self.vertex_count += len(mesh.positions)
+        self.face_count += len(mesh.tris) + len(mesh.quads)
+
+    def close(self):
+        if self.faces is None:
+            return
+        self.faces.seek(0)
+        shutil.copyfileobj(self.faces, self.f)
+        self.faces.close()
+        self.faces = None
+        end = self.f.tell()
+        self.f.seek(self.start)
+        self.f.write(self._header())
+        self.f.seek(end)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def make_stl(f, mesh):
+    """Export to binary STL. f must be opened in binary mode.
+    STL only supports triangles, so quads are split in two, and vertices are written as 32 bit floats."""
+    tris = mesh.triangles()
+    corners = mesh.positions[tris].astype(np.float64)
+    normals = np.cross(corners[:, 1] - corners[:, 0], corners[:, 2] - corners[:, 0])
+    length = np.linalg.norm(normals, axis=-1, keepdims=True)
+    normals = np.divide(normals, length, out=np.zeros_like(normals), where=length > 0)
+
+    records = np.zeros(len(tris), dtype=[("normal", "<f4", 3), ("corners", "<f4", (3, 3)), ("attributes", "<u2")])
+    records["normal"] = normals
+    records["corners"] = corners
+    f.write(b"Binary STL".ljust(80, b" "))
+    f.write(struct.pack("<I", len(tris)))
+    f.write(records.tobytes())
+
+
+def make_glb(f, mesh):
+    """Export to binary glTF (.glb), as a single triangle mesh. f must be opened in binary mode.
+    Quads are split in two, and vertices are written as 32 bit floats.
+    glTF doesn't allow empty buffers, so a mesh with no faces is written as a scene with nothing in it."""
+    positions = mesh.positions.astype("<f4")
+    indices = mesh.triangles().astype("<u4").ravel()
+    # Chunks and buffer views must be 4 byte aligned. Both of these are already.
+    binary = positions.tobytes() + indices.tobytes() if len(indices) else b""
+    document = {
+        "asset": {"version": "2.0"},
+        "scene": 0,
+        "scenes": [{}],
+    }
+    if binary:
+        document.update({
+            "scenes": [{"nodes": [0]}],
+            "nodes": [{"mesh": 0}],
+            "meshes": [{"primitives": [{"attributes": {"POSITION": 0}, "indices": 1, "mode": 4}]}],
+            "buffers": [{"byteLength": len(binary)}],
+            "bufferViews": [
+                {"buffer": 0, "byteOffset": 0, "byteLength": positions.nbytes, "target": 34962},
+                {"buffer": 0, "byteOffset": positions.nbytes, "byteLength": indices.nbytes, "target": 34963},
+            ],
+            "accessors": [
+                {"bufferView": 0, "componentType": 5126, "count": len(positions), "type": "VEC3",
+                 "min": positions.min(axis=0).tolist(), "max": positions.max(axis=0).tolist()},
+                {"bufferView": 1, "componentType": 5125, "count": len(indices), "type": "SCALAR"},
+            ],
+        })
+    text = json.dumps(document, separators=(",", ":")).encode("utf-8")
+    text += b" " * (-len(text) % 4)
+
+    length = 12 + 8 + len(text) + (8 + len(binary) if binary else 0)
+    f.write(struct.pack("<4sII", b"glTF", 2, length))
+    f.write(struct.pack("<I4s", len(text), b"JSON"))
+    f.write(text)
+    if binary:
+        f.write(struct.pack("<I4s", len(binary), b"BIN\0"))
+        f.write(binary)
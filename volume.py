@@ -0,0 +1,123 @@
+"""Provides a way of meshing scalar fields that have already been sampled on a grid, such as CT scans or
+simulation output, rather than given as a function.
+
+A Volume wraps an array with an entry per grid point, along with the position of the first point (origin)
+and the distance between points (spacing). It can be called like any other f, interpolating linearly
+between grid points, so works with all the extractors, in 2d or 3d. Its normal method works as f_normal,
+by taking finite differences of the array.
+
+The array can be a numpy.memmap (see load_npy and load_raw) for volumes too large to load. It is only ever read
+a few grid points, or a slab of settings.CHUNK_SIZE planes, at a time. To avoid interpolating, mesh with
+CELL_SIZE equal to the spacing, over the range given by bounds. E.g.
+
+    volume = load_npy("scan.npy", spacing=CELL_SIZE)
+    mesh = dual_contour_3d(volume, volume.normal, *volume.bounds())"""
+
+import numpy as np
+
+import settings
+from utils_2d import V2
+from utils_3d import V3
+
+
+class Volume:
+    """A scalar field sampled on a regular grid. data[i, j, k] is the value at origin + (i, j, k) * spacing.
+    spacing can be a single number, or one per axis."""
+    def __init__(self, data, origin=None, spacing=1):
+        self.data = data
+        self.ndim = data.ndim
+        self.origin = tuple(float(o) for o in (origin if origin is not None else (0,) * self.ndim))
+        self.spacing = tuple(float(s) for s in np.broadcast_to(spacing, (self.ndim,)))
+        assert len(self.origin) == self.ndim, "origin does not match the dimensions of data"
+        assert min(data.shape) >= 2, "a volume needs at least two grid points along each axis"
+
+    def bounds(self):
+        """Returns the range covered by the grid, in the same order as the arguments of the extractors,
+        i.e. xmin, xmax, ymin, ymax[, zmin, zmax]"""
+        result = []
+        for o, s, n in zip(self.origin, self.spacing, self.data.shape):
+            result.extend((o, o + s * (n - 1)))
+        return tuple(result)
+
+    def _locate(self, axis, p):
+        """Finds the grid points either side of position p along axis, and how far p is between them.
+        Positions outside the grid are clamped to it."""
+        n = self.data.shape[axis]
+        t = (p - self.origin[axis]) / self.spacing[axis]
+        t = np.clip(t, 0, n - 1)
+        i0 = np.minimum(np.floor(t).astype(np.int64), n - 2)
+        return i0, t - i0
+
+    def __call__(self, *p):
+        """Evaluates the field at a single point by (bi/tri)linear interpolation.
+        At grid points, this is exactly the stored value."""
+        assert len(p) == self.ndim, "point does not match the dimensions of the volume"
+        located = [self._locate(axis, x) for axis, x in enumerate(p)]
+        start = tuple(int(i0) for i0, _ in located)
+        corners = np.asarray(self.data[tuple(slice(i, i + 2) for i in start)], dtype=float)
+        # Interpolate away one axis at a time
+        for _, t in located:
+            corners = corners[0] * (1 - float(t)) + corners[1] * float(t)
+        return float(corners)
+
+    def sample(self, *coords):
+        """Evaluates the field at every point of the lattice spanned by coords (one list of positions per axis),
+        the same as calling it at each point, but reading the data a slab at a time.
+        Only the part of the data around the lattice is read, so sampling a small part of a volume is cheap.
+        Returns an array with shape (len(coords[0]), len(coords[1]), ...)."""
+        assert len(coords) == self.ndim, "lattice does not match the dimensions of the volume"
+        coords = [np.asarray(c, dtype=float) for c in coords]
+        located = [self._locate(axis, c) for axis, c in enumerate(coords)]
+        result = np.empty([len(c) for c in coords])
+        # The range of grid points the lattice lies between, along the other axes
+        others = [(i0.min(), i0.max() + 2) for i0, _ in located[1:]]
+        box = tuple(slice(first, last) for first, last in others)
+        tile = settings.CHUNK_SIZE
+        for start in range(0, len(coords[0]), tile):
+            i0, t = located[0]
+            i0, t = i0[start:start + tile], t[start:start + tile]
+            # Read just the planes this slab of the lattice lies between
+            first, last = i0.min(), i0.max() + 2
+            values = np.asarray(self.data[(slice(first, last),) + box], dtype=float)
+            values = _interpolate_axis(values, 0, i0 - first, t)
+            for axis, (low, _) in enumerate(others, 1):
+                i0, t = located[axis]
+                values = _interpolate_axis(values, axis, i0 - low, t)
+            result[start:start + tile] = values
+        return result
+
+    def normal(self, *p):
+        """Estimates the gradient of the field at a point by central differences one grid spacing either side,
+        for use as f_normal. Returns a normalized V2 or V3."""
+        gradient = []
+        lo, hi = self.bounds()[0::2], self.bounds()[1::2]
+        for axis in range(self.ndim):
+            # Use one sided differences at the edges of the grid
+            p0 = list(p)
+            p1 = list(p)
+            p0[axis] = max(p[axis] - self.spacing[axis], lo[axis])
+            p1[axis] = min(p[axis] + self.spacing[axis], hi[axis])
+            gradient.append((self(*p1) - self(*p0)) / (p1[axis] - p0[axis]))
+        return (V3 if self.ndim == 3 else V2)(*gradient).normalize()
+
+
+def _interpolate_axis(values, axis, i0, t):
+    """Linearly interpolates values along axis at the points between index i0 and i0 + 1, at fraction t"""
+    shape = [1] * values.ndim
+    shape[axis] = len(t)
+    t = t.reshape(shape)
+    return np.take(values, i0, axis=axis) * (1 - t) + np.take(values, i0 + 1, axis=axis) * t
+
+
+def load_npy(path, origin=None, spacing=1):
+    """Opens a .npy file as a Volume, memory mapping rather than loading it"""
+    return Volume(np.load(path, mmap_mode="r"), origin, spacing)
+
+
+def load_raw(path, shape, dtype, origin=None, spacing=1, order="C"):
+    """Opens a headerless file of shape values of type dtype as a Volume, memory mapping rather than loading it.
+    order is "C" if the last axis varies fastest, or "F" if the first does."""
+    return Volume(np.memmap(path, dtype=dtype, mode="r", shape=tuple(shape), order=order), origin, spacing)
+
+
+__all__ = ["Volume", "load_npy", "load_raw"]